@@ -0,0 +1,246 @@
+import time
+import threading
+from itertools import islice
+
+from .tools import ENV, get_logger
+
+
+LOGGER = get_logger(__name__)
+
+
+# Ticks further apart than this may have missed renders
+AGGREGATE_MAX_GAP = float(ENV.get("AGGREGATE_MAX_GAP", 120))
+SUMMARY_LIST_SIZE = 10
+# What an aggregate keeps of a render, the layers of the few a summary
+# lists are read when it's sent
+RECORD_FIELDS = ["name", "user", "show", "shot", "startTime", "stopTime"]
+
+
+def get_render_cores(job):
+    cores = 0
+    for layer in job.get("layers", []):
+        cores += layer.get("currentCores", 0)
+    return cores
+
+
+def get_record(job):
+    return {field: job[field] for field in RECORD_FIELDS if field in job}
+
+
+def is_finished(job):
+    return job.get("state") == "1"
+
+
+def get_shot_key(job):
+    show = job.get("show")
+    shot = job.get("shot")
+    if not show or not shot or shot.startswith("none_"):
+        return None
+    return show, shot
+
+
+class UserAggregate:
+    """Everything a farm summary shows about one user's renders since a time.
+
+    Kept up to date one render at a time so reading it never walks the
+    renders themselves.
+    """
+
+    def __init__(self, user, since):
+        self.user = user
+        self.since = since
+        # {name: record}, in the order they were first seen
+        self.finished = {}
+        self.running = {}
+        # {show: {shot: [running renders, finished renders]}}
+        self.shots = {}
+        self.duration = 0
+        self.seen = set()
+        # Tick it was seeded in, see RenderAggregates.end_tick
+        self.tick = None
+
+    def add(self, job, finished=None):
+        name = job["name"]
+        self.remove(name)
+        if finished is None:
+            finished = is_finished(job)
+        job = get_record(job)
+        if finished:
+            self.finished[name] = job
+            self.duration += job["stopTime"] - job["startTime"]
+        else:
+            self.running[name] = job
+        key = get_shot_key(job)
+        if key:
+            counts = self.shots.setdefault(key[0], {}).setdefault(key[1], [0, 0])
+            counts[1 if finished else 0] += 1
+
+    def remove(self, name):
+        job = self.finished.pop(name, None)
+        finished = job is not None
+        if finished:
+            self.duration -= job["stopTime"] - job["startTime"]
+        else:
+            job = self.running.pop(name, None)
+            if job is None:
+                return
+        key = get_shot_key(job)
+        if key:
+            shots = self.shots[key[0]]
+            counts = shots[key[1]]
+            counts[1 if finished else 0] -= 1
+            if not any(counts):
+                del shots[key[1]]
+                if not shots:
+                    del self.shots[key[0]]
+
+    def observe(self, job):
+        if job["startTime"] <= self.since:
+            return
+        self.seen.add(job["name"])
+        self.add(job)
+
+    def get_gone(self):
+        # Running renders that dropped off the farm this tick
+        return [name for name in self.running if name not in self.seen]
+
+    def end_tick(self, stored):
+        # A render that left the farm finished if it was stored, see
+        # RenderAggregates.end_tick, finished ones stay until the window
+        # rolls over
+        for name in self.get_gone():
+            if name in stored:
+                self.add(stored[name], finished=True)
+            else:
+                self.remove(name)
+        self.seen = set()
+
+    def roll(self, since):
+        self.since = since
+        for renders in (self.finished, self.running):
+            for name in [n for n, job in renders.items() if job["startTime"] <= since]:
+                self.remove(name)
+
+    def seed(self, finished, running):
+        for job in running:
+            self.add(job)
+        for job in finished:
+            self.add(job, finished=True)
+
+    def get_shows(self):
+        # Same shape as the old per summary scan, a shot still running in
+        # any render isn't listed as finished
+        shows = {}
+        if not self.running or not self.finished:
+            return shows
+        for show, shots in self.shots.items():
+            shows[show] = {
+                "finished": [shot for shot, (r, f) in shots.items() if f and not r],
+                "running": [shot for shot, (r, _) in shots.items() if r],
+            }
+        return shows
+
+    def get_summary(self, limit=SUMMARY_LIST_SIZE):
+        return {
+            "user": self.user,
+            "since": self.since,
+            "finished": list(islice(self.finished.values(), limit)),
+            "running": list(islice(self.running.values(), limit)),
+            "finished_count": len(self.finished),
+            "running_count": len(self.running),
+            "shows": self.get_shows(),
+            "duration": self.duration,
+        }
+
+
+class RenderAggregates:
+    """User aggregates the cue tick keeps current as jobs stream past.
+
+    An aggregate is only trusted for a window if ticks ran without a gap
+    since it was seeded, otherwise the summary rebuilds it from storage.
+    """
+
+    def __init__(self, max_gap=AGGREGATE_MAX_GAP):
+        self.max_gap = max_gap
+        self.lock = threading.Lock()
+        # {user: (aggregate, seeded at)}
+        self.users = {}
+        self.covered_from = None
+        self.last_tick = None
+        self.ticks = 0
+
+    def observe(self, jobs):
+        users = self.users
+        lock = self.lock
+        for job in jobs:
+            tracked = users.get(job.get("user"))
+            if tracked is not None:
+                with lock:
+                    tracked[0].observe(job)
+            yield job
+
+    def begin_tick(self):
+        now = time.time()
+        if self.last_tick is None or now - self.last_tick > self.max_gap:
+            self.covered_from = now
+        self.last_tick = now
+        self.ticks += 1
+
+    def end_tick(self, storage=None):
+        with self.lock:
+            gone = [
+                name
+                for aggregate, _ in self.users.values()
+                if aggregate.tick != self.ticks
+                for name in aggregate.get_gone()
+            ]
+        stored = {}
+        if gone and storage is not None:
+            try:
+                renders = storage.get_renders(gone, RECORD_FIELDS)
+            except Exception as e:
+                # Guessing would drop renders that did finish, rebuild instead
+                LOGGER.error(f"Couldn't look up renders that left the farm: {e}")
+                self.invalidate()
+                renders = []
+            stored = {render["name"]: render for render in renders}
+        with self.lock:
+            for aggregate, _ in self.users.values():
+                if aggregate.tick == self.ticks:
+                    # Seeded halfway through this tick, it didn't see every job
+                    aggregate.seen = set()
+                    continue
+                aggregate.end_tick(stored)
+
+    def invalidate(self):
+        self.covered_from = None
+        self.last_tick = None
+
+    def is_covered(self, seeded_at):
+        if self.covered_from is None or self.last_tick is None:
+            return False
+        if time.time() - self.last_tick > self.max_gap:
+            return False
+        # Seeding counts as a look at everything, so ticks may start up to a
+        # gap after it
+        return self.covered_from - seeded_at <= self.max_gap
+
+    def get_summary(self, user, since):
+        with self.lock:
+            tracked = self.users.get(user)
+            if tracked is None:
+                return None
+            aggregate, seeded_at = tracked
+            if aggregate.since > since or not self.is_covered(seeded_at):
+                return None
+            if aggregate.since < since:
+                aggregate.roll(since)
+            return aggregate.get_summary()
+
+    def seed(self, user, since, finished, running):
+        aggregate = UserAggregate(user, since)
+        aggregate.seed(finished, running)
+        with self.lock:
+            aggregate.tick = self.ticks
+            self.users[user] = (aggregate, time.time())
+            return aggregate.get_summary()
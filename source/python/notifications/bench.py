@@ -0,0 +1,354 @@
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import functools
+import tracemalloc
+from statistics import mean
+
+import bson
+from bson.raw_bson import RawBSONDocument
+
+from . import cue
+from .slack import Response
+from .storage import MemoryStorage
+from .snapshot import EVENT_JOB_FIELDS, get_shard
+from .aggregates import RenderAggregates
+from .metrics import METRICS
+
+
+# What slack answers to every summary the bench sends
+SENT = Response(200, "{}")
+
+
+def percentile(values, percent):
+    if not values:
+        return 0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def get_stats(values):
+    return {
+        "count": len(values),
+        "mean": mean(values) if values else 0,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "max": max(values) if values else 0,
+    }
+
+
+def generate_users(amount):
+    return [f"user{i:03d}" for i in range(amount)]
+
+
+def generate_shows(amount):
+    return [f"show{i:02d}" for i in range(amount)]
+
+
+def generate_job(rng, index, users, shows, now):
+    user = rng.choice(users)
+    show = rng.choice(shows)
+    shot = f"{rng.randint(1, 300):04d}"
+    name = f"{show}-{shot}-lighting-v{rng.randint(1, 40):03d}-{user}-{index}"
+    layers = []
+    for layer_index in range(rng.randint(1, 4)):
+        asset_dir = f"/jobs/{show}/{shot}/renders/{name}/layer{layer_index}"
+        layers.append({
+            "name": f"layer{layer_index}",
+            "currentCores": rng.choice([0, 8, 16, 32, 64]),
+            "percentCompleted": rng.randint(0, 100),
+            "outputPaths": [f"{asset_dir}/beauty.####.exr"],
+        })
+    start_time = now - rng.randint(0, 20 * 60 * 60)
+    return {
+        "name": name,
+        "user": user,
+        "show": show,
+        "shot": shot,
+        "state": rng.choice(["0", "0", "0", "1", "2"]),
+        "deadFrames": rng.choice([0] * 9 + [rng.randint(1, 50)]),
+        "startTime": start_time,
+        "stopTime": now - rng.randint(0, 60),
+        "layers": layers,
+    }
+
+
+def generate_snapshot(amount, users, shows, seed=0, now=None):
+    rng = random.Random(seed)
+    now = now or time.time()
+    jobs = [generate_job(rng, i, users, shows, now) for i in range(amount)]
+    return {"data": {"jobs": jobs}}
+
+
+def generate_rules(amount, users, shows, seed=0):
+    rng = random.Random(seed)
+    rules = []
+    for i in range(amount):
+        show = rng.choice(shows)
+        kind = rng.random()
+        if kind < 0.4:
+            targets = [f"{show}-*"]
+        elif kind < 0.7:
+            targets = [f"{show}-{rng.randint(1, 300):04d}-*"]
+        elif kind < 0.9:
+            targets = [f"*-{rng.choice(users)}-*"]
+        else:
+            targets = [f"{show}-0[0-4]??-*-v0*"]
+        filters = {}
+        if rng.random() < 0.3:
+            filters["users"] = rng.sample(users, min(len(users), 3))
+        rules.append({
+            "id": f"rule{i}",
+            "user": rng.choice(users),
+            "notified_for": rng.choice(cue.EVENT_RULE_TYPES),
+            "delivery": "slack",
+            "targets": targets,
+            "filters": filters,
+        })
+    return rules
+
+
+def mutate_snapshot(snapshot, rng, ratio, now):
+    jobs = [dict(job) for job in snapshot["data"]["jobs"]]
+    for job in rng.sample(jobs, int(len(jobs) * ratio)):
+        change = rng.random()
+        if change < 0.4:
+            job["state"] = "1"
+            job["stopTime"] = now
+        elif change < 0.8:
+            job["deadFrames"] = 0 if job["deadFrames"] else rng.randint(1, 20)
+        else:
+            job["state"] = "0"
+    return {"data": {"jobs": jobs}}
+
+
+def generate_ticks(jobs, users, shows, ticks, change, seed, now):
+    # The snapshot of every tick, the same for the same arguments
+    rng = random.Random(seed)
+    snapshots = [generate_snapshot(jobs, users, shows, seed, now)]
+    for tick in range(1, ticks):
+        snapshots.append(mutate_snapshot(snapshots[-1], rng, change, now + tick))
+    return snapshots
+
+
+def encode_snapshot(snapshot, fields=EVENT_JOB_FIELDS):
+    # As mongo hands it over, projected and still BSON
+    jobs = [
+        {field: job[field] for field in fields if field in job}
+        for job in snapshot["data"]["jobs"]
+    ]
+    return RawBSONDocument(bson.encode({"data": {"jobs": jobs}}))
+
+
+def split_snapshot(snapshot, shards):
+    parts = [[] for _ in range(shards)]
+    for job in snapshot["data"]["jobs"]:
+        parts[get_shard(job["name"], shards)].append(job)
+    return [{"data": {"jobs": jobs}} for jobs in parts]
+
+
+class ShardBenchStorage(MemoryStorage):
+    """A shard's storage, every tick's snapshot split and encoded up front
+    the way the server side filter would hand it over."""
+
+    def __init__(self, rules, shards, raw, *args):
+        super().__init__(rules=rules)
+        self.parts = []
+        for snapshot in generate_ticks(*args):
+            parts = split_snapshot(snapshot, shards)
+            self.parts.append([encode_snapshot(part) if raw else part for part in parts])
+
+    def get_snapshot_shard(self, snapshot_id, shard, shards, fields=None):
+        return self.parts[snapshot_id - 1][shard]
+
+
+class CountingStorage:
+    # Wraps a storage and counts every call, i.e. queries against a real one
+    def __init__(self, storage):
+        self.storage = storage
+        self.counts = {}
+
+    def __getattr__(self, attr):
+        func = getattr(self.storage, attr)
+        if not callable(func):
+            return func
+
+        def counted(*args, **kwargs):
+            self.counts[attr] = self.counts.get(attr, 0) + 1
+            return func(*args, **kwargs)
+
+        return counted
+
+    def reset(self):
+        counts = self.counts
+        self.counts = {}
+        return counts
+
+
+def bench_run(
+    jobs=2000, rules=200, users=50, shows=10, ticks=10, change=0.02, seed=0,
+    shards=0, raw=False,
+):
+    now = time.time()
+    user_names = generate_users(users)
+    show_names = generate_shows(shows)
+    rule_docs = generate_rules(rules, user_names, show_names, seed)
+    args = (jobs, user_names, show_names, ticks, change, seed, now)
+    storage = CountingStorage(MemoryStorage(rules=rule_docs))
+    if shards > 1:
+        from .shards import ShardedCueEngine
+        factory = functools.partial(ShardBenchStorage, rule_docs, shards, raw, *args)
+        engine = ShardedCueEngine(storage, shards, factory)
+        # Starts the shards and builds their snapshots outside of the ticks
+        engine.check(engine.pool.broadcast("reset"))
+        snapshots = [{}] * ticks
+    else:
+        engine = cue.CueEngine(storage)
+        snapshots = generate_ticks(*args)
+        if raw:
+            snapshots = [encode_snapshot(snapshot) for snapshot in snapshots]
+    results = []
+    tracemalloc.start()
+    for tick in range(ticks):
+        storage.snapshots.append(snapshots[tick])
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        start_time = time.perf_counter()
+        tick_data = engine.run()
+        elapsed = time.perf_counter() - start_time
+        _, peak = tracemalloc.get_traced_memory()
+        results.append({
+            "tick": tick,
+            "seconds": elapsed,
+            "queries": storage.reset(),
+            "peak_memory": peak,
+            "messages": len(tick_data.new_messages) if tick_data else 0,
+        })
+        if shards > 1:
+            # The busiest shard bounds the tick once every shard has a core
+            stats = [stats for stats in engine.shard_stats if stats]
+            results[-1]["shard_seconds"] = max(
+                [shard["seconds"] for shard in stats], default=0
+            )
+            results[-1]["shard_cpu_seconds"] = max(
+                [shard["cpu_seconds"] for shard in stats], default=0
+            )
+    tracemalloc.stop()
+    if shards > 1:
+        engine.close()
+    steady = [result["seconds"] for result in results[1:]]
+    return {
+        "params": {
+            "jobs": jobs,
+            "rules": rules,
+            "users": users,
+            "shows": shows,
+            "ticks": ticks,
+            "change": change,
+            "shards": shards,
+            "raw": raw,
+        },
+        "first_tick": results[0],
+        "steady_ticks": get_stats(steady),
+        "jobs_per_second": jobs / results[0]["seconds"] if results[0]["seconds"] else 0,
+        "ticks": results,
+    }
+
+
+def bench_summary(jobs=2000, users=50, shows=10, renders=5000, seed=0):
+    now = time.time()
+    user_names = generate_users(users)
+    show_names = generate_shows(shows)
+    snapshot = generate_snapshot(jobs, user_names, show_names, seed, now)
+    finished = generate_snapshot(renders, user_names, show_names, seed + 1, now)
+    storage = CountingStorage(MemoryStorage(
+        snapshots=[snapshot], renders=finished["data"]["jobs"]
+    ))
+    rules = [
+        {"notified_for": "farm_summary", "user": user, "times": [0, 0]}
+        for user in user_names
+    ]
+    sent = []
+
+    def send(**kwargs):
+        sent.append(kwargs)
+        return SENT
+
+    aggregates = RenderAggregates()
+    # A tick just ran, so the aggregates seeded by the first run are trusted
+    aggregates.begin_tick()
+    start_time = time.perf_counter()
+    cue.run_summary(storage, rules, send=send, aggregates=aggregates)
+    elapsed = time.perf_counter() - start_time
+    queries = storage.reset()
+    # Every user is read from the aggregates this time
+    start_time = time.perf_counter()
+    cue.run_summary(storage, rules, send=lambda **kwargs: SENT, aggregates=aggregates)
+    warm_elapsed = time.perf_counter() - start_time
+    warm_queries = storage.reset()
+    # Per user read and build latency, measured one user at a time
+    since = cue.get_logoff_ts(rules[0], cue.datetime.datetime.now(), storage)
+    latencies = []
+    for user in user_names:
+        user_start = time.perf_counter()
+        summary = aggregates.get_summary(user, since)
+        if summary is not None:
+            cue.send_summary(summary, send=lambda **kwargs: SENT)
+        latencies.append(time.perf_counter() - user_start)
+    return {
+        "params": {"jobs": jobs, "users": users, "shows": shows, "renders": renders},
+        "seconds": elapsed,
+        "queries": queries,
+        "warm_seconds": warm_elapsed,
+        "warm_queries": warm_queries,
+        "summaries": len(sent),
+        "per_user": get_stats(latencies),
+    }
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Benchmark the cue pipeline")
+    parser.add_argument("--jobs", type=int, default=2000)
+    parser.add_argument("--rules", type=int, default=200)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--shows", type=int, default=10)
+    parser.add_argument("--renders", type=int, default=5000)
+    parser.add_argument("--ticks", type=int, default=10)
+    parser.add_argument("--change", type=float, default=0.02)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--shards", type=int, default=0, help="Run the ticks across shard processes"
+    )
+    parser.add_argument(
+        "--raw", action="store_true", help="Hand the snapshots over as BSON, like mongo"
+    )
+    parser.add_argument("--output", help="Write the JSON results to this file")
+    args = parser.parse_args(args)
+    METRICS.reset()
+    results = {
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "run": bench_run(
+            args.jobs, args.rules, args.users, args.shows, args.ticks, args.change,
+            args.seed, args.shards, args.raw,
+        ),
+        "summary": bench_summary(
+            args.jobs, args.users, args.shows, args.renders, args.seed
+        ),
+        "metrics": METRICS.snapshot(),
+    }
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,45 @@
+from pymongo.errors import BulkWriteError
+
+from .tools import ENV, get_logger
+
+
+LOGGER = get_logger(__name__)
+
+BULK_BATCH_SIZE = int(ENV.get("NOTIFICATIONS_BULK_BATCH_SIZE", 500))
+
+
+class BulkWriter:
+    def __init__(self, batch_size=None):
+        self.batch_size = batch_size or BULK_BATCH_SIZE
+        self.pending = {}
+
+    def add(self, coll, op):
+        key = coll.full_name
+        if key not in self.pending:
+            self.pending[key] = (coll, [])
+        self.pending[key][1].append(op)
+
+    def __len__(self):
+        return sum(len(ops) for _, ops in self.pending.values())
+
+    def flush(self):
+        results = {}
+        for key, (coll, ops) in self.pending.items():
+            result = results[key] = {"ops": len(ops), "errors": [], "matched": 0}
+            for i in range(0, len(ops), self.batch_size):
+                batch = ops[i:i + self.batch_size]
+                try:
+                    result["matched"] += coll.bulk_write(batch, ordered=False).matched_count
+                except BulkWriteError as e:
+                    result["matched"] += e.details.get("nMatched", 0)
+                    errors = e.details.get("writeErrors", [])
+                    # Report the index within the whole flush, not the batch
+                    for error in errors:
+                        error["index"] += i
+                    result["errors"] += errors
+                    LOGGER.error(
+                        f"{len(errors)} of {len(batch)} writes to {key} failed: "
+                        f"{errors[0]['errmsg'] if errors else e}"
+                    )
+        self.pending = {}
+        return results
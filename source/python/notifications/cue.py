@@ -1,280 +1,566 @@
-import fnmatch
+import time
 import datetime
-from uuid import uuid4
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 from . import slack
-from .tools import get_logger, get_collection, get_slackbot_collection
+from .messages import (
+    WINDOW_MARGIN, get_message_key, new_message, new_digest, is_open, add_entry
+)
+from .throttle import DIGEST, Throttle
+from .diff import SnapshotDiffer
+from .events import EVENT_TYPES
+from .snapshot import (
+    EVENT_JOB_FIELDS, AGGREGATE_JOB_FIELDS, SUMMARY_JOB_FIELDS, iter_jobs
+)
+from .storage import MongoStorage
+from .sources import CueSource
+from .locks import LOCK_REFRESH_INTERVAL
+from .metrics import METRICS
+from .vri import VriResolver
+from .aggregates import (
+    RECORD_FIELDS, RenderAggregates, UserAggregate, get_render_cores
+)
+from .templates import (
+    SECTION_TEXT_LIMIT, Template, join_limited, join_words, section, divider,
+    limit_blocks,
+)
+from .rules import RuleIndex, get_rules_revision
+from .tools import ENV, get_logger
 
 
 
 LOGGER = get_logger(__name__)
 
-rules_coll = get_collection("notification_rules")
-farm_coll = get_slackbot_collection("store_farm")
-renders_coll = get_slackbot_collection("store_renders")
-renders_submitted_coll = get_collection("renders_submitted")
-renders_failing_coll = get_collection("renders_failing")
-renders_finished_coll = get_collection("renders_finished")
-messages_coll = get_collection("notification_messages")
-notification_times_coll = get_collection("notification_times")
-
-
-def is_rule_relevant(rule, job):
-    rule_match = False
-    job_name = job["name"]
-    for target in rule["targets"]:
-        if fnmatch.fnmatch(job_name, target):
-            rule_match = True
-            break
-    if not rule_match:
-        return False
-    filters = rule.get("filters", {})
-    users_filter = filters.get("users", [])
-    if users_filter and job["user"] not in users_filter:
-        return False
-    return True
+RENDER_FIELDS = [
+    "name",
+    "user",
+    "show",
+    "shot",
+    "startTime",
+    "stopTime",
+    "layers.outputPaths",
+]
+SUMMARY_WORKERS = int(ENV.get("SUMMARY_WORKERS", 8))
+EVENT_RULE_TYPES = list(EVENT_TYPES)
+# More than one splits each tick across that many shard processes
+CUE_SHARDS = int(ENV.get("CUE_SHARDS", 0))
+# Used when a user hasn't set their own times
+SUMMARY_TIME = ENV.get("SUMMARY_TIME", "09:00")
+LOGOFF_TIME = ENV.get("SUMMARY_LOGOFF_TIME", "21:00")
+
+SUMMARY_MAX_SHOTS = int(ENV.get("SUMMARY_MAX_SHOTS", 20))
+
+NO_RENDERS_TEXT = ":sunny: Morning! You had no renders on the farm last night."
+MORNING_TEXT = Template(":sunny: Morning! Here's your farm summary since yesterday {since}.")
+INTRO_TEXT = Template(
+    "You had {renders} {renders_text} on the farm, {finished} of which are finished."
+)
+FINISHED_LINE = Template(">_{name}_\n>`{vri}`\n>Start-to-finish: {render_time}\n\n")
+RUNNING_LINE = Template(">`{name}`\n>Progress: {progress}%\n>Current power: {cores} cores\n\n")
+
+_ENGINE = None
+VRI_RESOLVER = VriResolver()
+
+
+class Evaluation:
+    """Lock changes and notifications decided for a set of changed jobs.
+
+    Kept apart from message building so evaluations of disjoint sets of jobs
+    can be merged before coalescing.
+    """
+
+    def __init__(self, locks):
+        # {rule_type: {job name: set of notified users}}
+        self.locks = locks
+        self.lock_adds = {rule_type: {} for rule_type in locks}
+        self.lock_clears = {rule_type: set() for rule_type in locks}
+        # [(rule, job, now)] in evaluation order
+        self.notifications = []
+
+    def get_notified(self, rule_type, name):
+        return self.locks[rule_type].setdefault(name, set())
+
+    def add_notified(self, rule_type, name, user):
+        self.locks[rule_type].setdefault(name, set()).add(user)
+        self.lock_adds[rule_type].setdefault(name, []).append(user)
+
+    def clear_notified(self, rule_type, name):
+        self.locks[rule_type].pop(name, None)
+        self.lock_adds[rule_type].pop(name, None)
+        self.lock_clears[rule_type].add(name)
+
+    def merge(self, other):
+        for rule_type, adds in other.lock_adds.items():
+            self.lock_adds.setdefault(rule_type, {}).update(adds)
+        for rule_type, names in other.lock_clears.items():
+            self.lock_clears.setdefault(rule_type, set()).update(names)
+        self.notifications += other.notifications
+
+
+class TickData:
+    def __init__(self, rule_index, locks, messages, throttle=None, service="cue"):
+        self.rule_index = rule_index
+        self.service = service
+        self.evaluation = Evaluation(locks)
+        # {(rule_type, user, delivery, service): pending message}, digests
+        # are keyed by DIGEST for their rule_type
+        self.messages = messages
+        self.throttle = throttle
+        # {message id: new message}
+        self.new_messages = {}
+        # {message _id: (message, appended entries, {rule_type: count})}
+        self.appends = {}
+
+    @property
+    def lock_adds(self):
+        return self.evaluation.lock_adds
+
+    @property
+    def lock_clears(self):
+        return self.evaluation.lock_clears
+
+    def get_open(self, key, now):
+        message = self.messages.get(key)
+        if message is None:
+            return None
+        if message["id"] in self.new_messages or is_open(message, now):
+            return message
+        return None
+
+    def open_message(self, rule, now):
+        rule_type, user, delivery = rule["notified_for"], rule["user"], rule["delivery"]
+        # Anything still open takes the line for free, a new message needs
+        # budget and without it the line waits for the user's digest
+        key = (rule_type, user, delivery, self.service)
+        message = self.get_open(key, now)
+        if message is not None:
+            return message
+        digest_key = (DIGEST, user, delivery, self.service)
+        message = self.get_open(digest_key, now)
+        if message is None:
+            if self.throttle is None or self.throttle.allow(user, delivery, now):
+                message = self.messages[key] = new_message(rule, now, self.service)
+            else:
+                message = self.messages[digest_key] = new_digest(
+                    user, delivery, now, service=self.service
+                )
+                METRICS.inc("digests_opened", delivery=delivery, service=self.service)
+            self.new_messages[message["id"]] = message
+        if message["rule_type"] == DIGEST:
+            METRICS.inc("events_throttled", rule_type=rule_type, service=self.service)
+        return message
+
+    def notify(self, rule, job, now):
+        rule_type = rule["notified_for"]
+        message = self.open_message(rule, now)
+        entry = {"name": job["name"], "user": job["user"]}
+        if message["rule_type"] == DIGEST:
+            entry["rule_type"] = rule_type
+        stored = add_entry(message, entry)
+        METRICS.inc("events_notified", rule_type=rule_type, service=self.service)
+        if message["id"] in self.new_messages:
+            return
+        _, entries, counts = self.appends.setdefault(message["_id"], (message, [], {}))
+        # Past the cap only the total grows, the entry is dropped
+        entries.append(entry if stored else None)
+        if "counts" in message:
+            counts[rule_type] = counts.get(rule_type, 0) + 1
+
+    def coalesce(self):
+        for rule, job, now in self.evaluation.notifications:
+            self.notify(rule, job, now)
+
+
+def get_triggered(transitions):
+    return [
+        name for name, event_type in EVENT_TYPES.items()
+        if transitions & event_type.triggers
+    ]
 
 
-def process_submitted(job):
-    name = job["name"]
-    rules = rules_coll.find({"notified_for": "render_submitted"})
-    existing_data = renders_submitted_coll.find_one({"name": name})
-    for rule in rules:
-        if not is_rule_relevant(rule, job):
-            continue
-        if existing_data:
-            if rule["user"] in existing_data["users"]:
-                # Already notified
-                continue
-        now = datetime.datetime.now()
-        now_ts = datetime.datetime.timestamp(now)
-        finished_ts = job["startTime"]
-        mins = abs(now_ts - finished_ts) / 60
-        if mins > 10:
-            # Too old, ignore
-            continue
-        user_formatted = "you" if rule["user"] == job["user"] else job["user"]
-        existing_query = {
-            "rule_type": rule["notified_for"],
-            "user": rule["user"],
-            "delivery": rule["delivery"],
-        }
-        existing_message = messages_coll.find_one(existing_query)
-        if existing_message:
-            updated_message = (
-                existing_message["message"].replace(
-                    "*Farm job submitted*", "*Farm jobs submitted*"
-                )
-                + f"\n`{name}` by {user_formatted}"
-            )
-            messages_coll.update_one(
-                existing_query, {"$set": {"message": updated_message}}
-            )
-        else:
-            messages_coll.insert_one(
-                {
-                    "id": str(uuid4()),
-                    "rule_type": rule["notified_for"],
-                    "asset": name,
-                    "user": rule["user"],
-                    "message": f"*Farm job submitted*\n`{name}` by {user_formatted}",
-                    "timestamp": now_ts,
-                    "delivery": rule["delivery"],
-                    "service": "cue",
-                }
+def match_changes(changes, rule_index, service="cue"):
+    # Every changed job is matched once, against the types it can trigger
+    matched = []
+    for job, transitions in changes:
+        matches = rule_index.match_all(job, get_triggered(transitions))
+        for rule_type, rules in matches.items():
+            METRICS.inc(
+                "rules_matched", len(rules), rule_type=rule_type, service=service
             )
-        renders_submitted_coll.update_one(
-            {"name": name}, {"$push": {"users": rule["user"]}}, upsert=True
-        )
+        matched.append((job, transitions, matches))
+    return matched
 
 
-def process_failing(job):
-    name = job["name"]
-    if job["deadFrames"] == 0:
-        # Is not failing, remove existing failing locks
-        renders_failing_coll.delete_many({"name": name})
-        return
-    rules = rules_coll.find({"notified_for": "render_failing"})
-    existing_data = renders_failing_coll.find_one({"name": name})
-    for rule in rules:
-        if not is_rule_relevant(rule, job):
+def evaluate_job(job, transitions, matches, evaluation, now, prefix=""):
+    name = prefix + job["name"]
+    for rule_type, event_type in EVENT_TYPES.items():
+        if transitions & event_type.clears:
+            evaluation.clear_notified(rule_type, name)
+            continue
+        rules = matches.get(rule_type)
+        if not rules or not transitions & event_type.triggers:
+            continue
+        if not event_type.applies(job, now):
+            LOGGER.debug(f"{name} is too old for {rule_type}, ignoring...")
             continue
-        if existing_data:
-            if rule["user"] in existing_data["users"]:
+        notified = evaluation.get_notified(rule_type, name)
+        for rule in rules:
+            if rule["user"] in notified:
                 # Already notified
                 continue
-        now = datetime.datetime.now()
-        now_ts = datetime.datetime.timestamp(now)
-        user_formatted = "you" if rule["user"] == job["user"] else job["user"]
-        existing_query = {
-            "rule_type": rule["notified_for"],
-            "user": rule["user"],
-            "delivery": rule["delivery"],
-        }
-        existing_message = messages_coll.find_one(existing_query)
-        if existing_message:
-            updated_message = (
-                existing_message["message"].replace(
-                    "*Farm job failing*", "*Farm jobs failing*"
-                )
-                + f"\n`{name}` by {user_formatted}"
-            )
-            messages_coll.update_one(
-                existing_query, {"$set": {"message": updated_message}}
-            )
-        else:
-            messages_coll.insert_one(
-                {
-                    "id": str(uuid4()),
-                    "rule_type": rule["notified_for"],
-                    "asset": name,
-                    "user": rule["user"],
-                    "message": f"*Farm job failing*\n`{name}` by {user_formatted}",
-                    "timestamp": now_ts,
-                    "delivery": rule["delivery"],
-                    "service": "cue",
-                }
-            )
-        renders_failing_coll.update_one(
-            {"name": name}, {"$push": {"users": rule["user"]}}, upsert=True
-        )
+            evaluation.add_notified(rule_type, name, rule["user"])
+            evaluation.notifications.append((rule, job, now))
 
 
-def process_finished(job):
-    name = job["name"]
-    if job["state"] == "0":
-        # Is not finished, remove existing finished locks
-        existing_data = renders_finished_coll.delete_many({"name": name})
-        return
-    if job["state"] != "1":
-        return
-    rules = rules_coll.find({"notified_for": "render_finished"})
-    existing_data = renders_finished_coll.find_one({"name": name})
-    for rule in rules:
-        if not is_rule_relevant(rule, job):
-            continue
-        if existing_data:
-            if rule["user"] in existing_data["users"]:
-                # Already notified
-                continue
-        now = datetime.datetime.now()
-        now_ts = datetime.datetime.timestamp(now)
-        finished_ts = job["stopTime"]
-        secs = abs(now_ts - finished_ts)
-        if secs > 30:
-            # Too old, ignore
-            print(rule["id"], name, f"was submitted {secs} seconds ago, ignoring...")
-            continue
-        user_formatted = "you" if rule["user"] == job["user"] else job["user"]
-        existing_query = {
-            "rule_type": rule["notified_for"],
-            "user": rule["user"],
-            "delivery": rule["delivery"],
-        }
-        existing_message = messages_coll.find_one(existing_query)
-        if existing_message:
-            updated_message = (
-                existing_message["message"].replace(
-                    "*Farm job finished*", "*Farm jobs finished*"
+def get_lock_prefix(service):
+    # Lock names are job names, other sources' jobs mustn't collide with cue's
+    return "" if service == "cue" else f"{service}:"
+
+
+def get_locks(storage, matched, prefix=""):
+    # Only jobs that matched a rule of a type can have a lock for it
+    locks = {}
+    for rule_type in EVENT_TYPES:
+        names = [
+            prefix + job["name"] for job, _, matches in matched if rule_type in matches
+        ]
+        locks[rule_type] = storage.get_locks(rule_type, names) if names else {}
+    return locks
+
+
+def evaluate(matched, evaluation, now=None, prefix=""):
+    now = now or time.time()
+    for job, transitions, matches in matched:
+        evaluate_job(job, transitions, matches, evaluation, now, prefix)
+    return evaluation
+
+
+def get_vri(job):
+    return VRI_RESOLVER.resolve(job)
+
+
+class CueEngine:
+    def __init__(self, storage=None, service="cue"):
+        self.storage = storage or MongoStorage()
+        # The source whose jobs this engine evaluates, see sources
+        self.service = service
+        self.lock_prefix = get_lock_prefix(service)
+        self.rule_index = None
+        self.differ = SnapshotDiffer()
+        self.aggregates = RenderAggregates()
+        self.locks_refreshed = 0
+
+    def get_rule_index(self):
+        rules = [
+            rule for rule in self.storage.get_rules(EVENT_RULE_TYPES)
+            # Rules from before there were other sources are cue's
+            if self.service in rule.get("sources", ["cue"])
+        ]
+        revision = get_rules_revision(rules)
+        if self.rule_index is None or self.rule_index.revision != revision:
+            LOGGER.debug(f"Building rule index from {len(rules)} rules")
+            self.rule_index = RuleIndex(rules, revision)
+            METRICS.inc("rule_index_builds", service=self.service)
+            METRICS.set("rules", len(rules), service=self.service)
+            # Rules changed, re-evaluate every job once against the new rules
+            self.differ.reset()
+        return self.rule_index
+
+    def get_throttle(self):
+        # Read every tick, the other sources spend from the same buckets
+        throttle = Throttle()
+        throttle.load(self.storage.get_throttle_state())
+        return throttle
+
+    def prefetch(self, matched, rule_index):
+        locks = get_locks(self.storage, matched, self.lock_prefix)
+        messages = {}
+        open_after = time.time() + WINDOW_MARGIN
+        rule_types = EVENT_RULE_TYPES + [DIGEST]
+        for message in self.storage.get_pending_messages(rule_types, open_after):
+            messages[get_message_key(message)] = message
+        return TickData(
+            rule_index, locks, messages, self.get_throttle(), self.service
+        )
+
+    def flush(self, tick, batch_size=None):
+        failed = self.storage.write_tick(tick, batch_size)
+        METRICS.inc("messages_created", len(tick.new_messages), service=self.service)
+        METRICS.inc("messages_appended", len(tick.appends), service=self.service)
+        if failed:
+            METRICS.inc("write_failures", failed, service=self.service)
+            LOGGER.error(f"{failed} writes failed while flushing cue tick")
+            # Some writes were lost, look at every job again next tick
+            self.reset()
+        return failed
+
+    def reset(self):
+        self.differ.reset()
+
+    def process(self, jobs):
+        with METRICS.time("cue_stage", stage="rules", service=self.service):
+            rule_index = self.get_rule_index()
+        with METRICS.time("cue_stage", stage="diff", service=self.service):
+            changes = self.differ.diff(jobs)
+        METRICS.set("jobs_tracked", len(self.differ.states), service=self.service)
+        METRICS.inc("jobs_changed", len(changes), service=self.service)
+        self.refresh_locks()
+        if not changes:
+            return None
+        try:
+            with METRICS.time("cue_stage", stage="match", service=self.service):
+                matched = match_changes(changes, rule_index, self.service)
+            with METRICS.time("cue_stage", stage="prefetch", service=self.service):
+                tick = self.prefetch(matched, rule_index)
+            with METRICS.time("cue_stage", stage="evaluate", service=self.service):
+                evaluate(matched, tick.evaluation, prefix=self.lock_prefix)
+            with METRICS.time("cue_stage", stage="coalesce", service=self.service):
+                tick.coalesce()
+            with METRICS.time("cue_stage", stage="flush", service=self.service):
+                self.flush(tick)
+        except Exception:
+            # The differ already moved on, these changes would never come back
+            self.reset()
+            raise
+        return tick
+
+    def refresh_locks(self):
+        # A lock that expired under a job still on the farm would notify
+        # again after the next reset
+        now = time.time()
+        if now - self.locks_refreshed < LOCK_REFRESH_INTERVAL:
+            return
+        with METRICS.time("cue_stage", stage="refresh_locks", service=self.service):
+            try:
+                failed = self.storage.touch_locks(
+                    [self.lock_prefix + name for name in self.differ.states]
                 )
-                + f"\n`{name}` by {user_formatted}"
-            )
-            messages_coll.update_one(
-                existing_query, {"$set": {"message": updated_message}}
-            )
+            except Exception as e:
+                LOGGER.error(f"Couldn't refresh render locks: {e}")
+                return
+        if not failed:
+            self.locks_refreshed = now
+
+    def get_fields(self):
+        # Summary aggregates need the extra fields, but only once someone
+        # has asked for one
+        return AGGREGATE_JOB_FIELDS if self.aggregates.users else EVENT_JOB_FIELDS
+
+    def iter_jobs(self, snapshot):
+        users = self.aggregates.users
+        if not users:
+            return iter_jobs(snapshot, EVENT_JOB_FIELDS)
+        # Only the tracked users' jobs are worth decoding the shots of
+        return iter_jobs(
+            snapshot,
+            EVENT_JOB_FIELDS,
+            AGGREGATE_JOB_FIELDS,
+            lambda job: job.get("user") in users,
+        )
+
+    def observe(self, jobs):
+        self.aggregates.begin_tick()
+        try:
+            tick = self.process(self.aggregates.observe(jobs))
+        except Exception:
+            # Not every job was seen, the aggregates can't be trusted
+            self.aggregates.invalidate()
+            raise
+        self.aggregates.end_tick(self.storage)
+        return tick
+
+    def run(self):
+        fields = self.get_fields()
+        with METRICS.time("cue_tick", service=self.service):
+            with METRICS.time("cue_stage", stage="snapshot", service=self.service):
+                farm_data = self.storage.get_latest_snapshot(fields)
+            if not farm_data:
+                LOGGER.error("No farm data found, aborting...")
+                METRICS.inc("missing_snapshots", service=self.service)
+                return None
+            return self.observe(self.iter_jobs(farm_data))
+
+
+def get_engine():
+    global _ENGINE
+    if _ENGINE is None:
+        if CUE_SHARDS > 1:
+            from .shards import ShardedCueEngine
+            _ENGINE = ShardedCueEngine(shards=CUE_SHARDS)
         else:
-            messages_coll.insert_one(
-                {
-                    "id": str(uuid4()),
-                    "rule_type": rule["notified_for"],
-                    "user": rule["user"],
-                    "message": f"*Farm job finished*\n`{name}` by {user_formatted}.",
-                    "timestamp": now_ts,
-                    "delivery": rule["delivery"],
-                    "service": "cue",
-                }
-            )
-        renders_finished_coll.update_one(
-            {"name": name}, {"$push": {"users": rule["user"]}}, upsert=True
+            _ENGINE = CueEngine()
+    return _ENGINE
+
+
+def get_source():
+    if CUE_SHARDS > 1:
+        from .shards import ShardedCueSource
+        return ShardedCueSource(get_engine())
+    return CueSource(get_engine())
+
+
+def run(storage=None):
+    engine = CueEngine(storage) if storage else get_engine()
+    return engine.run()
+
+
+def parse_time(value, default):
+    # "HH:MM" or an hour of the day, unset values (the old 0) use the default
+    if not value:
+        value = default
+    if isinstance(value, datetime.time):
+        return value
+    if isinstance(value, (int, float)):
+        return datetime.time(int(value) % 24, int(value % 1 * 60))
+    return datetime.datetime.strptime(value, "%H:%M").time()
+
+
+def get_user_times(times):
+    # A notification_times document or a [summary, logoff] pair
+    if isinstance(times, dict):
+        times = times.get("times") or [times.get("summary"), times.get("logoff")]
+    times = list(times or []) + [None, None]
+    return parse_time(times[0], SUMMARY_TIME), parse_time(times[1], LOGOFF_TIME)
+
+
+def get_logoff_ts(rule, now, storage):
+    user = rule["user"]
+    times = rule.get("times")
+    if not times:
+        times = storage.get_notification_times(user)
+    if not times:
+        LOGGER.error(f"No times found for user {user}, aborting...")
+        return None
+    _, logoff_time = get_user_times(times)
+    # The last logoff before now, usually yesterday evening
+    logoff = datetime.datetime.combine(now.date(), logoff_time)
+    if logoff >= now:
+        logoff -= datetime.timedelta(days=1)
+    LOGGER.debug(f"{user} time: {logoff}")
+    return logoff.timestamp()
+
+
+def get_running_renders(since_by_user, storage):
+    running = {user: [] for user in since_by_user}
+    farm_data = storage.get_latest_snapshot(AGGREGATE_JOB_FIELDS)
+    for render in iter_jobs(farm_data, AGGREGATE_JOB_FIELDS):
+        since = since_by_user.get(render["user"])
+        if since is not None and render["startTime"] > since:
+            running[render["user"]].append(render)
+    return running
+
+
+def send_summary(summary, send=None):
+    user = summary["user"]
+    if not summary["running_count"] and not summary["finished_count"]:
+        since_date = datetime.datetime.fromtimestamp(summary["since"])
+        LOGGER.warning(f"User {user} had no renders since {since_date}, skipping...")
+        return False
+    blocks = get_summary_blocks(summary)
+    send = send or slack.send_message
+    resp = send(service="cue", text="Your Farm Summary", blocks=blocks, user=user)
+    if not resp.ok:
+        # 429 and 5xx were retried already, anything else is a rejection
+        raise slack.SlackError(
+            f"Slack answered {resp.status_code} for {user}'s summary: {resp.text}"
         )
+    return True
 
 
-def get_vri(job):
-    for layer in job.get("layers", []):
-        paths = layer.get("outputPaths", [])
-        for path in paths:
-            if not path or not path.startswith("/jobs"):
-                return ""
-            path = Path(path)
-            asset_dir = path.parent
-            vri_path = asset_dir / ".vri"
-            vri = ""
-            if vri_path.is_file():
-                return vri_path.read_text()
-    return ""
-
-
-def run():
-    farm_data = farm_coll.find_one(sort=[("_id", -1)])
-    if not farm_data:
-        LOGGER.error("No farm data found, aborting...")
-        return
-    for job in farm_data["data"]["jobs"]:
-        process_submitted(job)
-        process_failing(job)
-        process_finished(job)
-
-
-def run_summary():
-    # rules = rules_coll.find({"notified_for": "farm_summary"})
-    "theom, georgeg, alexga, yousef, tri"
-    rules = [{
-        "notified_for": "farm_summary",
-        "user": "dorianne",
-        "times": [0, 0]
-    }]
+def get_summaries(since_by_user, storage, aggregates=None):
+    # {user: summary}, read from the aggregates where the cue tick kept them
+    # current, everyone else is built from storage in one go
+    summaries = {}
+    if aggregates is not None:
+        for user, since in since_by_user.items():
+            summary = aggregates.get_summary(user, since)
+            if summary is not None:
+                summaries[user] = summary
+        METRICS.inc("summary_aggregate_hits", len(summaries))
+    missing = {
+        user: since for user, since in since_by_user.items() if user not in summaries
+    }
+    if missing:
+        METRICS.inc("summary_aggregate_misses", len(missing))
+        summaries.update(build_summaries(missing, storage, aggregates))
+    with METRICS.time("summary_stage", stage="details"):
+        add_render_details(summaries.values(), storage)
+    return summaries
+
+
+def build_summaries(since_by_user, storage, aggregates=None):
+    summaries = {}
+    with METRICS.time("summary_stage", stage="finished"):
+        finished_by_user = storage.get_renders_since(since_by_user, RECORD_FIELDS)
+    with METRICS.time("summary_stage", stage="running"):
+        running_by_user = get_running_renders(since_by_user, storage)
+    for user, since in since_by_user.items():
+        finished = finished_by_user.get(user, [])
+        running = running_by_user.get(user, [])
+        if aggregates is not None:
+            # Seeded once, the tick keeps it up to date from here on
+            summaries[user] = aggregates.seed(user, since, finished, running)
+            continue
+        aggregate = UserAggregate(user, since)
+        aggregate.seed(finished, running)
+        summaries[user] = aggregate.get_summary()
+    return summaries
+
+
+def add_render_details(summaries, storage):
+    # Summaries only keep scalars, the layers are read for the few renders
+    # each one lists
+    summaries = list(summaries)
+    running = [render["name"] for s in summaries for render in s["running"]]
+    finished = [render["name"] for s in summaries for render in s["finished"]]
+    jobs = {}
+    if running:
+        for job in storage.get_snapshot_jobs(running, SUMMARY_JOB_FIELDS):
+            jobs[job["name"]] = job
+    renders = {}
+    if finished:
+        for render in storage.get_renders(finished, RENDER_FIELDS):
+            renders[render["name"]] = render
+    for summary in summaries:
+        # One that left the farm in between is listed without its layers
+        summary["running"] = [
+            jobs.get(render["name"], render) for render in summary["running"]
+        ]
+        summary["finished"] = [
+            renders.get(render["name"], render) for render in summary["finished"]
+        ]
+
+
+def run_summary(storage=None, rules=None, send=None, aggregates=None):
+    # Returns {user: sent or not}, None for the users that failed
+    if storage is None:
+        storage = get_engine().storage
+        aggregates = aggregates or get_engine().aggregates
+    if rules is None:
+        rules = storage.get_rules(["farm_summary"])
     now = datetime.datetime.now()
-    yesterday_date = now - datetime.timedelta(days=3)
+    since_by_user = {}
     for rule in rules:
-        user = rule["user"]
-        times = rule.get("times")
-        if not times:
-            times = notification_times_coll.find_one({"user": user})
-        if not times:
-            LOGGER.error(f"No times found for user {user}, aborting...")
-            continue
-        specific_time = datetime.datetime.strptime("21:00", "%H:%M").time()
-        yesterday_specific_time = datetime.datetime.combine(yesterday_date, specific_time)
-        logoff_ts = yesterday_specific_time.timestamp()
-        print(user, "time:", yesterday_specific_time)
-        finished_renders = list(renders_coll.find({"user": user, "startTime": {"$gt": logoff_ts}}))
-        farm_data = farm_coll.find_one(sort=[("_id", -1)])
-        if not farm_data:
-            farm_data = []
-        running_renders = [render for render in farm_data["data"]["jobs"] if render["user"] == user and render["startTime"] > logoff_ts]
-        if not running_renders and not finished_renders:
-            LOGGER.warning(f"User {user} had no renders since {yesterday_specific_time}, skipping...")
-            continue
-        shows = {}
-        if running_renders and finished_renders:
-            for state, renders in [["running", running_renders], ["finished", finished_renders]]:
-                for render in renders:
-                    if not render.get("show") or not render.get("shot"):
-                        continue
-                    if render["shot"].startswith("none_"):
-                        continue
-                    if not shows.get(render["show"]):
-                        shows[render["show"]] = {"finished": [], "running": []}
-                    if render["shot"] in shows[render["show"]]["running"]:
-                        continue
-                    if render["shot"] in shows[render["show"]][state]:
-                        continue
-                    shows[render["show"]][state].append(render["shot"])
-        blocks = get_summary_blocks(finished_renders, running_renders, shows)
-        slack.send_message(
-            service="cue", text="Your Farm Summary", blocks=blocks, user="george"
-        )
+        logoff_ts = get_logoff_ts(rule, now, storage)
+        if logoff_ts is not None:
+            since_by_user[rule["user"]] = logoff_ts
+    summaries = get_summaries(since_by_user, storage, aggregates)
+    results = {user: None for user in since_by_user}
+    # The per user summaries are rendered and sent in parallel
+    with ThreadPoolExecutor(SUMMARY_WORKERS, thread_name_prefix="summary") as pool:
+        futures = {
+            pool.submit(send_summary, summary, send): user
+            for user, summary in summaries.items()
+        }
+        for future, user in futures.items():
+            try:
+                results[user] = future.result()
+                if results[user]:
+                    METRICS.inc("summaries_sent")
+            except Exception as e:
+                METRICS.inc("summary_failures")
+                LOGGER.error(f"Failed to send summary to {user}: {e}")
+    return results
 
 
 def get_running_time(job):
@@ -300,182 +586,105 @@ def format_time(sec):
 
 
 def get_shots_text(shots, show=None):
-    text = f"\n`{show}` shot" if show else "Shot"
     finished = shots.get("finished")
     running = shots.get("running")
-    finished_amount = len(finished)
-    running_amount = len(running)
     if finished and running:
-        if finished_amount > 1:
-            text += "s "
-            text += ", ".join([f"`{shot}`" for shot in finished[:-1]]) + f" and `{finished[-1]}`"
-            text += " are done while "
+        parts = [f"\n`{show}` shot" if show else "Shot"]
+        if len(finished) > 1:
+            parts.append(f"s {join_shots(finished)} are done while ")
         else:
-            text += f" `{finished[0]}` is done while "
-        if running_amount > 1:
-            text += ", ".join([f"`{shot}`" for shot in running[:-1]]) + f" and `{running[-1]}` are still running."
+            parts.append(f" `{finished[0]}` is done while ")
+        if len(running) > 1:
+            parts.append(f"{join_shots(running)} are still running.")
         else:
-            text += f"`{running[0]}` is still running."
-    elif finished:
+            parts.append(f"`{running[0]}` is still running.")
+        return "".join(parts)
+    if finished:
         if not show:
             return "All shots are done."
-        if finished_amount > 1:
-            text += "shots "
-        text += "are all done."
-    elif running:
+        if len(finished) > 1:
+            return f"\n`{show}` shots are all done."
+        return f"\n`{show}` shot is done."
+    if running:
         if not show:
             return "All shots are still running."
-        if running_amount > 1:
-            text += "shots "
-        text += "are all still running."
-    print(text)
-    return text
+        if len(running) > 1:
+            return f"\n`{show}` shots are all still running."
+        return f"\n`{show}` shot is still running."
+    return f"\n`{show}` shot" if show else "Shot"
 
 
-def get_render_cores(job):
-    cores = 0
-    for layer in job.get("layers", []):
-        cores += layer.get("currentCores", 0)
-    return cores
+def join_shots(shots):
+    return join_words([f"`{shot}`" for shot in shots], SUMMARY_MAX_SHOTS)
 
 
 def get_render_progress(job):
-    layers = job.get("layers", [])
+    layers = job.get("layers")
+    if not layers:
+        return 0
     total_percent = sum(layer.get("percentCompleted", 100) for layer in layers)
     return round(total_percent / len(layers))
 
 
-def get_summary_blocks(finished, running, shows):
-    running_amount = len(running)
-    finished_amount = len(finished)
+def get_summary_blocks(summary):
+    finished = summary["finished"]
+    running = summary["running"]
+    shows = summary["shows"]
+    running_amount = summary["running_count"]
+    finished_amount = summary["finished_count"]
     renders_amount = running_amount + finished_amount
+    if renders_amount == 0:
+        return [section(NO_RENDERS_TEXT)]
     finished_text = "all" if finished_amount == renders_amount else f"{finished_amount}"
     renders_text = "render" if renders_amount == 1 else "renders"
-    shows_amount = len(shows)
-    shows_text = ""
-    if shows_amount == 1:
-        show = list(shows.keys())[0]
-        shows_text = " " + get_shots_text(shows[show])
-    elif shows_amount > 1:
-        shows_text = " " + "\n".join([get_shots_text(shots, show) for show, shots in shows.items()])
-    if renders_amount == 0:
-        return [{
-        "type": "section",
-        "text": {
-            "type": "mrkdwn",
-            "text": ":sunny: Morning! You had no renders on the farm last night.",
-        }
-    }]
-    else:
-        intro_text = f"You had {renders_amount} {renders_text} on the farm, {finished_text} of which are finished.{shows_text}"
-    finished_pattern = ">_{name}_\n>`{vri}`\n>Start-to-finish: {render_time}\n\n"
-    running_pattern = ">`{name}`\n>Progress: {progress}%\n>Current power: {cores_text}\n\n"
-    finished_text = ""
-    running_text = ""
-    for render in finished[:10]:
-        finished_text += finished_pattern.format(
+    intro_text = INTRO_TEXT.render(
+        renders=renders_amount, renders_text=renders_text, finished=finished_text
+    )
+    if len(shows) == 1:
+        shots = next(iter(shows.values()))
+        intro_text += " " + get_shots_text(shots)
+    elif shows:
+        show_lines = [get_shots_text(shots, show) for show, shots in shows.items()]
+        limit = SECTION_TEXT_LIMIT - len(intro_text) - 1
+        intro_text += " " + join_limited(show_lines, limit=limit)
+    vris = VRI_RESOLVER.resolve_many(finished)
+    finished_lines = [
+        FINISHED_LINE.render(
             name=render["name"],
-            vri=get_vri(render) or "Couldn't get VRI",
+            vri=vri or "Couldn't get VRI",
             render_time=format_time(get_running_time(render)),
         )
-    if finished_amount > 10:
-        finished_text += f"and {finished_amount - 10} more..."
-    for render in running[:10]:
-        cores_text = f"{get_render_cores(render)} cores"
-        running_text += running_pattern.format(
+        for render, vri in zip(finished, vris)
+    ]
+    running_lines = [
+        RUNNING_LINE.render(
             name=render["name"],
             progress=get_render_progress(render),
-            cores_text=cores_text,
+            cores=get_render_cores(render),
         )
-    if running_amount > 10:
-        running_text += f"and {running_amount - 10} more..."
-    # spacer_block = {
-    #     "type": "section",
-    #     "text": {
-    #         "type": "plain_text",
-    #         "text": " ",
-    #     }
-    # }
-    spacer_block = {
-        "type": "divider"
-    }
-    # morning_block = {
-    #     "type": "section",
-    #     "text": {
-    #         "type": "mrkdwn",
-    #         "text": ":sunny: Morning! Here's your farm summary since yesterday",
-    #     },
-    #     "accessory": {
-    #         "type": "timepicker",
-    #         "initial_time": "21:00",
-    #         "placeholder": {
-    #             "type": "plain_text",
-    #             "text": "Select time",
-    #             "emoji": True
-    #         },
-    #         "action_id": "timepicker-action",
-    #     }
-    # }
-    morning_block = {
-        "type": "section",
-        "text": {
-            "type": "mrkdwn",
-            "text": ":sunny: Morning! Here's your farm summary since yesterday 21:00.",
-        }
-    }
-    intro_block = {
-        "type": "section",
-        "text": {
-            "type": "mrkdwn",
-            "text": intro_text,
-        }
-    }
-    finished_header_text = ":white_check_mark: Here's what's finished:"
-    if running_amount:
-        if finished_amount == 1:
-            finished_header_text = ":white_check_mark: Here it is:"
-        else:
-            finished_header_text = ":white_check_mark: Here they are:"
-    finished_header_block = {
-			"type": "section",
-			"text": {
-				"type": "mrkdwn",
-				"text": finished_header_text,
-			}
-		}
-    finished_block = {
-        "type": "section",
-        "text": {
-            "type": "mrkdwn",
-            "text": finished_text,
-        }
-    }
-    running_header_text = ":woman_in_lotus_position: Here's what you're waiting for:"
-    if finished_amount:
-        if running_amount == 1:
-            running_header_text = ":woman_in_lotus_position: The remaining one is:"
-        else:
-            running_header_text = ":woman_in_lotus_position: The remaining ones are:"
-    running_header_block = {
-        "type": "section",
-        "text": {
-            "type": "mrkdwn",
-            "text": running_header_text,
-        }
-    }
-    running_block = {
-        "type": "section",
-        "text": {
-            "type": "mrkdwn",
-            "text": running_text,
-        }
-    }
-    final = [
-        morning_block,
-        intro_block,
+        for render in running
+    ]
+    finished_text = join_limited(finished_lines, finished_amount, sep="")
+    running_text = join_limited(running_lines, running_amount, sep="")
+    since = datetime.datetime.fromtimestamp(summary["since"])
+    blocks = [
+        section(MORNING_TEXT.render(since=since.strftime("%H:%M"))),
+        section(intro_text),
     ]
     if finished_text:
-        final += [spacer_block, finished_header_block, finished_block]
+        finished_header_text = ":white_check_mark: Here's what's finished:"
+        if running_amount:
+            if finished_amount == 1:
+                finished_header_text = ":white_check_mark: Here it is:"
+            else:
+                finished_header_text = ":white_check_mark: Here they are:"
+        blocks += [divider(), section(finished_header_text), section(finished_text)]
     if running_text:
-        final += [spacer_block, running_header_block, running_block]
-    return final
+        running_header_text = ":woman_in_lotus_position: Here's what you're waiting for:"
+        if finished_amount:
+            if running_amount == 1:
+                running_header_text = ":woman_in_lotus_position: The remaining one is:"
+            else:
+                running_header_text = ":woman_in_lotus_position: The remaining ones are:"
+        blocks += [divider(), section(running_header_text), section(running_text)]
+    return limit_blocks(blocks)
@@ -0,0 +1,290 @@
+import sys
+import json
+import asyncio
+import smtplib
+import threading
+from email.message import EmailMessage
+
+import aiohttp
+
+from . import slack
+from .messages import render_text, render_blocks
+from .tools import ENV, get_logger
+
+
+LOGGER = get_logger(__name__)
+
+SMTP_HOST = ENV.get("SMTP_HOST")
+SMTP_PORT = int(ENV.get("SMTP_PORT", 25))
+SMTP_USER = ENV.get("SMTP_USER")
+SMTP_PASSWORD = ENV.get("SMTP_PASSWORD")
+SMTP_STARTTLS = ENV.get("SMTP_STARTTLS", "0") == "1"
+SMTP_TIMEOUT = float(ENV.get("SMTP_TIMEOUT", 10))
+EMAIL_FROM = ENV.get("EMAIL_FROM", "notifications@localhost")
+# Users are mailed at user@EMAIL_DOMAIN
+EMAIL_DOMAIN = ENV.get("EMAIL_DOMAIN", "localhost")
+EMAIL_BATCH_SIZE = int(ENV.get("EMAIL_BATCH_SIZE", 20))
+EMAIL_CONCURRENCY = int(ENV.get("EMAIL_CONCURRENCY", 2))
+WEBHOOK_URL = ENV.get("WEBHOOK_URL")
+WEBHOOK_TIMEOUT = float(ENV.get("WEBHOOK_TIMEOUT", 10))
+WEBHOOK_CONCURRENCY = int(ENV.get("WEBHOOK_CONCURRENCY", 8))
+# "-" writes to stdout
+FILE_SINK_PATH = ENV.get("FILE_SINK_PATH", "-")
+
+
+def get_deliveries(message):
+    # A delivery like "slack,email" fans the message out to both
+    return [name.strip() for name in message.get("delivery", "slack").split(",")]
+
+
+class Backend:
+    """Somewhere a coalesced message can be delivered to.
+
+    The outbox hands a backend at most batch_size messages at a time and
+    has at most concurrency batches in flight with it, across every
+    dispatcher. send_batch answers with one ok per message.
+    """
+
+    name = None
+    batch_size = 1
+    concurrency = 8
+    _semaphore = None
+
+    def get_semaphore(self):
+        # Created lazily so it belongs to the loop the dispatchers run on
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._semaphore
+
+    async def send(self, message):
+        raise NotImplementedError
+
+    async def send_batch(self, messages):
+        results = await asyncio.gather(
+            *[self.send(message) for message in messages], return_exceptions=True
+        )
+        for message, result in zip(messages, results):
+            if isinstance(result, Exception):
+                LOGGER.error(f"{self.name} failed to send {message['id']}: {result}")
+        return [result is True for result in results]
+
+    async def close(self):
+        pass
+
+
+class FunctionBackend(Backend):
+    # Wraps a plain async send function, the registry's original shape
+    def __init__(self, name, function, concurrency=Backend.concurrency):
+        self.name = name
+        self.function = function
+        self.concurrency = concurrency
+
+    async def send(self, message):
+        return await self.function(message)
+
+
+class SlackBackend(Backend):
+    name = "slack"
+    concurrency = slack.SLACK_CONCURRENCY
+
+    async def send(self, message):
+        resp = await slack.send_message_async(
+            service=message.get("service", "hub"),
+            text=render_text(message),
+            user=message["user"],
+        )
+        if not resp.ok:
+            # 429 and 5xx were retried already, anything else is a rejection
+            LOGGER.error(
+                f"Slack answered {resp.status_code} for {message['id']}: {resp.text}"
+            )
+            return False
+        return True
+
+
+def get_subject(text):
+    return text.split("\n", 1)[0].strip("*_ ")
+
+
+# The server turned one mail down, the session is still good
+SMTP_REJECTIONS = (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused)
+
+
+def close_smtp(smtp):
+    if smtp is not None:
+        try:
+            smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            smtp.close()
+    return None
+
+
+class EmailBackend(Backend):
+    """Sends a batch of messages over one SMTP session."""
+
+    name = "email"
+
+    def __init__(
+        self,
+        host=SMTP_HOST,
+        port=SMTP_PORT,
+        sender=EMAIL_FROM,
+        domain=EMAIL_DOMAIN,
+        user=SMTP_USER,
+        password=SMTP_PASSWORD,
+        starttls=SMTP_STARTTLS,
+        timeout=SMTP_TIMEOUT,
+        batch_size=EMAIL_BATCH_SIZE,
+        concurrency=EMAIL_CONCURRENCY,
+    ):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.domain = domain
+        self.user = user
+        self.password = password
+        self.starttls = starttls
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+
+    def get_email(self, message):
+        text = render_text(message)
+        email = EmailMessage()
+        email["From"] = self.sender
+        email["To"] = f"{message['user']}@{self.domain}"
+        email["Subject"] = get_subject(text)
+        email.set_content(text)
+        return email
+
+    def connect(self):
+        smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.starttls:
+            smtp.starttls()
+        if self.user:
+            smtp.login(self.user, self.password)
+        return smtp
+
+    def send_all(self, messages):
+        # One ok per message, so mails sent before an error aren't resent
+        results = []
+        smtp = None
+        try:
+            for message in messages:
+                if smtp is None:
+                    try:
+                        smtp = self.connect()
+                    except (smtplib.SMTPException, OSError) as e:
+                        LOGGER.error(f"Couldn't connect to {self.host}: {e}")
+                        break
+                try:
+                    smtp.send_message(self.get_email(message))
+                    results.append(True)
+                except (smtplib.SMTPException, OSError) as e:
+                    LOGGER.error(f"Couldn't email {message['id']}: {e}")
+                    results.append(False)
+                    if not isinstance(e, SMTP_REJECTIONS):
+                        # The session is gone, the next message reconnects
+                        smtp = close_smtp(smtp)
+        finally:
+            close_smtp(smtp)
+        return results + [False] * (len(messages) - len(results))
+
+    async def send(self, message):
+        return (await self.send_batch([message]))[0]
+
+    async def send_batch(self, messages):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.send_all, messages)
+
+
+class WebhookBackend(Backend):
+    """Posts each message as JSON, reusing one pooled session."""
+
+    name = "webhook"
+
+    def __init__(
+        self, url=WEBHOOK_URL, timeout=WEBHOOK_TIMEOUT, concurrency=WEBHOOK_CONCURRENCY
+    ):
+        self.url = url
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self._session = None
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                connector=aiohttp.TCPConnector(limit=self.concurrency),
+            )
+        return self._session
+
+    def get_payload(self, message):
+        return {
+            "id": message["id"],
+            "user": message["user"],
+            "rule_type": message.get("rule_type"),
+            "total": message.get("total"),
+            "text": render_text(message),
+            "blocks": render_blocks(message),
+        }
+
+    async def send(self, message):
+        session = self._get_session()
+        async with session.post(self.url, json=self.get_payload(message)) as resp:
+            if resp.status >= 400:
+                text = await resp.text()
+                LOGGER.error(f"Webhook answered {resp.status} for {message['id']}: {text}")
+                return False
+        return True
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+
+class FileBackend(Backend):
+    """Appends every message as a JSON line, for trying rules out locally."""
+
+    name = "file"
+    batch_size = 100
+
+    def __init__(self, path=FILE_SINK_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def write(self, lines):
+        with self.lock:
+            if self.path == "-":
+                sys.stdout.write(lines)
+                sys.stdout.flush()
+                return
+            with open(self.path, "a") as f:
+                f.write(lines)
+
+    async def send(self, message):
+        return (await self.send_batch([message]))[0]
+
+    async def send_batch(self, messages):
+        lines = "".join(
+            json.dumps({
+                "id": message["id"],
+                "user": message["user"],
+                "delivery": message.get("delivery"),
+                "text": render_text(message),
+            }) + "\n"
+            for message in messages
+        )
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.write, lines)
+        return [True] * len(messages)
+
+
+def get_backends():
+    # Backends needing a server are only there once it is configured
+    backends = [SlackBackend(), FileBackend()]
+    if SMTP_HOST:
+        backends.append(EmailBackend())
+    if WEBHOOK_URL:
+        backends.append(WebhookBackend())
+    return {backend.name: backend for backend in backends}
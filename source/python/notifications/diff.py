@@ -0,0 +1,61 @@
+NEW = "new"
+FAILING = "failing"
+RECOVERED = "recovered"
+FINISHED = "finished"
+UNFINISHED = "unfinished"
+
+
+def get_job_state(job):
+    return (job["state"], job["deadFrames"], job["startTime"], job["stopTime"])
+
+
+def get_transitions(previous, current):
+    state, dead_frames = current[0], current[1]
+    transitions = set()
+    if previous is None:
+        # First time we see the job, emit everything that applies to it so
+        # stale locks get cleared and fresh events still get notified
+        transitions.add(NEW)
+        transitions.add(FAILING if dead_frames else RECOVERED)
+        if state == "1":
+            transitions.add(FINISHED)
+        elif state == "0":
+            transitions.add(UNFINISHED)
+        return transitions
+    if previous == current:
+        return transitions
+    previous_state, previous_dead_frames = previous[0], previous[1]
+    if dead_frames and not previous_dead_frames:
+        transitions.add(FAILING)
+    elif not dead_frames and previous_dead_frames:
+        transitions.add(RECOVERED)
+    if state != previous_state:
+        if state == "1":
+            transitions.add(FINISHED)
+        elif state == "0":
+            transitions.add(UNFINISHED)
+    return transitions
+
+
+class SnapshotDiffer:
+    def __init__(self):
+        # {job name: (state, deadFrames, startTime, stopTime)}
+        self.states = {}
+
+    def reset(self):
+        self.states = {}
+
+    def diff(self, jobs):
+        previous_states = self.states
+        states = {}
+        changes = []
+        for job in jobs:
+            name = job["name"]
+            current = get_job_state(job)
+            states[name] = current
+            transitions = get_transitions(previous_states.get(name), current)
+            if transitions:
+                changes.append((job, transitions))
+        # Jobs that dropped off the farm are simply forgotten
+        self.states = states
+        return changes
@@ -0,0 +1,77 @@
+from .diff import NEW, FAILING, RECOVERED, FINISHED, UNFINISHED
+
+
+class EventType:
+    """Declares when a job notifies the rules of one notified_for type.
+
+    A job triggers the event on any of the trigger transitions (see diff)
+    if the predicate holds and it isn't older than max_age seconds, going by
+    its age_field. A clear transition forgets who was notified so the event
+    can trigger again later.
+    """
+
+    def __init__(
+        self,
+        name,
+        lock_collection,
+        triggers,
+        clears=(),
+        predicate=None,
+        max_age=None,
+        age_field=None,
+        header=None,
+    ):
+        self.name = name
+        self.lock_collection = lock_collection
+        self.triggers = frozenset(triggers)
+        self.clears = frozenset(clears)
+        self.predicate = predicate
+        self.max_age = max_age
+        self.age_field = age_field
+        # (single, plural) message header
+        self.header = header or (name, name)
+
+    def applies(self, job, now):
+        if self.max_age is not None and abs(now - job[self.age_field]) > self.max_age:
+            return False
+        if self.predicate is not None and not self.predicate(job):
+            return False
+        return True
+
+    def __repr__(self):
+        return f"EventType({self.name!r})"
+
+
+# {notified_for: event type}, evaluated in this order
+EVENT_TYPES = {}
+
+
+def register_event_type(event_type):
+    EVENT_TYPES[event_type.name] = event_type
+    return event_type
+
+
+register_event_type(EventType(
+    "render_submitted",
+    "renders_submitted",
+    triggers=[NEW],
+    max_age=10 * 60,
+    age_field="startTime",
+    header=("*Farm job submitted*", "*Farm jobs submitted*"),
+))
+register_event_type(EventType(
+    "render_failing",
+    "renders_failing",
+    triggers=[FAILING],
+    clears=[RECOVERED],
+    header=("*Farm job failing*", "*Farm jobs failing*"),
+))
+register_event_type(EventType(
+    "render_finished",
+    "renders_finished",
+    triggers=[FINISHED],
+    clears=[UNFINISHED],
+    max_age=30,
+    age_field="stopTime",
+    header=("*Farm job finished*", "*Farm jobs finished*"),
+))
@@ -0,0 +1,186 @@
+import sys
+import time
+import argparse
+
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+
+from .locks import LOCK_COLLECTIONS, LOCK_TTL
+from .outbox import get_available_query
+from .tools import ENV, get_logger, get_collection, get_slackbot_collection
+
+
+LOGGER = get_logger(__name__)
+
+# Summary delivery keys only need to outlive the catch-up window
+SUMMARY_DELIVERY_TTL = int(ENV.get("SUMMARY_DELIVERY_TTL", 30 * 24 * 60 * 60))
+# Messages that ran out of attempts stay this long for a look
+OUTBOX_FAILED_TTL = int(ENV.get("OUTBOX_FAILED_TTL", 7 * 24 * 60 * 60))
+
+# (collection getter, collection name, keys, options)
+INDEXES = [
+    (get_collection, "notification_rules", [("notified_for", ASCENDING)], {}),
+    (
+        get_collection,
+        "notification_messages",
+        [("id", ASCENDING)],
+        {"unique": True},
+    ),
+    (
+        get_collection,
+        "notification_messages",
+        [("rule_type", ASCENDING), ("user", ASCENDING), ("delivery", ASCENDING)],
+        {},
+    ),
+    (
+        get_collection,
+        "notification_messages",
+        [
+            ("rule_type", ASCENDING),
+            ("claimed_by", ASCENDING),
+            ("window_close", ASCENDING),
+        ],
+        {},
+    ),
+    (
+        get_collection,
+        "notification_messages",
+        [("claimed_by", ASCENDING), ("lease_expires", ASCENDING)],
+        {},
+    ),
+    # The expired lease half of the outbox claim's $or, see
+    # outbox.get_available_query
+    (
+        get_collection,
+        "notification_messages",
+        [("lease_expires", ASCENDING)],
+        {"sparse": True},
+    ),
+    (get_collection, "notification_messages", [("claim", ASCENDING)], {"sparse": True}),
+    (
+        get_collection,
+        "notification_messages",
+        [("failed_at", ASCENDING)],
+        {"expireAfterSeconds": OUTBOX_FAILED_TTL},
+    ),
+    (get_collection, "notification_times", [("user", ASCENDING)], {}),
+    (
+        get_collection,
+        "summary_deliveries",
+        [("created", ASCENDING)],
+        {"expireAfterSeconds": SUMMARY_DELIVERY_TTL},
+    ),
+    # Throttle buckets are dropped once they'd have refilled anyway
+    (
+        get_collection,
+        "notification_throttle",
+        [("expires", ASCENDING)],
+        {"expireAfterSeconds": 0},
+    ),
+    (
+        get_slackbot_collection,
+        "store_renders",
+        [("user", ASCENDING), ("startTime", ASCENDING)],
+        {},
+    ),
+    # Renders that left the farm are looked up by name, see aggregates.py
+    (get_slackbot_collection, "store_renders", [("name", ASCENDING)], {}),
+]
+# The unique name index is what stops concurrent upserts creating duplicates
+INDEXES += [
+    (get_collection, name, [("name", ASCENDING)], {"unique": True})
+    for name in LOCK_COLLECTIONS
+]
+INDEXES += [
+    (get_collection, name, [("updated", ASCENDING)], {"expireAfterSeconds": LOCK_TTL})
+    for name in LOCK_COLLECTIONS
+]
+
+
+def ensure_indexes():
+    failed = []
+    for get_coll, name, keys, options in INDEXES:
+        try:
+            get_coll(name).create_index(keys, background=True, **options)
+        except OperationFailure as e:
+            LOGGER.error(f"Couldn't create index {keys} on {name}: {e}")
+            failed.append((name, keys))
+    return failed
+
+
+def get_hot_queries():
+    now = time.time()
+    queries = [
+        (
+            get_collection("notification_rules"),
+            {"notified_for": {"$in": ["render_submitted"]}},
+            None,
+        ),
+        (
+            get_collection("notification_messages"),
+            {"rule_type": {"$in": ["render_submitted"]}, "claimed_by": None,
+             "window_close": {"$gt": now}},
+            None,
+        ),
+        (
+            get_collection("notification_messages"),
+            {"rule_type": "render_submitted", "user": "", "delivery": "slack"},
+            None,
+        ),
+        (
+            get_collection("notification_messages"),
+            {"claimed_by": {"$ne": None}, "lease_expires": {"$lt": now}},
+            None,
+        ),
+        (get_collection("notification_messages"), get_available_query(now), None),
+        (
+            get_slackbot_collection("store_renders"),
+            {"user": "", "startTime": {"$gt": now}},
+            None,
+        ),
+        (get_slackbot_collection("store_farm"), {}, [("_id", DESCENDING)]),
+    ]
+    queries += [
+        (get_collection(name), {"name": {"$in": [""]}}, None)
+        for name in LOCK_COLLECTIONS
+    ]
+    return queries
+
+
+def get_stages(plan):
+    stages = [plan.get("stage")]
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            stages += get_stages(plan[key])
+    for child in plan.get("inputStages", []):
+        stages += get_stages(child)
+    return stages
+
+
+def check_query_plans():
+    collscans = []
+    for coll, query, sort in get_hot_queries():
+        cursor = coll.find(query).limit(1)
+        if sort:
+            cursor = cursor.sort(sort)
+        plan = cursor.explain()["queryPlanner"]["winningPlan"]
+        stages = get_stages(plan)
+        if "COLLSCAN" in stages:
+            LOGGER.error(f"COLLSCAN on {coll.full_name} for {query}")
+            collscans.append((coll.full_name, query))
+        else:
+            LOGGER.info(f"{coll.full_name} {query}: {' <- '.join(filter(None, stages))}")
+    return collscans
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Manage notification indexes")
+    parser.add_argument("command", choices=["ensure", "explain"])
+    args = parser.parse_args(args)
+    if args.command == "ensure":
+        return 1 if ensure_indexes() else 0
+    return 1 if check_query_plans() else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,138 @@
+import os
+import sys
+import time
+import socket
+import argparse
+import threading
+from uuid import uuid4
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+from .metrics import METRICS
+from .tools import ENV, get_logger, get_collection
+
+
+LOGGER = get_logger(__name__)
+
+LEADER_TTL = float(ENV.get("LEADER_TTL", 15))
+LEADER_HEARTBEAT = float(ENV.get("LEADER_HEARTBEAT", 3))
+
+
+class LeaderLease:
+    """Lease on a named role, held by at most one instance at a time.
+
+    The lease document is renewed every heartbeat and anyone may take it
+    over once it has gone ttl seconds without one. The heartbeat runs in a
+    thread so a long tick on the event loop can't starve it.
+    """
+
+    def __init__(
+        self, coll, name, holder=None, ttl=LEADER_TTL, heartbeat=LEADER_HEARTBEAT
+    ):
+        self.coll = coll
+        self.name = name
+        self.holder = holder or (
+            f"{socket.gethostname()}-{os.getpid()}-{uuid4().hex[:6]}"
+        )
+        self.ttl = ttl
+        self.heartbeat = heartbeat
+        # Counts acquisitions, state built under an older term is stale
+        self.term = 0
+        self._deadline = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def is_leader(self):
+        # Give up a heartbeat early so two holders never overlap
+        return time.monotonic() < self._deadline - self.heartbeat
+
+    def try_acquire(self):
+        was_leader = self.is_leader
+        start_time = time.monotonic()
+        now = time.time()
+        try:
+            lease = self.coll.find_one_and_update(
+                {
+                    "_id": self.name,
+                    "$or": [{"holder": self.holder}, {"expires": {"$lt": now}}],
+                },
+                {"$set": {"holder": self.holder, "expires": now + self.ttl}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            # Someone else holds a live lease, the upsert collided with it
+            lease = None
+        except PyMongoError as e:
+            # Keep what we have, the deadline runs out on its own
+            LOGGER.error(f"Couldn't renew {self.name} lease: {e}")
+            return self.is_leader
+        if not lease or lease.get("holder") != self.holder:
+            self._deadline = 0
+            if was_leader:
+                METRICS.inc("leader_lost", role=self.name)
+                LOGGER.warning(f"{self.holder} lost the {self.name} lease")
+            METRICS.set("leader", 0, role=self.name)
+            return False
+        self._deadline = start_time + self.ttl
+        if not was_leader:
+            self.term += 1
+            METRICS.inc("leader_acquired", role=self.name)
+            LOGGER.info(f"{self.holder} is now the {self.name} leader")
+        METRICS.set("leader", 1, role=self.name)
+        return True
+
+    def release(self):
+        self._deadline = 0
+        try:
+            self.coll.delete_one({"_id": self.name, "holder": self.holder})
+        except PyMongoError as e:
+            LOGGER.error(f"Couldn't release {self.name} lease: {e}")
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.try_acquire()
+            self._stop.wait(self.heartbeat)
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, name=f"lease-{self.name}", daemon=True
+            )
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.release()
+
+
+def get_lease(name):
+    return LeaderLease(get_collection("notification_leases"), name)
+
+
+def main(args=None):
+    # Contend for a lease and report changes, run two of these to try failover
+    parser = argparse.ArgumentParser(description="Hold a notification leader lease")
+    parser.add_argument("name", nargs="?", default="cue")
+    args = parser.parse_args(args)
+    lease = get_lease(args.name).start()
+    leader = None
+    try:
+        while True:
+            if lease.is_leader != leader:
+                leader = lease.is_leader
+                print(f"{lease.holder}: {'leader' if leader else 'standby'}")
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        lease.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
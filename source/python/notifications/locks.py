@@ -0,0 +1,119 @@
+import sys
+import datetime
+import argparse
+
+from pymongo import UpdateOne, UpdateMany, DeleteMany
+
+from .bulk import BulkWriter
+from .events import EVENT_TYPES
+from .tools import ENV, get_logger, get_collection
+
+
+LOGGER = get_logger(__name__)
+
+LOCK_COLLECTION_NAMES = {
+    name: event_type.lock_collection for name, event_type in EVENT_TYPES.items()
+}
+LOCK_COLLECTIONS = list(LOCK_COLLECTION_NAMES.values())
+# Locks of jobs that dropped off the farm expire after this many seconds,
+# the cue keeps refreshing the ones of jobs still there
+LOCK_TTL = int(ENV.get("NOTIFICATIONS_LOCK_TTL", 7 * 24 * 60 * 60))
+LOCK_REFRESH_INTERVAL = float(ENV.get("NOTIFICATIONS_LOCK_REFRESH", LOCK_TTL / 4))
+
+
+def get_add_op(name, users, now=None):
+    now = now or datetime.datetime.utcnow()
+    return UpdateOne(
+        {"name": name},
+        {
+            "$addToSet": {"users": {"$each": list(users)}},
+            "$set": {"updated": now},
+            "$setOnInsert": {"created": now},
+        },
+        upsert=True,
+    )
+
+
+def get_touch_op(names, now=None):
+    now = now or datetime.datetime.utcnow()
+    return UpdateMany({"name": {"$in": list(names)}}, {"$set": {"updated": now}})
+
+
+def get_clear_op(names):
+    return DeleteMany({"name": {"$in": list(names)}})
+
+
+def get_compact_ops(locks, now):
+    users = set()
+    created = []
+    for lock in locks:
+        users.update(lock.get("users", []))
+        if lock.get("created"):
+            created.append(lock["created"])
+    keep, duplicates = locks[0], locks[1:]
+    needs_update = (
+        duplicates
+        or len(users) != len(keep.get("users", []))
+        or "updated" not in keep
+    )
+    ops = []
+    if needs_update:
+        ops.append(UpdateOne({"_id": keep["_id"]}, {"$set": {
+            "users": sorted(users),
+            "created": min(created) if created else now,
+            "updated": keep.get("updated") or now,
+        }}))
+    if duplicates:
+        ops.append(DeleteMany({"_id": {"$in": [lock["_id"] for lock in duplicates]}}))
+    return ops
+
+
+def compact(coll_name, batch_size=None):
+    # Merges duplicate lock documents, dedupes users and stamps the
+    # timestamps the TTL index needs on documents from before it existed
+    coll = get_collection(coll_name)
+    writer = BulkWriter(batch_size)
+    now = datetime.datetime.utcnow()
+    projection = {"name": 1, "users": 1, "created": 1, "updated": 1}
+    writes = 0
+    failed = 0
+
+    def flush():
+        results = writer.flush()
+        return sum(len(result["errors"]) for result in results.values())
+
+    group = []
+    for lock in coll.find({}, projection).sort("name", 1):
+        if group and lock.get("name") != group[0].get("name"):
+            ops = get_compact_ops(group, now)
+            writes += len(ops)
+            for op in ops:
+                writer.add(coll, op)
+            group = []
+            if len(writer) >= writer.batch_size:
+                failed += flush()
+        group.append(lock)
+    if group:
+        ops = get_compact_ops(group, now)
+        writes += len(ops)
+        for op in ops:
+            writer.add(coll, op)
+    failed += flush()
+    LOGGER.info(f"Compacted {coll_name} with {writes} writes, {failed} failed")
+    return failed
+
+
+def main(args=None):
+    from .indexes import ensure_indexes
+
+    parser = argparse.ArgumentParser(description="Maintain render lock collections")
+    parser.add_argument("command", choices=["compact"])
+    parser.parse_args(args)
+    failed = sum(compact(coll_name) for coll_name in LOCK_COLLECTIONS)
+    # Unique and TTL indexes can only be built once the data is clean
+    failed += len(ensure_indexes())
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
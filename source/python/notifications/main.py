@@ -1,69 +1,88 @@
-import time
 import asyncio
 
-from . import cue, volt, slack
-from .tools import get_logger, get_collection
+from . import cue, volt
+from .tools import ENV, get_logger, get_collection
+from .outbox import OutboxDispatcher
+from .delivery import get_backends
+from .indexes import ensure_indexes
+from .leader import get_lease
+from .scheduler import SummaryScheduler
+from .metrics import (
+    METRICS_PORT, METRICS_JSON_PATH, serve_metrics, dump_metrics
+)
 
 
 LOGGER = get_logger(__name__)
 
 messages_coll = get_collection("notification_messages")
+OUTBOX_WORKERS = int(ENV.get("OUTBOX_WORKERS", 2))
 
 
 async def cue_summary():
-    while True:
-        start_time = time.time()
-        cue.run_summary()
-        end_time = time.time()
-        elapsed_time = end_time - start_time
-        LOGGER.debug(f"Cue summary for {round(elapsed_time, 1)} seconds")
-        break
-        # await asyncio.sleep(60)
+    engine = cue.get_engine()
+    scheduler = SummaryScheduler(engine.storage, aggregates=engine.aggregates)
+    await scheduler.run()
+
+
+def get_leader_check(lease, source):
+    # Every instance stays hot, only the lease holder evaluates snapshots
+    term = 0
+
+    def is_leader():
+        nonlocal term
+        if not lease.is_leader:
+            return False
+        if lease.term != term:
+            # Another instance ran in between, our previous state is stale
+            term = lease.term
+            source.reset()
+        return True
+
+    return is_leader
+
+
+async def run_source(source):
+    lease = get_lease(source.name).start()
+    await source.run(get_leader_check(lease, source))
 
 
 async def cue_():
-    while True:
-        start_time = time.time()
-        cue.run()
-        end_time = time.time()
-        elapsed_time = end_time - start_time
-        LOGGER.debug(f"Cue run for {round(elapsed_time, 1)} seconds")
-        await asyncio.sleep(10)
+    await run_source(cue.get_source())
 
 
 async def volt_():
-    pass
-    # while True:
-    #     start_time = time.time()
-    #     end_time = time.time()
-    #     elapsed_time = end_time - start_time
-    #     LOGGER.debug(f"Volt run for {round(elapsed_time, 1)} seconds")
-    #     await asyncio.sleep(10)
+    source = volt.get_source()
+    if source is not None:
+        await run_source(source)
+
+
+# {delivery: backend}, a rule's delivery may name several, e.g. "slack,email"
+send_functions = get_backends()
 
 
-def send_slack_message(msg):
-    slack.send_message(
-        service=msg.get("service", "hub"), text=msg["message"], user=msg["user"]
-    )
-    return True
+async def outbox_():
+    dispatchers = [
+        OutboxDispatcher(messages_coll, send_functions)
+        for _ in range(OUTBOX_WORKERS)
+    ]
+    await asyncio.gather(*[dispatcher.run() for dispatcher in dispatchers])
 
 
-send_functions = {
-    "slack": send_slack_message,
-}
+async def metrics_():
+    # Prometheus scrape endpoint and/or a periodic JSON dump, both opt in
+    tasks = []
+    if METRICS_PORT:
+        tasks.append(serve_metrics(METRICS_PORT))
+    if METRICS_JSON_PATH:
+        tasks.append(dump_metrics(METRICS_JSON_PATH))
+    await asyncio.gather(*tasks)
 
 
 async def main():
-    # asyncio.gather(*[cue_(), volt_()])
-    asyncio.gather(*[cue_summary()])
-    # while True:
-    #     LOGGER.debug("Sending slack messages")
-    #     messages = messages_coll.find()
-    #     for msg in messages:
-    #         success = send_functions[msg.get("delivery", "slack")](msg)
-    #         if success:
-    #             messages_coll.delete_one({"id": msg["id"]})
-    #     await asyncio.sleep(20)
-
-
-asyncio.run(main())
+    ensure_indexes()
+    await asyncio.gather(*[cue_(), cue_summary(), volt_(), outbox_(), metrics_()])
+
+
+# Guarded so spawned processes (see shards) can import this module safely
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,163 @@
+from uuid import uuid4
+
+from .tools import ENV
+from .events import EVENT_TYPES
+from .throttle import DIGEST, THROTTLE_DIGEST_WINDOW
+from .templates import (
+    RENDER_CACHE_SIZE, SECTION_TEXT_LIMIT, MORE_TEXT, Template, join_limited,
+    section, limit_blocks, truncate,
+)
+
+
+# How long a pending message keeps collecting jobs before it can be sent
+MESSAGE_WINDOW = float(ENV.get("NOTIFICATIONS_MESSAGE_WINDOW", 15))
+MESSAGE_MAX_ENTRIES = int(ENV.get("NOTIFICATIONS_MESSAGE_MAX_ENTRIES", 20))
+# Stop appending to a window this close to closing so it can't race a claim
+WINDOW_MARGIN = 2
+
+HEADERS = {name: event_type.header for name, event_type in EVENT_TYPES.items()}
+# The same job shows up in the messages of everyone with a matching rule
+ENTRY_LINE = Template("`{name}` by {user}", RENDER_CACHE_SIZE)
+DIGEST_HEADER = Template(
+    "*Busy on the farm*, {total} notifications over the last {minutes} minutes:"
+)
+DIGEST_COUNT_LINE = Template("{header} ({count})")
+
+
+def get_message_key(message):
+    return (
+        message["rule_type"],
+        message["user"],
+        message["delivery"],
+        message.get("service", "cue"),
+    )
+
+
+def new_message(rule, now, service="cue"):
+    window = rule.get("window", MESSAGE_WINDOW)
+    return {
+        "id": str(uuid4()),
+        "rule_type": rule["notified_for"],
+        "user": rule["user"],
+        "delivery": rule["delivery"],
+        "service": service,
+        "timestamp": now,
+        "window_open": now,
+        "window_close": now + window,
+        "max_entries": rule.get("max_entries", MESSAGE_MAX_ENTRIES),
+        "entries": [],
+        "total": 0,
+    }
+
+
+def new_digest(user, delivery, now, window=THROTTLE_DIGEST_WINDOW, service="cue"):
+    # Takes whatever a user's budget couldn't send on its own, of any type
+    message = new_message(
+        {"notified_for": DIGEST, "user": user, "delivery": delivery, "window": window},
+        now,
+        service,
+    )
+    message["counts"] = {}
+    return message
+
+
+def reopen_message(message, entries, counts, now):
+    # Lines that missed their message because it was claimed first, they
+    # waited long enough and go out as soon as the outbox sees them
+    reopened = {
+        key: value for key, value in message.items()
+        if key not in ("_id", "tick", "claimed_by", "claim", "lease_expires")
+    }
+    stored = [entry for entry in entries if entry]
+    reopened.update({
+        "id": str(uuid4()),
+        "timestamp": now,
+        "window_open": now,
+        "window_close": now,
+        "entries": stored[:message["max_entries"]],
+        "total": len(entries),
+    })
+    if "counts" in message:
+        reopened["counts"] = dict(counts)
+    return reopened
+
+
+def is_open(message, now):
+    # Messages from before windows existed are never appended to
+    if "entries" not in message:
+        return False
+    return message["window_close"] - WINDOW_MARGIN > now
+
+
+def add_entry(message, entry):
+    message["total"] += 1
+    if "counts" in message:
+        counts = message["counts"]
+        counts[entry["rule_type"]] = counts.get(entry["rule_type"], 0) + 1
+    if len(message["entries"]) >= message["max_entries"]:
+        return False
+    message["entries"].append(entry)
+    return True
+
+
+def get_entry_text(entry, user):
+    user_formatted = "you" if entry["user"] == user else entry["user"]
+    return ENTRY_LINE.render(name=entry["name"], user=user_formatted)
+
+
+def render_digest_text(message):
+    total = message["total"]
+    minutes = round((message["window_close"] - message["window_open"]) / 60)
+    header = DIGEST_HEADER.render(total=total, minutes=minutes)
+    # [count line, entry lines, entry lines shown] per type
+    groups = []
+    for rule_type, count in message["counts"].items():
+        single, plural = HEADERS.get(rule_type, (rule_type,) * 2)
+        count_line = DIGEST_COUNT_LINE.render(
+            header=plural if count > 1 else single, count=count
+        )
+        entries = [
+            get_entry_text(entry, message["user"])
+            for entry in message["entries"] if entry["rule_type"] == rule_type
+        ]
+        groups.append((count_line, entries, []))
+    # Every count line stays, the types take turns at the room left for
+    # entries so a busy one can't push the others out
+    room = SECTION_TEXT_LIMIT - len(header) - len(MORE_TEXT.format(total)) - 2
+    room -= sum(len(count_line) + 1 for count_line, _, _ in groups)
+    active = list(groups)
+    while active:
+        for group in list(active):
+            _, entries, shown = group
+            if len(shown) == len(entries) or len(entries[len(shown)]) + 1 > room:
+                active.remove(group)
+                continue
+            shown.append(entries[len(shown)])
+            room -= len(shown[-1]) + 1
+    lines = [header]
+    for count_line, _, shown in groups:
+        lines += [count_line] + shown
+    # One line for the entries that didn't fit and those never stored
+    left = total - sum(len(shown) for _, _, shown in groups)
+    if left:
+        lines.append(MORE_TEXT.format(left))
+    return truncate("\n".join(lines))
+
+
+def render_text(message):
+    if "entries" not in message:
+        return message["message"]
+    if message["rule_type"] == DIGEST:
+        return render_digest_text(message)
+    entries = message["entries"]
+    total = message["total"]
+    single, plural = HEADERS.get(message["rule_type"], (message["rule_type"],) * 2)
+    header = plural if total > 1 else single
+    lines = [get_entry_text(entry, message["user"]) for entry in entries]
+    # Past the stored entries, or past what fits in a section, is summed up
+    body = join_limited(lines, total, limit=SECTION_TEXT_LIMIT - len(header) - 1)
+    return f"{header}\n{body}" if body else header
+
+
+def render_blocks(message):
+    return limit_blocks([section(render_text(message))])
@@ -0,0 +1,145 @@
+import os
+import json
+import time
+import asyncio
+import threading
+from contextlib import contextmanager
+
+
+ENV = os.environ
+METRICS_PORT = int(ENV.get("METRICS_PORT", 0))
+METRICS_JSON_PATH = ENV.get("METRICS_JSON_PATH", "")
+METRICS_JSON_INTERVAL = float(ENV.get("METRICS_JSON_INTERVAL", 60))
+METRICS_PREFIX = "notifications_"
+
+
+def get_key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+def format_labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # {(name, labels): value}
+        self.counters = {}
+        self.gauges = {}
+        # {(name, labels): [count, sum, max]}
+        self.timings = {}
+
+    def inc(self, name, value=1, **labels):
+        key = get_key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[get_key(name, labels)] = value
+
+    def observe(self, name, seconds, **labels):
+        key = get_key(name, labels)
+        with self.lock:
+            timing = self.timings.get(key)
+            if timing is None:
+                self.timings[key] = [1, seconds, seconds]
+                return
+            timing[0] += 1
+            timing[1] += seconds
+            if seconds > timing[2]:
+                timing[2] = seconds
+
+    @contextmanager
+    def time(self, name, **labels):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start_time, **labels)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "counters": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in self.counters.items()
+                ],
+                "gauges": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in self.gauges.items()
+                ],
+                "timings": [
+                    {
+                        "name": name,
+                        "labels": dict(labels),
+                        "count": count,
+                        "sum": total,
+                        "max": maximum,
+                    }
+                    for (name, labels), (count, total, maximum) in self.timings.items()
+                ],
+            }
+
+    def render_prometheus(self):
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f"{METRICS_PREFIX}{name}_total{format_labels(labels)} {value}")
+            for (name, labels), value in sorted(self.gauges.items()):
+                lines.append(f"{METRICS_PREFIX}{name}{format_labels(labels)} {value}")
+            for (name, labels), timing in sorted(self.timings.items()):
+                count, total, maximum = timing
+                full_name = f"{METRICS_PREFIX}{name}_seconds"
+                lines.append(f"{full_name}_count{format_labels(labels)} {count}")
+                lines.append(f"{full_name}_sum{format_labels(labels)} {total}")
+                lines.append(f"{full_name}_max{format_labels(labels)} {maximum}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.gauges = {}
+            self.timings = {}
+
+
+METRICS = Metrics()
+
+
+async def handle_request(reader, writer):
+    try:
+        await reader.readuntil(b"\r\n\r\n")
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+        pass
+    body = METRICS.render_prometheus().encode()
+    writer.write(
+        b"HTTP/1.1 200 OK\r\n"
+        b"Content-Type: text/plain; version=0.0.4\r\n"
+        + f"Content-Length: {len(body)}\r\n".encode()
+        + b"Connection: close\r\n\r\n"
+        + body
+    )
+    try:
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def serve_metrics(port=METRICS_PORT, host="0.0.0.0"):
+    server = await asyncio.start_server(handle_request, host, port)
+    async with server:
+        await server.serve_forever()
+
+
+async def dump_metrics(path=METRICS_JSON_PATH, interval=METRICS_JSON_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        data = dict(METRICS.snapshot(), timestamp=time.time())
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
@@ -0,0 +1,205 @@
+import os
+import time
+import datetime
+import socket
+import asyncio
+from uuid import uuid4
+
+from .delivery import Backend, FunctionBackend, get_deliveries
+from .tools import ENV, get_logger
+from .metrics import METRICS
+
+
+LOGGER = get_logger(__name__)
+
+OUTBOX_BATCH_SIZE = int(ENV.get("OUTBOX_BATCH_SIZE", 50))
+OUTBOX_LEASE = float(ENV.get("OUTBOX_LEASE", 120))
+OUTBOX_CONCURRENCY = int(ENV.get("OUTBOX_CONCURRENCY", 8))
+OUTBOX_INTERVAL = float(ENV.get("OUTBOX_INTERVAL", 5))
+OUTBOX_MAX_ATTEMPTS = int(ENV.get("OUTBOX_MAX_ATTEMPTS", 5))
+
+
+def get_available_query(now):
+    return {
+        "failed": {"$ne": True},
+        # Still collecting jobs, see messages.MESSAGE_WINDOW
+        "window_close": {"$not": {"$gt": now}},
+        "$or": [{"claimed_by": None}, {"lease_expires": {"$lt": now}}],
+    }
+
+
+class OutboxDispatcher:
+    """Claims due messages and hands them to their delivery backends.
+
+    send_functions maps a delivery to a Backend, or to a plain async send
+    function. A message whose delivery lists several is fanned out to all
+    of them at once and only retried for the ones that failed.
+    """
+
+    def __init__(
+        self,
+        coll,
+        send_functions,
+        worker_id=None,
+        batch_size=OUTBOX_BATCH_SIZE,
+        lease=OUTBOX_LEASE,
+        concurrency=OUTBOX_CONCURRENCY,
+        interval=OUTBOX_INTERVAL,
+        max_attempts=OUTBOX_MAX_ATTEMPTS,
+    ):
+        self.coll = coll
+        self.backends = {
+            name: backend if isinstance(backend, Backend)
+            else FunctionBackend(name, backend)
+            for name, backend in send_functions.items()
+        }
+        self.worker_id = worker_id or (
+            f"{socket.gethostname()}-{os.getpid()}-{uuid4().hex[:6]}"
+        )
+        self.batch_size = batch_size
+        self.lease = lease
+        self.concurrency = concurrency
+        self.interval = interval
+        self.max_attempts = max_attempts
+
+    def claim(self):
+        now = time.time()
+        available = get_available_query(now)
+        candidates = self.coll.find(available, {"_id": 1}).limit(self.batch_size)
+        ids = [msg["_id"] for msg in candidates]
+        if not ids:
+            return None, []
+        # Every document is re-checked and claimed atomically, a replica that
+        # got there first simply makes it drop out of our claim
+        claim = str(uuid4())
+        self.coll.update_many(
+            {"$and": [{"_id": {"$in": ids}}, available]},
+            {"$set": {
+                "claimed_by": self.worker_id,
+                "claim": claim,
+                "lease_expires": now + self.lease,
+            }},
+        )
+        return claim, list(self.coll.find({"claim": claim}))
+
+    def ack(self, claim, delivered, failed):
+        # failed is {_id: deliveries it did reach}, only the rest are retried
+        if delivered:
+            self.coll.delete_many({"_id": {"$in": delivered}, "claim": claim})
+        for _id, reached in failed.items():
+            if reached:
+                self.coll.update_one(
+                    {"_id": _id, "claim": claim},
+                    {"$addToSet": {"delivered_to": {"$each": reached}}},
+                )
+        failed = list(failed)
+        if failed:
+            self.coll.update_many(
+                {"_id": {"$in": failed}, "claim": claim},
+                {
+                    "$set": {"claimed_by": None},
+                    "$unset": {"claim": "", "lease_expires": ""},
+                    "$inc": {"attempts": 1},
+                },
+            )
+            self.coll.update_many(
+                {"_id": {"$in": failed}, "attempts": {"$gte": self.max_attempts}},
+                # Kept for a look until indexes.OUTBOX_FAILED_TTL runs out
+                {"$set": {"failed": True, "failed_at": datetime.datetime.utcnow()}},
+            )
+
+    def requeue_expired(self):
+        result = self.coll.update_many(
+            {"claimed_by": {"$ne": None}, "lease_expires": {"$lt": time.time()}},
+            {"$set": {"claimed_by": None}, "$unset": {"claim": "", "lease_expires": ""}},
+        )
+        if result.modified_count:
+            METRICS.inc("messages_requeued", result.modified_count)
+            LOGGER.warning(f"Requeued {result.modified_count} expired messages")
+
+    async def deliver_batch(self, backend, batch, semaphore):
+        delivery = backend.name
+        async with backend.get_semaphore(), semaphore:
+            start_time = time.perf_counter()
+            try:
+                results = await backend.send_batch(batch)
+            except Exception as e:
+                LOGGER.error(f"Failed to deliver {len(batch)} messages via {delivery}: {e}")
+                results = [False] * len(batch)
+            METRICS.observe(
+                "delivery", time.perf_counter() - start_time, delivery=delivery
+            )
+        now = time.time()
+        for msg, ok in zip(batch, results):
+            if not ok:
+                METRICS.inc("delivery_failures", delivery=delivery)
+                continue
+            METRICS.inc("deliveries", delivery=delivery)
+            # How long the message waited after its window closed
+            ready = msg.get("window_close") or msg.get("timestamp")
+            if ready:
+                METRICS.observe("delivery_lag", max(0, now - ready), delivery=delivery)
+        return results
+
+    async def deliver(self, delivery, messages, semaphore):
+        backend = self.backends.get(delivery)
+        if backend is None:
+            for msg in messages:
+                LOGGER.error(f"No delivery backend for {delivery}, message {msg['id']}")
+            METRICS.inc("delivery_failures", len(messages), delivery=delivery)
+            return [False] * len(messages)
+        batches = [
+            messages[i:i + backend.batch_size]
+            for i in range(0, len(messages), backend.batch_size)
+        ]
+        results = await asyncio.gather(
+            *[self.deliver_batch(backend, batch, semaphore) for batch in batches]
+        )
+        return [ok for batch_results in results for ok in batch_results]
+
+    async def run_once(self):
+        loop = asyncio.get_running_loop()
+        with METRICS.time("outbox_stage", stage="claim"):
+            claim, messages = await loop.run_in_executor(None, self.claim)
+        if not messages:
+            return 0
+        METRICS.inc("messages_claimed", len(messages))
+        # {delivery: [messages]}, backends a message already reached on an
+        # earlier attempt are skipped
+        targets = {}
+        for msg in messages:
+            done = msg.get("delivered_to", [])
+            for delivery in get_deliveries(msg):
+                if delivery not in done:
+                    targets.setdefault(delivery, []).append(msg)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        results = await asyncio.gather(*[
+            self.deliver(delivery, msgs, semaphore)
+            for delivery, msgs in targets.items()
+        ])
+        # {message _id: deliveries that failed}, {message _id: that succeeded}
+        failures = {}
+        reached = {}
+        for (delivery, msgs), oks in zip(targets.items(), results):
+            for msg, ok in zip(msgs, oks):
+                (reached if ok else failures).setdefault(msg["_id"], []).append(delivery)
+        delivered = [msg["_id"] for msg in messages if msg["_id"] not in failures]
+        failed = {_id: reached.get(_id, []) for _id in failures}
+        with METRICS.time("outbox_stage", stage="ack"):
+            await loop.run_in_executor(None, self.ack, claim, delivered, failed)
+        LOGGER.debug(
+            f"{self.worker_id} delivered {len(delivered)}, failed {len(failed)}"
+        )
+        return len(messages)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await loop.run_in_executor(None, self.requeue_expired)
+                # Keep draining while there is a backlog
+                while await self.run_once() >= self.batch_size:
+                    pass
+            except Exception as e:
+                LOGGER.error(f"Outbox worker {self.worker_id} failed: {e}")
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,169 @@
+import re
+import fnmatch
+
+
+GLOB_CHARS = set("*?[")
+
+
+def get_rules_revision(rules):
+    parts = []
+    for rule in rules:
+        parts.append(repr((
+            str(rule.get("_id", rule.get("id"))),
+            rule.get("user"),
+            rule.get("notified_for"),
+            rule.get("delivery"),
+            tuple(rule.get("targets", [])),
+            sorted((rule.get("filters") or {}).items()),
+            rule.get("window"),
+            rule.get("max_entries"),
+        )))
+    parts.sort()
+    return hash(tuple(parts))
+
+
+def is_literal(target):
+    return not GLOB_CHARS.intersection(target)
+
+
+def is_prefix_glob(target):
+    return target.endswith("*") and is_literal(target[:-1])
+
+
+class RuleBucket:
+    # Rules sharing a target, split by their users filter so a job only
+    # looks at the rules that can apply to its user
+    __slots__ = ("unfiltered", "by_user")
+
+    def __init__(self):
+        self.unfiltered = []
+        self.by_user = {}
+
+    def add(self, rule):
+        users_filter = (rule.get("filters") or {}).get("users", [])
+        if not users_filter:
+            self.unfiltered.append(rule)
+            return
+        for user in set(users_filter):
+            self.by_user.setdefault(user, []).append(rule)
+
+    def collect(self, user, found):
+        for rule in self.unfiltered:
+            found[id(rule)] = rule
+        for rule in self.by_user.get(user, ()):
+            found[id(rule)] = rule
+
+
+class PrefixTrie:
+    __slots__ = ("root",)
+
+    def __init__(self):
+        self.root = {}
+
+    def add(self, prefix, rule):
+        node = self.root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        bucket = node.get(None)
+        if bucket is None:
+            bucket = node[None] = RuleBucket()
+        bucket.add(rule)
+
+    def collect(self, name, user, found):
+        node = self.root
+        bucket = node.get(None)
+        if bucket:
+            bucket.collect(user, found)
+        for char in name:
+            node = node.get(char)
+            if node is None:
+                return
+            bucket = node.get(None)
+            if bucket:
+                bucket.collect(user, found)
+
+
+class TypeIndex:
+    def __init__(self):
+        self.literals = {}
+        self.prefixes = PrefixTrie()
+        self.patterns = {}
+        self.combined = None
+        self.compiled = []
+
+    def add(self, rule):
+        for target in set(rule.get("targets", [])):
+            if is_literal(target):
+                bucket = self.literals.get(target)
+                if bucket is None:
+                    bucket = self.literals[target] = RuleBucket()
+                bucket.add(rule)
+            elif is_prefix_glob(target):
+                self.prefixes.add(target[:-1], rule)
+            else:
+                bucket = self.patterns.get(target)
+                if bucket is None:
+                    bucket = self.patterns[target] = RuleBucket()
+                bucket.add(rule)
+
+    def compile(self):
+        if not self.patterns:
+            return
+        translated = [fnmatch.translate(target) for target in self.patterns]
+        # One pass over the combined regex tells us whether any of the
+        # remaining globs can match, only then are they checked one by one
+        self.combined = re.compile("|".join(f"(?:{t})" for t in translated))
+        self.compiled = [
+            (re.compile(t).match, bucket)
+            for t, bucket in zip(translated, self.patterns.values())
+        ]
+
+    def collect(self, name, user, found):
+        bucket = self.literals.get(name)
+        if bucket:
+            bucket.collect(user, found)
+        self.prefixes.collect(name, user, found)
+        if self.combined is None or not self.combined.match(name):
+            return
+        for match, bucket in self.compiled:
+            if match(name):
+                bucket.collect(user, found)
+
+
+class RuleIndex:
+    def __init__(self, rules, revision=None):
+        self.revision = revision
+        self.types = {}
+        self.rules = list(rules)
+        self.order = {id(rule): i for i, rule in enumerate(self.rules)}
+        for rule in self.rules:
+            notified_for = rule.get("notified_for")
+            type_index = self.types.get(notified_for)
+            if type_index is None:
+                type_index = self.types[notified_for] = TypeIndex()
+            type_index.add(rule)
+        for type_index in self.types.values():
+            type_index.compile()
+
+    def match(self, job, notified_for):
+        type_index = self.types.get(notified_for)
+        if type_index is None:
+            return []
+        found = {}
+        type_index.collect(job["name"], job.get("user"), found)
+        if len(found) < 2:
+            return list(found.values())
+        # Keep the order rules were loaded in, as the old linear scan did
+        order = self.order
+        return sorted(found.values(), key=lambda rule: order[id(rule)])
+
+    def match_all(self, job, notified_fors=None):
+        # {notified_for: matching rules}, only types with a match
+        matches = {}
+        if notified_fors is None:
+            notified_fors = self.types
+        for notified_for in notified_fors:
+            rules = self.match(job, notified_for)
+            if rules:
+                matches[notified_for] = rules
+        return matches
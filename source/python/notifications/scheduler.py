@@ -0,0 +1,157 @@
+import time
+import heapq
+import asyncio
+import datetime
+
+from . import cue
+from .metrics import METRICS
+from .tools import ENV, get_logger
+
+
+LOGGER = get_logger(__name__)
+
+# A run missed by less than this, e.g. during a restart, is still sent
+SUMMARY_CATCHUP = float(ENV.get("SUMMARY_CATCHUP", 6 * 60 * 60))
+SCHEDULER_RELOAD = float(ENV.get("SCHEDULER_RELOAD", 5 * 60))
+
+
+def get_next_run(at, now):
+    run = datetime.datetime.combine(now.date(), at)
+    if run <= now:
+        run += datetime.timedelta(days=1)
+    return run
+
+
+def get_last_run(at, now):
+    run = datetime.datetime.combine(now.date(), at)
+    if run > now:
+        run -= datetime.timedelta(days=1)
+    return run
+
+
+def get_delivery_key(user, run):
+    return f"farm_summary:{user}:{run:%Y-%m-%d}"
+
+
+class SummaryScheduler:
+    """Sends every user's farm summary at their own time of day.
+
+    Users sit in a min-heap keyed by their next run, so a wake-up only pops
+    what is due. Each run claims a delivery key per user and day first,
+    which is what keeps restarts and other instances from sending twice.
+    """
+
+    def __init__(
+        self,
+        storage,
+        send=None,
+        aggregates=None,
+        catchup=SUMMARY_CATCHUP,
+        reload_interval=SCHEDULER_RELOAD,
+    ):
+        self.storage = storage
+        self.send = send
+        self.aggregates = aggregates
+        self.catchup = catchup
+        self.reload_interval = reload_interval
+        # {user: (summary time, logoff time)}
+        self.times = {}
+        # [(timestamp, user, run)]
+        self.heap = []
+        # {delivery key: timestamp}, keys known to be taken
+        self.done = {}
+
+    def load(self):
+        times = {}
+        for doc in self.storage.get_all_notification_times():
+            if doc.get("user"):
+                times[doc["user"]] = cue.get_user_times(doc)
+        now = datetime.datetime.now()
+        heap = []
+        for user, (summary_time, _) in times.items():
+            run = get_last_run(summary_time, now)
+            missed = (now - run).total_seconds() <= self.catchup
+            if not missed or get_delivery_key(user, run) in self.done:
+                run = get_next_run(summary_time, now)
+            heap.append((run.timestamp(), user, run))
+        heapq.heapify(heap)
+        self.times = times
+        self.heap = heap
+        # Keys older than the catch-up window can't come up again
+        expired = time.time() - self.catchup - 24 * 60 * 60
+        self.done = {key: ts for key, ts in self.done.items() if ts > expired}
+        METRICS.set("scheduled_summaries", len(heap))
+        LOGGER.debug(f"Scheduled summaries for {len(heap)} users")
+
+    def pop_due(self, now):
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            due.append(heapq.heappop(self.heap))
+        return due
+
+    def fire(self, due):
+        claimed = {}
+        rules = []
+        for ts, user, run in due:
+            if user not in self.times:
+                # Removed since the last load
+                continue
+            key = get_delivery_key(user, run)
+            if key not in self.done and self.storage.claim_delivery(
+                key, {"user": user, "run": run}
+            ):
+                claimed[user] = key
+                rules.append({
+                    "notified_for": "farm_summary",
+                    "user": user,
+                    "times": list(self.times[user]),
+                })
+            else:
+                METRICS.inc("summaries_deduped")
+            self.done[key] = ts
+        if rules:
+            try:
+                results = cue.run_summary(
+                    self.storage, rules, self.send, self.aggregates
+                )
+            except Exception:
+                # Nothing was sent, every key goes back for the next load
+                for key in claimed.values():
+                    self.release(key)
+                raise
+            for user, key in claimed.items():
+                if results.get(user, False) is None:
+                    # Failed, give the key back so a reload can catch it up
+                    self.release(key)
+        now = datetime.datetime.now()
+        for _, user, run in due:
+            if user in self.times:
+                run = get_next_run(self.times[user][0], max(now, run))
+                heapq.heappush(self.heap, (run.timestamp(), user, run))
+        return claimed
+
+    def release(self, key):
+        try:
+            self.storage.release_delivery(key)
+        except Exception as e:
+            LOGGER.error(f"Couldn't release summary delivery {key}: {e}")
+        self.done.pop(key, None)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        next_load = 0
+        while True:
+            try:
+                if time.time() >= next_load:
+                    await loop.run_in_executor(None, self.load)
+                    next_load = time.time() + self.reload_interval
+                due = self.pop_due(time.time())
+                if due:
+                    await loop.run_in_executor(None, self.fire, due)
+                    continue
+            except Exception as e:
+                LOGGER.error(f"Summary scheduler failed: {e}")
+                # Rebuild the heap, due runs popped before the error included
+                next_load = time.time() + min(self.reload_interval, 60)
+            wake = min(self.heap[0][0], next_load) if self.heap else next_load
+            await asyncio.sleep(max(0.1, wake - time.time()))
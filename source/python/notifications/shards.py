@@ -0,0 +1,254 @@
+import time
+import atexit
+import traceback
+import multiprocessing
+
+from .cue import CueEngine, Evaluation, match_changes, get_locks, evaluate
+from .sources import CueSource
+from .snapshot import EVENT_JOB_FIELDS, iter_jobs
+from .storage import MongoStorage
+from .metrics import METRICS
+from .tools import ENV, get_logger
+
+
+LOGGER = get_logger(__name__)
+
+# Children must not re-run the parent's main module, see main.py
+CUE_SHARD_START_METHOD = ENV.get("CUE_SHARD_START_METHOD", "spawn")
+CUE_SHARD_TIMEOUT = float(ENV.get("CUE_SHARD_TIMEOUT", 60))
+
+
+class Shard(CueEngine):
+    """Reads, diffs and evaluates the jobs that hash to one shard.
+
+    Only this shard's part of the snapshot is read and decoded, see
+    snapshot.get_snapshot_shard. A job always lands on the same shard, so
+    its previous state and its locks are only ever looked at here.
+    """
+
+    def __init__(self, index, shards, storage):
+        super().__init__(storage)
+        self.index = index
+        self.shards = shards
+        # Summaries are built from storage in sharded mode
+        self.aggregates = None
+
+    def tick(self, snapshot_id, now):
+        start_time = time.perf_counter()
+        start_cpu = time.process_time()
+        snapshot = self.storage.get_snapshot_shard(
+            snapshot_id, self.index, self.shards, EVENT_JOB_FIELDS
+        )
+        rule_index = self.get_rule_index()
+        changes = self.differ.diff(iter_jobs(snapshot, EVENT_JOB_FIELDS))
+        self.refresh_locks()
+        evaluation = None
+        if changes:
+            try:
+                matched = match_changes(changes, rule_index, self.service)
+                evaluation = Evaluation(get_locks(self.storage, matched, self.lock_prefix))
+                evaluate(matched, evaluation, now, self.lock_prefix)
+            except Exception:
+                self.reset()
+                raise
+            # The parent only needs the changes, not what was already locked
+            evaluation.locks = {}
+        stats = {
+            "jobs": len(self.differ.states),
+            "changed": len(changes),
+            "seconds": time.perf_counter() - start_time,
+            "cpu_seconds": time.process_time() - start_cpu,
+        }
+        return stats, evaluation
+
+
+def shard_main(conn, index, shards, storage_factory):
+    shard = Shard(index, shards, storage_factory())
+    while True:
+        try:
+            command, args = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+        if command == "stop":
+            break
+        try:
+            conn.send((True, getattr(shard, command)(*args)))
+        except Exception:
+            # Whatever this tick decided is lost, look at every job again
+            shard.reset()
+            conn.send((False, traceback.format_exc()))
+    conn.close()
+
+
+class ShardPool:
+    def __init__(self, shards, storage_factory=MongoStorage, start_method=None):
+        self.shards = shards
+        self.storage_factory = storage_factory
+        self.context = multiprocessing.get_context(
+            start_method or CUE_SHARD_START_METHOD
+        )
+        self.workers = [None] * shards
+
+    def start(self, index):
+        parent_conn, child_conn = self.context.Pipe()
+        process = self.context.Process(
+            target=shard_main,
+            args=(child_conn, index, self.shards, self.storage_factory),
+            name=f"cue-shard-{index}",
+            daemon=True,
+        )
+        process.start()
+        child_conn.close()
+        self.workers[index] = (process, parent_conn)
+        return self.workers[index]
+
+    def restart(self, index):
+        process, conn = self.workers[index]
+        conn.close()
+        if process.is_alive():
+            process.kill()
+        process.join()
+        METRICS.inc("shard_restarts")
+        self.start(index)
+
+    def get_worker(self, index):
+        worker = self.workers[index]
+        if worker is None:
+            return self.start(index)
+        if not worker[0].is_alive():
+            LOGGER.error(f"Cue shard {index} died, restarting...")
+            self.restart(index)
+        return self.workers[index]
+
+    def send(self, index, command, args=()):
+        _, conn = self.get_worker(index)
+        try:
+            conn.send((command, args))
+        except OSError:
+            self.restart(index)
+            self.workers[index][1].send((command, args))
+
+    def receive(self, index, timeout=CUE_SHARD_TIMEOUT):
+        process, conn = self.workers[index]
+        try:
+            if not conn.poll(timeout):
+                raise TimeoutError(f"no answer in {timeout} seconds")
+            ok, result = conn.recv()
+        except (EOFError, OSError, TimeoutError) as e:
+            # A fresh process starts with no state, so it re-evaluates every
+            # job it owns and the locks keep that from notifying twice
+            self.restart(index)
+            return False, f"shard {index} lost: {e}"
+        return ok, result
+
+    def broadcast(self, command, args=()):
+        # Every shard works at the same time, answers are gathered in order
+        for index in range(self.shards):
+            self.send(index, command, args)
+        return [self.receive(index) for index in range(self.shards)]
+
+    def close(self):
+        for index, worker in enumerate(self.workers):
+            if worker is None:
+                continue
+            process, conn = worker
+            try:
+                conn.send(("stop", ()))
+            except OSError:
+                pass
+            conn.close()
+            process.join(5)
+            if process.is_alive():
+                process.kill()
+            self.workers[index] = None
+
+
+class ShardedCueEngine(CueEngine):
+    """Spreads each tick across shard processes that read their own jobs.
+
+    The parent only looks up the latest snapshot's id, then merges what
+    the shards decided and coalesces and flushes it in one bulk write.
+    """
+
+    def __init__(
+        self, storage=None, shards=2, storage_factory=MongoStorage, start_method=None
+    ):
+        super().__init__(storage)
+        self.pool = ShardPool(shards, storage_factory, start_method)
+        # What each shard reported for the last tick, see Shard.tick
+        self.shard_stats = []
+        # The parent never sees the jobs, summaries are built from storage
+        self.aggregates = None
+        atexit.register(self.close)
+
+    def check(self, results):
+        failed = [result for ok, result in results if not ok]
+        for error in failed:
+            METRICS.inc("shard_failures")
+            LOGGER.error(f"Cue shard failed: {error}")
+        return failed
+
+    def process_snapshot(self, snapshot_id):
+        now = time.time()
+        with METRICS.time("cue_stage", stage="shards", service=self.service):
+            results = self.pool.broadcast("tick", (snapshot_id, now))
+        self.check(results)
+        self.shard_stats = [result[0] if ok else None for ok, result in results]
+        evaluations = []
+        for index, (ok, result) in enumerate(results):
+            if not ok:
+                continue
+            stats, evaluation = result
+            METRICS.observe("shard_tick", stats["seconds"], shard=index)
+            METRICS.set(
+                "jobs_tracked", stats["jobs"], shard=index, service=self.service
+            )
+            METRICS.inc("jobs_changed", stats["changed"], service=self.service)
+            if evaluation is not None:
+                evaluations.append(evaluation)
+        if not evaluations:
+            return None
+        try:
+            with METRICS.time("cue_stage", stage="prefetch", service=self.service):
+                tick = self.prefetch([], None)
+            with METRICS.time("cue_stage", stage="evaluate", service=self.service):
+                for evaluation in evaluations:
+                    tick.evaluation.merge(evaluation)
+            with METRICS.time("cue_stage", stage="coalesce", service=self.service):
+                tick.coalesce()
+            with METRICS.time("cue_stage", stage="flush", service=self.service):
+                self.flush(tick)
+        except Exception:
+            # The shards already moved on, these changes would never come back
+            self.reset()
+            raise
+        return tick
+
+    def reset(self):
+        super().reset()
+        self.check(self.pool.broadcast("reset"))
+
+    def run(self):
+        with METRICS.time("cue_tick", service=self.service):
+            snapshot_id = self.storage.get_latest_snapshot_id()
+            if snapshot_id is None:
+                LOGGER.error("No farm data found, aborting...")
+                METRICS.inc("missing_snapshots", service=self.service)
+                return None
+            return self.process_snapshot(snapshot_id)
+
+    def close(self):
+        self.pool.close()
+
+
+class ShardedCueSource(CueSource):
+    # Hands the shards the snapshot's id, they read their jobs themselves
+
+    def fetch(self):
+        return self.engine.storage.get_latest_snapshot_id()
+
+    def normalize(self, snapshot_id):
+        return snapshot_id
+
+    def process(self, snapshot_id):
+        return self.engine.process_snapshot(snapshot_id)
@@ -1,18 +1,187 @@
 import os
-import requests
+import json
+import time
+import random
+import asyncio
+import weakref
+import datetime
+import threading
+from email.utils import parsedate_to_datetime
+
+import aiohttp
+
+from .metrics import METRICS
 
 
 ENV = os.environ
+SLACKBOT_URL = ENV.get("SLACKBOT_URL", "http://slackbot.london.etc:8081/api")
+SLACK_TIMEOUT = float(ENV.get("SLACK_TIMEOUT", 10))
+SLACK_RETRIES = int(ENV.get("SLACK_RETRIES", 3))
+SLACK_CONCURRENCY = int(ENV.get("SLACK_CONCURRENCY", 8))
+SLACK_BACKOFF = float(ENV.get("SLACK_BACKOFF", 0.5))
+
+_CLIENTS = weakref.WeakKeyDictionary()
+_SYNC_LOOP = None
+_SYNC_LOCK = threading.Lock()
+
+
+class SlackError(Exception):
+    pass
+
+
+class Response:
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    def json(self):
+        return json.loads(self.text)
+
+
+def get_retry_after(value, default):
+    # Retry-After is seconds or an HTTP date, anything else waits the backoff
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return max(0.0, date.timestamp() - time.time())
+
+
+class RateLimiter:
+    # Shared pause for every request of a client, set from 429 Retry-After
+    def __init__(self):
+        self.resume_at = 0
+
+    def pause(self, seconds):
+        self.resume_at = max(self.resume_at, time.monotonic() + seconds)
+
+    async def wait(self):
+        delay = self.resume_at - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class SlackClient:
+    def __init__(
+        self,
+        base_url=SLACKBOT_URL,
+        timeout=SLACK_TIMEOUT,
+        retries=SLACK_RETRIES,
+        concurrency=SLACK_CONCURRENCY,
+        backoff=SLACK_BACKOFF,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.retries = retries
+        self.concurrency = concurrency
+        self.backoff = backoff
+        self.limiter = RateLimiter()
+        self._session = None
+        self._semaphore = None
+
+    def _get_session(self):
+        # Created lazily so both belong to the loop the client is used on
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                connector=aiohttp.TCPConnector(limit=self.concurrency),
+            )
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._session
+
+    def _get_delay(self, attempt):
+        # Full jitter exponential backoff
+        return random.uniform(0, self.backoff * 2 ** attempt)
+
+    async def request(self, method, data=None):
+        url = f"{self.base_url}/{method}"
+        session = self._get_session()
+        last_error = None
+        async with self._semaphore:
+            for attempt in range(self.retries + 1):
+                if attempt:
+                    METRICS.inc("slack_retries", method=method)
+                    await asyncio.sleep(self._get_delay(attempt - 1))
+                await self.limiter.wait()
+                try:
+                    async with session.request(
+                        "POST" if data else "GET", url, json=data or None
+                    ) as resp:
+                        text = await resp.text()
+                        if resp.status == 429:
+                            METRICS.inc("slack_rate_limited", method=method)
+                            self.limiter.pause(get_retry_after(
+                                resp.headers.get("Retry-After"), self.backoff
+                            ))
+                            last_error = SlackError(f"Rate limited on {method}")
+                            continue
+                        if resp.status >= 500:
+                            last_error = SlackError(
+                                f"{method} failed with {resp.status}: {text}"
+                            )
+                            continue
+                        return Response(resp.status, text)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    last_error = e
+        raise SlackError(
+            f"{method} failed after {self.retries + 1} attempts: {last_error}"
+        )
+
+    async def send_message(self, **kwargs):
+        return await self.request("send_slack_message", kwargs)
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+
+def get_client():
+    # One pooled client per event loop
+    loop = asyncio.get_running_loop()
+    client = _CLIENTS.get(loop)
+    if client is None:
+        client = _CLIENTS[loop] = SlackClient()
+    return client
+
+
+def _get_sync_loop():
+    global _SYNC_LOOP
+    with _SYNC_LOCK:
+        if _SYNC_LOOP is None:
+            _SYNC_LOOP = asyncio.new_event_loop()
+            thread = threading.Thread(target=_SYNC_LOOP.run_forever, daemon=True)
+            thread.start()
+        return _SYNC_LOOP
+
+
+def run_sync(coro):
+    # Runs on a background loop so it also works from inside a running loop
+    return asyncio.run_coroutine_threadsafe(coro, _get_sync_loop()).result()
+
+
+async def request_async(method, data):
+    return await get_client().request(method, data)
+
+
+async def send_message_async(**kwargs):
+    return await get_client().send_message(**kwargs)
 
 
 def request(method, data):
-    url = f"http://slackbot.london.etc:8081/api/{method}"
-    if not data:
-        resp = requests.get(url)
-    else:
-        headers = {"Content-Type": "application/json"}
-        resp = requests.post(url, headers=headers, json=data)
-    return resp
+    return run_sync(request_async(method, data))
 
 
 def send_message(**kwargs):
@@ -0,0 +1,142 @@
+import string
+
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+
+
+# Only the fields the event path looks at
+EVENT_JOB_FIELDS = ["name", "user", "state", "deadFrames", "startTime", "stopTime"]
+# Summary aggregates keep counts per shot, see aggregates.UserAggregate
+AGGREGATE_JOB_FIELDS = EVENT_JOB_FIELDS + ["show", "shot"]
+# The renders a summary lists also need the layers for cores, progress and
+# the VRI lookup
+SUMMARY_JOB_FIELDS = AGGREGATE_JOB_FIELDS + [
+    "layers.currentCores",
+    "layers.percentCompleted",
+    "layers.outputPaths",
+]
+
+RAW_CODEC_OPTIONS = CodecOptions(document_class=RawBSONDocument)
+# Shards split jobs by a hash of their name that mongo can compute as well,
+# so each shard only reads its own jobs, see get_shard_expression
+SHARD_ALPHABET = string.ascii_letters + string.digits + "-_."
+SHARD_HASH_MODULUS = 1000003
+
+
+def get_projection(fields, prefix=""):
+    return {prefix + field: 1 for field in fields}
+
+
+def get_latest_snapshot(coll, fields=None, raw=True):
+    if raw:
+        # Keep the document as BSON bytes, jobs get decoded one at a time
+        coll = coll.with_options(codec_options=RAW_CODEC_OPTIONS)
+    projection = get_projection(fields, "data.jobs.") if fields else None
+    return coll.find_one(sort=[("_id", -1)], projection=projection)
+
+
+def get_name_hash(name):
+    value = 0
+    for char in name:
+        value = (value * 37 + SHARD_ALPHABET.find(char) + 1) % SHARD_HASH_MODULUS
+    return value
+
+
+def get_shard(name, shards):
+    return get_name_hash(name or "") % shards
+
+
+def get_shard_expression(name, shards):
+    # get_shard in the aggregation language, characters outside the
+    # alphabet count as 0 on both sides
+    return {"$mod": [
+        {"$reduce": {
+            "input": {"$range": [0, {"$strLenCP": name}]},
+            "initialValue": 0,
+            "in": {"$mod": [
+                {"$add": [
+                    {"$multiply": ["$$value", 37]},
+                    {"$indexOfCP": [SHARD_ALPHABET, {"$substrCP": [name, "$$this", 1]}]},
+                    1,
+                ]},
+                SHARD_HASH_MODULUS,
+            ]},
+        }},
+        shards,
+    ]}
+
+
+def get_latest_snapshot_id(coll):
+    latest = coll.find_one(sort=[("_id", -1)], projection={"_id": 1})
+    return latest["_id"] if latest else None
+
+
+def get_snapshot_shard(coll, snapshot_id, shard, shards, fields=None):
+    # The snapshot with only the jobs of one shard, filtered server side
+    name = {"$ifNull": ["$$job.name", ""]}
+    pipeline = [
+        {"$match": {"_id": snapshot_id}},
+        {"$project": {"data.jobs": {"$filter": {
+            "input": "$data.jobs",
+            "as": "job",
+            "cond": {"$eq": [get_shard_expression(name, shards), shard]},
+        }}}},
+    ]
+    if fields:
+        pipeline.append({"$project": get_projection(fields, "data.jobs.")})
+    coll = coll.with_options(codec_options=RAW_CODEC_OPTIONS)
+    return next(coll.aggregate(pipeline), None)
+
+
+def get_snapshot_jobs(coll, names, fields=None):
+    # Only the named jobs of the latest snapshot, filtered server side
+    pipeline = [
+        {"$sort": {"_id": -1}},
+        {"$limit": 1},
+        {"$project": {"data.jobs": {"$filter": {
+            "input": "$data.jobs",
+            "as": "job",
+            "cond": {"$in": ["$$job.name", list(names)]},
+        }}}},
+    ]
+    if fields:
+        pipeline.append({"$project": get_projection(fields, "data.jobs.")})
+    snapshot = next(coll.aggregate(pipeline), None)
+    return snapshot["data"]["jobs"] if snapshot else []
+
+
+def materialize(value):
+    if isinstance(value, RawBSONDocument):
+        return {key: materialize(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [materialize(item) for item in value]
+    return value
+
+
+def get_top_fields(fields):
+    return {field.split(".", 1)[0] for field in fields}
+
+
+def iter_jobs(snapshot, fields=None, extra_fields=None, wants_extra=None):
+    # extra_fields are only decoded for the jobs wants_extra picks
+    if not snapshot:
+        return
+    top_fields = get_top_fields(fields) if fields else None
+    extra = None
+    if extra_fields and top_fields is not None:
+        extra = get_top_fields(extra_fields) - top_fields
+    for job in snapshot["data"]["jobs"]:
+        if not isinstance(job, RawBSONDocument):
+            yield job
+            continue
+        if top_fields is None:
+            yield materialize(job)
+            continue
+        decoded = {
+            field: materialize(job[field]) for field in top_fields if field in job
+        }
+        if extra and wants_extra(decoded):
+            decoded.update(
+                {field: materialize(job[field]) for field in extra if field in job}
+            )
+        yield decoded
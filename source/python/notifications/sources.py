@@ -0,0 +1,103 @@
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from .watch import SnapshotWatcher
+from .metrics import METRICS
+from .tools import ENV, get_logger
+
+
+LOGGER = get_logger(__name__)
+
+# "poll" re-runs cue every CUE_INTERVAL seconds, "watch" runs it as snapshots land
+CUE_MODE = ENV.get("CUE_MODE", "poll")
+CUE_INTERVAL = float(ENV.get("CUE_INTERVAL", 10))
+
+
+class Source:
+    """Somewhere jobs come from, fed through a cue engine.
+
+    A tick fetches the latest snapshot, normalizes its jobs into the shape
+    the engine diffs (see snapshot.EVENT_JOB_FIELDS) and lets the engine
+    extract and notify the events. Each source ticks in its own thread on
+    its own cadence, so a slow one never holds up the others.
+    """
+
+    name = None
+
+    def __init__(self, engine, interval, mode="poll"):
+        self.engine = engine
+        self.interval = interval
+        self.mode = mode
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix=f"source-{self.name}")
+
+    def fetch(self):
+        raise NotImplementedError
+
+    def normalize(self, snapshot):
+        # Yields the snapshot's jobs in the engine's shape
+        raise NotImplementedError
+
+    def process(self, jobs):
+        return self.engine.process(jobs)
+
+    def get_watch_collection(self):
+        # The collection snapshots land in, for the "watch" mode
+        raise NotImplementedError
+
+    def reset(self):
+        self.engine.reset()
+
+    def tick(self):
+        with METRICS.time("source_tick", source=self.name):
+            with METRICS.time("source_stage", source=self.name, stage="fetch"):
+                snapshot = self.fetch()
+            if not snapshot:
+                LOGGER.error(f"No {self.name} snapshot found, aborting...")
+                METRICS.inc("missing_snapshots", source=self.name)
+                return None
+            return self.process(self.normalize(snapshot))
+
+    async def run_tick(self, should_run=None):
+        if should_run is not None and not should_run():
+            return None
+        loop = asyncio.get_running_loop()
+        start_time = time.time()
+        try:
+            return await loop.run_in_executor(self.executor, self.tick)
+        except Exception as e:
+            METRICS.inc("source_failures", source=self.name)
+            LOGGER.error(f"{self.name} run failed: {e}")
+        finally:
+            elapsed_time = time.time() - start_time
+            LOGGER.debug(f"{self.name} run for {round(elapsed_time, 1)} seconds")
+
+    async def run(self, should_run=None):
+        if self.mode == "watch":
+            watcher = SnapshotWatcher(self.get_watch_collection())
+            await watcher.run(lambda: self.run_tick(should_run))
+            return
+        while True:
+            start_time = time.monotonic()
+            await self.run_tick(should_run)
+            await asyncio.sleep(max(0, self.interval - (time.monotonic() - start_time)))
+
+
+class CueSource(Source):
+    name = "cue"
+
+    def __init__(self, engine, interval=CUE_INTERVAL, mode=CUE_MODE):
+        super().__init__(engine, interval, mode)
+
+    def fetch(self):
+        return self.engine.storage.get_latest_snapshot(self.engine.get_fields())
+
+    def normalize(self, snapshot):
+        return self.engine.iter_jobs(snapshot)
+
+    def process(self, jobs):
+        # Through the summary aggregates as well
+        return self.engine.observe(jobs)
+
+    def get_watch_collection(self):
+        return self.engine.storage.farm_coll
@@ -0,0 +1,377 @@
+import time
+import datetime
+from uuid import uuid4
+
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from .bulk import BulkWriter
+from .messages import is_open, reopen_message
+from .throttle import get_bucket_update, merge_bucket
+from .locks import LOCK_COLLECTION_NAMES, get_add_op, get_clear_op, get_touch_op
+from .snapshot import (
+    get_latest_snapshot, get_latest_snapshot_id, get_snapshot_shard, get_snapshot_jobs,
+    get_projection, get_shard,
+)
+from .tools import get_logger, get_collection, get_slackbot_collection
+
+
+LOGGER = get_logger(__name__)
+
+
+def split_late_appends(appends, now):
+    # Appends to windows that closed since the prefetch could lose a race
+    # with the outbox's claim, they become new messages straight away
+    on_time = {}
+    late = []
+    for _id, append in appends.items():
+        if is_open(append[0], now):
+            on_time[_id] = append
+        else:
+            late.append(append)
+    return on_time, late
+
+
+class Storage:
+    """Everything the cue engine reads and writes.
+
+    Writes from a tick are handed over in one go through write_tick so a
+    backend can batch them.
+    """
+
+    def get_rules(self, rule_types):
+        raise NotImplementedError
+
+    def get_locks(self, rule_type, names):
+        # {job name: set of notified users}
+        raise NotImplementedError
+
+    def get_pending_messages(self, rule_types, open_after):
+        raise NotImplementedError
+
+    def write_tick(self, tick, batch_size=None):
+        # Returns the number of failed writes
+        raise NotImplementedError
+
+    def touch_locks(self, names):
+        # Keeps the locks of jobs still on the farm from expiring
+        raise NotImplementedError
+
+    def get_latest_snapshot(self, fields=None):
+        raise NotImplementedError
+
+    def get_latest_snapshot_id(self):
+        raise NotImplementedError
+
+    def get_snapshot_shard(self, snapshot_id, shard, shards, fields=None):
+        # The snapshot with only the jobs snapshot.get_shard puts on shard
+        raise NotImplementedError
+
+    def get_snapshot_jobs(self, names, fields=None):
+        # The named jobs of the latest snapshot
+        raise NotImplementedError
+
+    def get_throttle_state(self):
+        # [{"_id": bucket key, "t": tokens, "at": updated}]
+        raise NotImplementedError
+
+    def get_renders_since(self, since_by_user, fields=None):
+        # {user: [renders started after since]}
+        raise NotImplementedError
+
+    def get_renders(self, names, fields=None):
+        # The stored renders with these names
+        raise NotImplementedError
+
+    def get_notification_times(self, user):
+        raise NotImplementedError
+
+    def get_all_notification_times(self):
+        raise NotImplementedError
+
+    def claim_delivery(self, key, doc):
+        # False if the key was already claimed, i.e. it was sent before
+        raise NotImplementedError
+
+    def release_delivery(self, key):
+        raise NotImplementedError
+
+
+class MongoStorage(Storage):
+    def __init__(self):
+        self.rules_coll = get_collection("notification_rules")
+        self.messages_coll = get_collection("notification_messages")
+        self.notification_times_coll = get_collection("notification_times")
+        self.lock_colls = {
+            rule_type: get_collection(name)
+            for rule_type, name in LOCK_COLLECTION_NAMES.items()
+        }
+        self.deliveries_coll = get_collection("summary_deliveries")
+        self.throttle_coll = get_collection("notification_throttle")
+        self.farm_coll = get_slackbot_collection("store_farm")
+        self.renders_coll = get_slackbot_collection("store_renders")
+
+    def get_rules(self, rule_types):
+        return list(self.rules_coll.find({"notified_for": {"$in": rule_types}}))
+
+    def get_locks(self, rule_type, names):
+        locks = {}
+        query = {"name": {"$in": list(names)}}
+        for lock in self.lock_colls[rule_type].find(query, {"name": 1, "users": 1}):
+            locks.setdefault(lock["name"], set()).update(lock.get("users", []))
+        return locks
+
+    def get_pending_messages(self, rule_types, open_after):
+        # Only messages whose window is still open can take new lines, the
+        # rest are up for delivery by the outbox
+        return list(self.messages_coll.find({
+            "rule_type": {"$in": rule_types},
+            "claimed_by": None,
+            "window_close": {"$gt": open_after},
+        }))
+
+    def write_tick(self, tick, batch_size=None):
+        writer = BulkWriter(batch_size)
+        for message in tick.new_messages.values():
+            writer.add(self.messages_coll, InsertOne(message))
+        # Stamped on every append so the ones that missed can be told apart
+        tick_id = str(uuid4())
+        appends, late = split_late_appends(tick.appends, time.time())
+        for _id, (message, entries, counts) in appends.items():
+            stored = [entry for entry in entries if entry]
+            inc = {"total": len(entries)}
+            inc.update({f"counts.{rule_type}": n for rule_type, n in counts.items()})
+            writer.add(self.messages_coll, UpdateOne(
+                {"_id": _id, "claimed_by": None},
+                {
+                    "$push": {"entries": {
+                        "$each": stored, "$slice": message["max_entries"]
+                    }},
+                    "$inc": inc,
+                    "$set": {"tick": tick_id},
+                },
+            ))
+        if tick.throttle is not None:
+            for key, change in tick.throttle.pop_changes():
+                writer.add(self.throttle_coll, UpdateOne(
+                    {"_id": key}, get_bucket_update(change), upsert=True
+                ))
+        now = datetime.datetime.utcnow()
+        for rule_type, coll in self.lock_colls.items():
+            names = tick.lock_clears.get(rule_type)
+            if names:
+                writer.add(coll, get_clear_op(names))
+            for name, users in tick.lock_adds.get(rule_type, {}).items():
+                writer.add(coll, get_add_op(name, users, now))
+        results = writer.flush()
+        failed = sum(len(result["errors"]) for result in results.values())
+        matched = results.get(self.messages_coll.full_name, {}).get("matched", 0)
+        if appends and matched < len(appends):
+            # Claimed by the outbox between the prefetch and this write
+            hit = {
+                doc["_id"] for doc in self.messages_coll.find(
+                    {"_id": {"$in": list(appends)}, "tick": tick_id}, {"_id": 1}
+                )
+            }
+            late += [append for _id, append in appends.items() if _id not in hit]
+        return failed + self.write_late(late)
+
+    def touch_locks(self, names):
+        writer = BulkWriter()
+        now = datetime.datetime.utcnow()
+        names = list(names)
+        for coll in self.lock_colls.values():
+            for i in range(0, len(names), writer.batch_size):
+                writer.add(coll, get_touch_op(names[i:i + writer.batch_size], now))
+        results = writer.flush()
+        return sum(len(result["errors"]) for result in results.values())
+
+    def write_late(self, late):
+        if not late:
+            return 0
+        now = time.time()
+        reopened = [reopen_message(*append, now) for append in late]
+        LOGGER.warning(f"{len(reopened)} messages were claimed before their appends")
+        try:
+            self.messages_coll.insert_many(reopened, ordered=False)
+        except BulkWriteError as e:
+            LOGGER.error(f"Couldn't reopen claimed messages: {e.details}")
+            return len(e.details.get("writeErrors", []))
+        return 0
+
+    def get_latest_snapshot(self, fields=None):
+        return get_latest_snapshot(self.farm_coll, fields)
+
+    def get_latest_snapshot_id(self):
+        return get_latest_snapshot_id(self.farm_coll)
+
+    def get_snapshot_shard(self, snapshot_id, shard, shards, fields=None):
+        return get_snapshot_shard(self.farm_coll, snapshot_id, shard, shards, fields)
+
+    def get_snapshot_jobs(self, names, fields=None):
+        return get_snapshot_jobs(self.farm_coll, names, fields)
+
+    def get_throttle_state(self):
+        return list(self.throttle_coll.find({}, {"expires": 0}))
+
+    def get_renders_since(self, since_by_user, fields=None):
+        if not since_by_user:
+            return {}
+        pipeline = [
+            {"$match": {"$or": [
+                {"user": user, "startTime": {"$gt": since}}
+                for user, since in since_by_user.items()
+            ]}},
+        ]
+        if fields:
+            pipeline.append({"$project": get_projection(fields)})
+        pipeline.append({"$group": {"_id": "$user", "renders": {"$push": "$$ROOT"}}})
+        groups = self.renders_coll.aggregate(pipeline, allowDiskUse=True)
+        return {group["_id"]: group["renders"] for group in groups}
+
+    def get_renders(self, names, fields=None):
+        projection = get_projection(fields) if fields else None
+        return list(self.renders_coll.find({"name": {"$in": list(names)}}, projection))
+
+    def get_notification_times(self, user):
+        return self.notification_times_coll.find_one({"user": user})
+
+    def get_all_notification_times(self):
+        return list(self.notification_times_coll.find({}, {"_id": 0}))
+
+    def claim_delivery(self, key, doc):
+        try:
+            self.deliveries_coll.insert_one(
+                dict(doc, _id=key, created=datetime.datetime.utcnow())
+            )
+        except DuplicateKeyError:
+            return False
+        return True
+
+    def release_delivery(self, key):
+        self.deliveries_coll.delete_one({"_id": key})
+
+
+def copy_message(message):
+    message = dict(message, entries=list(message["entries"]))
+    if "counts" in message:
+        message["counts"] = dict(message["counts"])
+    return message
+
+
+class MemoryStorage(Storage):
+    def __init__(self, rules=None, snapshots=None, renders=None, times=None):
+        self.rules = list(rules or [])
+        self.snapshots = list(snapshots or [])
+        self.renders = list(renders or [])
+        self.times = dict(times or {})
+        self.locks = {rule_type: {} for rule_type in LOCK_COLLECTION_NAMES}
+        # {message id: message}
+        self.messages = {}
+        # {delivery key: doc}
+        self.deliveries = {}
+        # {bucket key: doc}
+        self.throttle = {}
+
+    def get_rules(self, rule_types):
+        return [rule for rule in self.rules if rule.get("notified_for") in rule_types]
+
+    def get_locks(self, rule_type, names):
+        locks = self.locks[rule_type]
+        return {name: set(locks[name]) for name in names if name in locks}
+
+    def get_pending_messages(self, rule_types, open_after):
+        return [
+            copy_message(message)
+            for message in self.messages.values()
+            if message["rule_type"] in rule_types
+            and not message.get("claimed_by")
+            and message.get("window_close", 0) > open_after
+        ]
+
+    def write_tick(self, tick, batch_size=None):
+        for message in tick.new_messages.values():
+            message.setdefault("_id", message["id"])
+            self.messages[message["id"]] = copy_message(message)
+        appends, late = split_late_appends(tick.appends, time.time())
+        for _id, (message, entries, counts) in appends.items():
+            stored = self.messages.get(message["id"])
+            if stored is None or stored.get("claimed_by"):
+                late.append((message, entries, counts))
+                continue
+            stored["entries"] += [entry for entry in entries if entry]
+            del stored["entries"][stored["max_entries"]:]
+            stored["total"] += len(entries)
+            for rule_type, n in counts.items():
+                stored["counts"][rule_type] = stored["counts"].get(rule_type, 0) + n
+        if tick.throttle is not None:
+            for key, change in tick.throttle.pop_changes():
+                doc = merge_bucket(self.throttle.get(key), change)
+                self.throttle[key] = dict(doc, _id=key)
+        now = time.time()
+        for append in late:
+            message = reopen_message(*append, now)
+            message["_id"] = message["id"]
+            self.messages[message["id"]] = message
+        for rule_type, names in tick.lock_clears.items():
+            for name in names:
+                self.locks[rule_type].pop(name, None)
+        for rule_type, adds in tick.lock_adds.items():
+            for name, users in adds.items():
+                self.locks[rule_type].setdefault(name, set()).update(users)
+        return 0
+
+    def touch_locks(self, names):
+        # Nothing expires in memory
+        return 0
+
+    def get_latest_snapshot(self, fields=None):
+        return self.snapshots[-1] if self.snapshots else None
+
+    def get_latest_snapshot_id(self):
+        # Snapshots are numbered from 1 in the order they were added
+        return len(self.snapshots) or None
+
+    def get_snapshot_shard(self, snapshot_id, shard, shards, fields=None):
+        snapshot = self.snapshots[snapshot_id - 1]
+        jobs = [
+            job for job in snapshot["data"]["jobs"]
+            if get_shard(job.get("name"), shards) == shard
+        ]
+        return {"data": {"jobs": jobs}}
+
+    def get_snapshot_jobs(self, names, fields=None):
+        if not self.snapshots:
+            return []
+        names = set(names)
+        return [job for job in self.snapshots[-1]["data"]["jobs"] if job["name"] in names]
+
+    def get_throttle_state(self):
+        return list(self.throttle.values())
+
+    def get_renders_since(self, since_by_user, fields=None):
+        renders = {}
+        for render in self.renders:
+            since = since_by_user.get(render["user"])
+            if since is not None and render["startTime"] > since:
+                renders.setdefault(render["user"], []).append(render)
+        return renders
+
+    def get_renders(self, names, fields=None):
+        names = set(names)
+        return [render for render in self.renders if render["name"] in names]
+
+    def get_notification_times(self, user):
+        return self.times.get(user)
+
+    def get_all_notification_times(self):
+        return [dict(times, user=user) for user, times in self.times.items()]
+
+    def claim_delivery(self, key, doc):
+        if key in self.deliveries:
+            return False
+        self.deliveries[key] = doc
+        return True
+
+    def release_delivery(self, key):
+        self.deliveries.pop(key, None)
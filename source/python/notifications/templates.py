@@ -0,0 +1,89 @@
+from functools import lru_cache
+
+from .tools import ENV
+
+
+# Slack rejects section texts and messages over these
+SECTION_TEXT_LIMIT = 3000
+MAX_BLOCKS = 50
+RENDER_CACHE_SIZE = int(ENV.get("NOTIFICATIONS_RENDER_CACHE_SIZE", 4096))
+MORE_TEXT = "and {} more..."
+ELLIPSIS = "..."
+
+
+class Template:
+    """A text layout compiled once and rendered from keyword values.
+
+    With a cache size, identical renders are memoized, which pays off for
+    lines that repeat across many users' messages.
+    """
+
+    def __init__(self, pattern, cache_size=0):
+        self.pattern = pattern
+        render = pattern.format
+        if cache_size:
+            render = lru_cache(maxsize=cache_size)(render)
+        self.render = render
+
+    def cache_info(self):
+        if hasattr(self.render, "cache_info"):
+            return self.render.cache_info()
+        return None
+
+    def __repr__(self):
+        return f"Template({self.pattern!r})"
+
+
+def truncate(text, limit=SECTION_TEXT_LIMIT):
+    if len(text) <= limit:
+        return text
+    return text[:limit - len(ELLIPSIS)] + ELLIPSIS
+
+
+def join_limited(
+    lines, total=None, limit=SECTION_TEXT_LIMIT, sep="\n", more=MORE_TEXT
+):
+    # Joins as many lines as fit in limit, the rest become an "and N more"
+    # line. total counts lines left out by the caller already.
+    if total is None:
+        total = len(lines)
+    parts = []
+    size = 0
+    for line in lines:
+        added = len(line) + (len(sep) if parts else 0)
+        left = total - len(parts) - 1
+        reserved = len(sep) + len(more.format(left)) if left else 0
+        if size + added + reserved > limit:
+            break
+        parts.append(line)
+        size += added
+    left = total - len(parts)
+    if left:
+        parts.append(more.format(left))
+    return truncate(sep.join(parts), limit)
+
+
+def join_words(words, limit=None):
+    # "a, b and c", anything past limit words becomes "and N more"
+    if limit is not None and len(words) > limit:
+        return f"{', '.join(words[:limit])} and {len(words) - limit} more"
+    if len(words) < 2:
+        return "".join(words)
+    return f"{', '.join(words[:-1])} and {words[-1]}"
+
+
+def section(text):
+    return {
+        "type": "section",
+        "text": {"type": "mrkdwn", "text": truncate(text)},
+    }
+
+
+def divider():
+    return {"type": "divider"}
+
+
+def limit_blocks(blocks, limit=MAX_BLOCKS):
+    if len(blocks) <= limit:
+        return blocks
+    return blocks[:limit - 1] + [section(MORE_TEXT.format(len(blocks) - limit + 1))]
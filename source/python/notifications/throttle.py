@@ -0,0 +1,158 @@
+import datetime
+
+from .tools import ENV
+
+
+# Budgets are in messages, a burst of them then a steady rate per minute
+THROTTLE_USER_BURST = float(ENV.get("THROTTLE_USER_BURST", 10))
+THROTTLE_USER_PER_MINUTE = float(ENV.get("THROTTLE_USER_PER_MINUTE", 4))
+THROTTLE_DELIVERY_BURST = float(ENV.get("THROTTLE_DELIVERY_BURST", 6))
+THROTTLE_DELIVERY_PER_MINUTE = float(ENV.get("THROTTLE_DELIVERY_PER_MINUTE", 2))
+# Shared by everyone, what a delivery backend like slackbot can take
+THROTTLE_CHANNEL_BURST = float(ENV.get("THROTTLE_CHANNEL_BURST", 60))
+THROTTLE_CHANNEL_PER_MINUTE = float(ENV.get("THROTTLE_CHANNEL_PER_MINUTE", 60))
+# Throttled notifications are collected for this long into one digest
+THROTTLE_DIGEST_WINDOW = float(ENV.get("THROTTLE_DIGEST_WINDOW", 5 * 60))
+DIGEST = "digest"
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+class TokenBucket:
+    def __init__(self, burst, per_minute, tokens=None, updated=0):
+        self.burst = burst
+        self.rate = per_minute / 60
+        self.tokens = burst if tokens is None else tokens
+        self.updated = updated
+        # Taken since the bucket was loaded, see merge_bucket
+        self.spent = 0
+
+    def refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+        return self.tokens
+
+    def take(self, now):
+        self.tokens -= 1
+        self.spent += 1
+        self.updated = max(self.updated, now)
+
+    def get_full_at(self, now):
+        # When the bucket stops mattering, a full bucket needn't be stored
+        if not self.rate:
+            return None
+        return now + (self.burst - self.tokens) / self.rate
+
+
+def get_expires(full_at):
+    return full_at and datetime.datetime.utcfromtimestamp(full_at)
+
+
+def merge_bucket(doc, change):
+    # Only what this engine spent is taken off the stored bucket, so the
+    # other sources' spending since it was loaded still counts
+    bucket = TokenBucket(change["burst"], change["rate"] * 60)
+    if doc is not None:
+        bucket.tokens = doc["t"]
+        bucket.updated = doc["at"]
+    bucket.refill(change["at"])
+    bucket.tokens -= change["spent"]
+    bucket.updated = max(bucket.updated, change["at"])
+    return {
+        "t": round(bucket.tokens, 3),
+        "at": bucket.updated,
+        "expires": get_expires(bucket.get_full_at(bucket.updated)),
+    }
+
+
+def get_bucket_update(change):
+    # merge_bucket as an update pipeline, applied atomically by mongo
+    burst, rate, at = change["burst"], change["rate"], change["at"]
+    stored_at = {"$ifNull": ["$at", at]}
+    refilled = {"$min": [burst, {"$add": [
+        {"$ifNull": ["$t", burst]},
+        {"$multiply": [{"$max": [0, {"$subtract": [at, stored_at]}]}, rate]},
+    ]}]}
+    pipeline = [{"$set": {
+        "t": {"$round": [{"$subtract": [refilled, change["spent"]]}, 3]},
+        "at": {"$max": [stored_at, at]},
+    }}]
+    if rate:
+        full_at = {"$add": ["$at", {"$divide": [{"$subtract": [burst, "$t"]}, rate]}]}
+        # Adding milliseconds to a date gives a date
+        expires = {"$add": [EPOCH, {"$multiply": [full_at, 1000]}]}
+        pipeline.append({"$set": {"expires": expires}})
+    return pipeline
+
+
+def get_bucket_keys(user, delivery):
+    keys = [f"u:{user}", f"d:{user}:{delivery}"]
+    # A fanned out delivery like "slack,email" draws on every channel
+    keys += [f"c:{channel.strip()}" for channel in delivery.split(",")]
+    return keys
+
+
+class Throttle:
+    """Token buckets capping how many messages each user, each user's
+    delivery and each delivery channel overall can be sent.
+
+    Only buckets that have been drawn on are kept, as {key: (tokens,
+    updated)}, and only the ones that changed are written back. Every
+    source has its own throttle but they all spend from the same stored
+    buckets, so a change only carries what was spent, see merge_bucket.
+    """
+
+    def __init__(
+        self,
+        user_burst=THROTTLE_USER_BURST,
+        user_per_minute=THROTTLE_USER_PER_MINUTE,
+        delivery_burst=THROTTLE_DELIVERY_BURST,
+        delivery_per_minute=THROTTLE_DELIVERY_PER_MINUTE,
+        channel_burst=THROTTLE_CHANNEL_BURST,
+        channel_per_minute=THROTTLE_CHANNEL_PER_MINUTE,
+    ):
+        self.budgets = {
+            "u": (user_burst, user_per_minute),
+            "d": (delivery_burst, delivery_per_minute),
+            "c": (channel_burst, channel_per_minute),
+        }
+        self.buckets = {}
+        self.dirty = set()
+
+    def get_bucket(self, key):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(*self.budgets[key.split(":", 1)[0]])
+        return bucket
+
+    def allow(self, user, delivery, now):
+        keys = get_bucket_keys(user, delivery)
+        buckets = [self.get_bucket(key) for key in keys]
+        # Every budget needs a token, none is spent otherwise
+        if any(bucket.refill(now) < 1 for bucket in buckets):
+            return False
+        for bucket in buckets:
+            bucket.take(now)
+        self.dirty.update(keys)
+        return True
+
+    def load(self, docs):
+        for doc in docs:
+            bucket = self.get_bucket(doc["_id"])
+            bucket.tokens = doc["t"]
+            bucket.updated = doc["at"]
+
+    def pop_changes(self):
+        # [(key, change)], see merge_bucket
+        changes = []
+        for key in self.dirty:
+            bucket = self.buckets[key]
+            changes.append((key, {
+                "spent": bucket.spent,
+                "at": bucket.updated,
+                "burst": bucket.burst,
+                "rate": bucket.rate,
+            }))
+            bucket.spent = 0
+        self.dirty = set()
+        return changes
@@ -1,12 +1,24 @@
 import os
 import logging
+import threading
 
 import colorlog
 import pymongo
+from pymongo import monitoring
+
+from .metrics import METRICS
 
 
 ENV = os.environ
-MONGO_URL = ENV["MONGO_URL"]
+MONGO_URL = ENV.get("MONGO_URL")
+SLACKBOT_MONGO_URL = ENV.get("SLACKBOT_MONGO_URL", "slackbot:27117")
+MONGO_MAX_POOL_SIZE = int(ENV.get("MONGO_MAX_POOL_SIZE", 50))
+MONGO_MIN_POOL_SIZE = int(ENV.get("MONGO_MIN_POOL_SIZE", 0))
+MONGO_TIMEOUT_MS = int(ENV.get("MONGO_TIMEOUT_MS", 10000))
+
+# {(address, pid): client}, clients are never shared across a fork
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
 
 logFormatter = colorlog.ColoredFormatter(
     "%(log_color)s%(asctime)s - %(name)-8s - %(levelname)-8s - %(message)s",
@@ -22,12 +34,86 @@ LOGGER.addHandler(ch)
 LOGGER.propagate = False
 
 
-def new_mongo_client(address=f"mongodb://{MONGO_URL}"):
-    return pymongo.MongoClient(address)
+class MongoCommandListener(monitoring.CommandListener):
+    # Counts every command the clients send, grouped by command name
+    def started(self, event):
+        METRICS.inc("mongo_commands", command=event.command_name)
+
+    def succeeded(self, event):
+        METRICS.observe(
+            "mongo_command", event.duration_micros / 1e6, command=event.command_name
+        )
+
+    def failed(self, event):
+        METRICS.inc("mongo_command_failures", command=event.command_name)
+
+
+def new_mongo_client(address=None, **kwargs):
+    if address is None:
+        if not MONGO_URL:
+            raise RuntimeError("MONGO_URL is not set")
+        address = f"mongodb://{MONGO_URL}"
+    options = {
+        "maxPoolSize": MONGO_MAX_POOL_SIZE,
+        "minPoolSize": MONGO_MIN_POOL_SIZE,
+        "serverSelectionTimeoutMS": MONGO_TIMEOUT_MS,
+        "connectTimeoutMS": MONGO_TIMEOUT_MS,
+        # Don't open connections until the first operation
+        "connect": False,
+        "event_listeners": [MongoCommandListener()],
+    }
+    options.update(kwargs)
+    return pymongo.MongoClient(address, **options)
+
+
+def get_client(address=None):
+    key = (address, os.getpid())
+    client = _CLIENTS.get(key)
+    if client is None:
+        with _CLIENTS_LOCK:
+            client = _CLIENTS.get(key)
+            if client is None:
+                client = _CLIENTS[key] = new_mongo_client(address)
+    return client
+
+
+def _forget_clients():
+    # The child must not touch the parent's sockets, it builds its own pools
+    global _CLIENTS_LOCK
+    _CLIENTS.clear()
+    _CLIENTS_LOCK = threading.Lock()
 
 
-MONGODB_SLACKBOT = new_mongo_client("mongodb://slackbot:27117")
-MONGODB = new_mongo_client()
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forget_clients)
+
+
+class LazyCollection:
+    """Collection handle that only resolves its client on first use."""
+
+    def __init__(self, get_db, name):
+        self._get_db = get_db
+        self._name = name
+        self._coll = None
+        self._pid = None
+
+    def resolve(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            self._coll = self._get_db()[self._name]
+            self._pid = pid
+        return self._coll
+
+    def __getattr__(self, attr):
+        if attr.startswith("_"):
+            raise AttributeError(attr)
+        return getattr(self.resolve(), attr)
+
+    def __getitem__(self, name):
+        return self.resolve()[name]
+
+    def __repr__(self):
+        return f"LazyCollection({self._name!r})"
 
 
 def get_logger(name):
@@ -43,26 +129,26 @@ def get_logger(name):
 
 
 def get_db():
-    DB = MONGODB["hub"]
+    DB = get_mongo_client()["hub"]
     return DB
 
 
 def get_collection(name):
-    DB = get_db()
-    coll = DB[name]
-    return coll
+    return LazyCollection(get_db, name)
 
 
 def get_slackbot_db():
-    DB = MONGODB_SLACKBOT["et_hub"]
+    DB = get_slackbot_client()["et_hub"]
     return DB
 
 
 def get_slackbot_collection(name):
-    DB = get_slackbot_db()
-    coll = DB[name]
-    return coll
+    return LazyCollection(get_slackbot_db, name)
 
 
 def get_mongo_client():
-    return MONGODB
+    return get_client()
+
+
+def get_slackbot_client():
+    return get_client(f"mongodb://{SLACKBOT_MONGO_URL}")
@@ -1,2 +1,59 @@
-def run():
-    pass
+from .cue import CueEngine
+from .sources import Source
+from .snapshot import get_latest_snapshot, iter_jobs
+from .tools import ENV, get_slackbot_collection
+
+
+# Unset leaves the volt source off
+VOLT_COLLECTION = ENV.get("VOLT_COLLECTION")
+VOLT_MODE = ENV.get("VOLT_MODE", "poll")
+VOLT_INTERVAL = float(ENV.get("VOLT_INTERVAL", 30))
+# {volt field: cue job field}
+VOLT_FIELDS = {
+    "name": "name",
+    "user": "user",
+    "status": "state",
+    "failedTasks": "deadFrames",
+    "startTime": "startTime",
+    "stopTime": "stopTime",
+}
+VOLT_FINISHED_STATUSES = {"done", "complete", "finished"}
+
+
+def normalize_job(job):
+    normalized = {field: job.get(volt_field) for volt_field, field in VOLT_FIELDS.items()}
+    normalized["state"] = "1" if normalized["state"] in VOLT_FINISHED_STATUSES else "0"
+    for field in ("deadFrames", "startTime", "stopTime"):
+        normalized[field] = normalized[field] or 0
+    return normalized
+
+
+class VoltSource(Source):
+    name = "volt"
+
+    def __init__(self, engine, coll, interval=VOLT_INTERVAL, mode=VOLT_MODE):
+        super().__init__(engine, interval, mode)
+        self.coll = coll
+
+    def fetch(self):
+        return get_latest_snapshot(self.coll, list(VOLT_FIELDS))
+
+    def normalize(self, snapshot):
+        for job in iter_jobs(snapshot, list(VOLT_FIELDS)):
+            if job.get("name"):
+                yield normalize_job(job)
+
+    def get_watch_collection(self):
+        return self.coll
+
+
+def get_source(storage=None):
+    if not VOLT_COLLECTION:
+        return None
+    engine = CueEngine(storage, service="volt")
+    return VoltSource(engine, get_slackbot_collection(VOLT_COLLECTION))
+
+
+def run(storage=None):
+    source = get_source(storage)
+    return source.tick() if source else None
@@ -0,0 +1,123 @@
+import time
+import threading
+from pathlib import Path
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from .tools import ENV, get_logger
+
+
+LOGGER = get_logger(__name__)
+
+VRI_ROOT = ENV.get("VRI_ROOT", "/jobs")
+VRI_WORKERS = int(ENV.get("VRI_WORKERS", 8))
+VRI_TIMEOUT = float(ENV.get("VRI_TIMEOUT", 2))
+VRI_CACHE_TTL = float(ENV.get("VRI_CACHE_TTL", 600))
+VRI_CACHE_SIZE = int(ENV.get("VRI_CACHE_SIZE", 4096))
+
+
+def get_asset_dirs(job, root=VRI_ROOT):
+    # Same walk get_vri always did, stopping at the first path outside root
+    asset_dirs = []
+    for layer in job.get("layers", []):
+        for path in layer.get("outputPaths", []):
+            if not path or not path.startswith(root):
+                return asset_dirs
+            asset_dir = Path(path).parent
+            if asset_dir not in asset_dirs:
+                asset_dirs.append(asset_dir)
+    return asset_dirs
+
+
+def read_vri(asset_dir):
+    vri_path = Path(asset_dir) / ".vri"
+    if vri_path.is_file():
+        return vri_path.read_text()
+    return None
+
+
+class VriResolver:
+    def __init__(
+        self,
+        root=VRI_ROOT,
+        workers=VRI_WORKERS,
+        timeout=VRI_TIMEOUT,
+        ttl=VRI_CACHE_TTL,
+        max_size=VRI_CACHE_SIZE,
+    ):
+        self.root = root
+        self.timeout = timeout
+        self.ttl = ttl
+        self.max_size = max_size
+        # {asset dir: (expires, vri or None)}, None being a cached miss
+        self.cache = OrderedDict()
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="vri")
+
+    def _get_cached(self, asset_dir):
+        cached = self.cache.get(asset_dir)
+        if cached is None:
+            return False, None
+        expires, vri = cached
+        if expires < time.monotonic():
+            del self.cache[asset_dir]
+            return False, None
+        self.cache.move_to_end(asset_dir)
+        return True, vri
+
+    def _read(self, asset_dir):
+        try:
+            vri = read_vri(asset_dir)
+        except OSError as e:
+            LOGGER.warning(f"Couldn't read VRI in {asset_dir}: {e}")
+            vri = None
+        with self.lock:
+            self.cache[asset_dir] = (time.monotonic() + self.ttl, vri)
+            self.cache.move_to_end(asset_dir)
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+            self.in_flight.pop(asset_dir, None)
+        return vri
+
+    def _lookup(self, asset_dir):
+        # Returns a cached value or a future shared by everyone asking
+        with self.lock:
+            found, vri = self._get_cached(asset_dir)
+            if found:
+                return vri, None
+            future = self.in_flight.get(asset_dir)
+            if future is None:
+                future = self.executor.submit(self._read, asset_dir)
+                self.in_flight[asset_dir] = future
+            return None, future
+
+    def resolve_many(self, jobs):
+        # Start every lookup first so slow directories are read in parallel
+        lookups = [
+            [self._lookup(asset_dir) for asset_dir in get_asset_dirs(job, self.root)]
+            for job in jobs
+        ]
+        deadline = time.monotonic() + self.timeout
+        results = []
+        for job, job_lookups in zip(jobs, lookups):
+            vri = ""
+            for cached, future in job_lookups:
+                if future is not None:
+                    try:
+                        cached = future.result(max(0, deadline - time.monotonic()))
+                    except TimeoutError:
+                        LOGGER.warning(f"Timed out getting VRI for {job.get('name')}")
+                        continue
+                if cached:
+                    vri = cached
+                    break
+            results.append(vri)
+        return results
+
+    def resolve(self, job):
+        return self.resolve_many([job])[0]
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
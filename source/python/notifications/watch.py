@@ -0,0 +1,125 @@
+import time
+import asyncio
+import threading
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+from .tools import ENV, get_logger
+
+
+LOGGER = get_logger(__name__)
+
+WATCH_DEBOUNCE = float(ENV.get("CUE_WATCH_DEBOUNCE", 0.5))
+WATCH_MAX_WAIT = float(ENV.get("CUE_WATCH_MAX_WAIT", 2))
+WATCH_POLL_INTERVAL = float(ENV.get("CUE_WATCH_POLL_INTERVAL", 1))
+
+
+class SnapshotWatcher:
+    """Triggers a callback whenever a new snapshot lands in a collection.
+
+    Uses a change stream on inserts, falling back to tailing by _id when
+    the server does not support change streams. Bursts of inserts are
+    coalesced into a single callback.
+    """
+
+    def __init__(
+        self,
+        coll,
+        debounce=WATCH_DEBOUNCE,
+        max_wait=WATCH_MAX_WAIT,
+        poll_interval=WATCH_POLL_INTERVAL,
+    ):
+        self.coll = coll
+        self.debounce = debounce
+        self.max_wait = max_wait
+        self.poll_interval = poll_interval
+        self.mode = None
+        self.stopped = threading.Event()
+        self._event = None
+        self._loop = None
+
+    def _signal(self):
+        self._event.set()
+
+    def _signal_threadsafe(self):
+        self._loop.call_soon_threadsafe(self._signal)
+
+    def _watch(self):
+        while not self.stopped.is_set():
+            try:
+                self._watch_changes()
+            except OperationFailure as e:
+                LOGGER.warning(
+                    f"Change streams unavailable on {self.coll.full_name} "
+                    f"({e}), tailing by _id instead"
+                )
+                self._tail()
+            except PyMongoError as e:
+                LOGGER.error(f"Watching {self.coll.full_name} failed: {e}")
+                self.stopped.wait(self.poll_interval)
+
+    def _watch_changes(self):
+        pipeline = [{"$match": {"operationType": "insert"}}]
+        with self.coll.watch(pipeline, max_await_time_ms=1000) as stream:
+            self.mode = "change_stream"
+            while not self.stopped.is_set() and stream.alive:
+                if stream.try_next() is not None:
+                    self._signal_threadsafe()
+
+    def _tail(self):
+        self.mode = "tail"
+        latest = self.coll.find_one(sort=[("_id", -1)], projection={"_id": 1})
+        last_id = latest["_id"] if latest else None
+        while not self.stopped.is_set():
+            query = {"_id": {"$gt": last_id}} if last_id is not None else {}
+            try:
+                latest = self.coll.find_one(
+                    query, sort=[("_id", -1)], projection={"_id": 1}
+                )
+            except PyMongoError as e:
+                LOGGER.error(f"Tailing {self.coll.full_name} failed: {e}")
+                latest = None
+            if latest:
+                last_id = latest["_id"]
+                self._signal_threadsafe()
+            self.stopped.wait(self.poll_interval)
+
+    async def _coalesce(self):
+        loop = self._loop
+        await self._event.wait()
+        self._event.clear()
+        first = loop.time()
+        while True:
+            remaining = self.max_wait - (loop.time() - first)
+            if remaining <= 0:
+                return
+            try:
+                await asyncio.wait_for(
+                    self._event.wait(), min(self.debounce, remaining)
+                )
+            except asyncio.TimeoutError:
+                return
+            self._event.clear()
+
+    async def run(self, callback):
+        self._loop = asyncio.get_running_loop()
+        self._event = asyncio.Event()
+        self.stopped.clear()
+        thread = threading.Thread(target=self._watch, daemon=True)
+        thread.start()
+        # Process whatever is already there before waiting for inserts
+        self._signal()
+        try:
+            while True:
+                await self._coalesce()
+                start_time = time.time()
+                result = callback()
+                if asyncio.iscoroutine(result):
+                    # Run off the loop by the caller, see sources
+                    await result
+                LOGGER.debug(
+                    f"Snapshot processed via {self.mode} in "
+                    f"{round(time.time() - start_time, 1)} seconds"
+                )
+        finally:
+            self.stopped.set()
@@ -111,6 +111,39 @@ def test(ctx, coverage='', path='', tests=''):
     )
 
 
+@task
+def indexes(ctx, command='explain'):
+    """Ensure the Mongo indexes exist or check the hot queries use them."""
+    ctx.run(
+        "rez env {0}-{1} -- python -m notifications.indexes {2}".format(
+            NAME, version, command
+        )
+    )
+
+
+@task
+def compact_locks(ctx):
+    """Merge duplicate render locks and stamp them for TTL expiry."""
+    ctx.run(
+        "rez env {0}-{1} -- python -m notifications.locks compact".format(
+            NAME, version
+        )
+    )
+
+
+@task
+def bench(ctx, jobs=2000, rules=200, users=50, shards=0, raw=False, output=''):
+    """Benchmark cue.run and cue.run_summary on synthetic farm data."""
+    output = " --output {}".format(output) if output else ""
+    raw = " --raw" if raw else ""
+    ctx.run(
+        "rez env {0}-{1} -- python -m notifications.bench "
+        "--jobs {2} --rules {3} --users {4} --shards {5}{6}{7}".format(
+            NAME, version, jobs, rules, users, shards, raw, output
+        )
+    )
+
+
 @task(pre=[clean])
 def release(ctx, extra='--skip-repo-errors', force=False):
     location = '/software/rez/packages/int/{0}/{1}/package.py'.format(name, version)
@@ -0,0 +1,206 @@
+import time
+
+import pytest
+
+from notifications.cue import CueEngine, get_summaries
+from notifications.metrics import METRICS
+from notifications.storage import MemoryStorage
+from notifications.throttle import THROTTLE_USER_BURST, THROTTLE_CHANNEL_BURST
+
+
+RULES = [{
+    "notified_for": "render_failing",
+    "user": "ann",
+    "delivery": "slack",
+    "targets": ["*"],
+}]
+
+
+def get_snapshot(dead_frames, count=1):
+    now = time.time()
+    return {"data": {"jobs": [
+        {
+            "name": f"job{i}",
+            "user": "bob",
+            "state": "0",
+            "deadFrames": dead_frames,
+            "startTime": now,
+            "stopTime": 0,
+        }
+        for i in range(count)
+    ]}}
+
+
+def get_render(name, start, **fields):
+    render = {
+        "name": name,
+        "user": "bob",
+        "state": "0",
+        "deadFrames": 0,
+        "startTime": start,
+        "stopTime": 0,
+        "show": "show",
+        "shot": "sh010",
+    }
+    return dict(render, **fields)
+
+
+def failing_once(function, error):
+    calls = []
+
+    def wrapper(*args, **kwargs):
+        if not calls:
+            calls.append(True)
+            raise error
+        return function(*args, **kwargs)
+
+    return wrapper
+
+
+def get_names(storage):
+    return sorted(
+        entry["name"] for message in storage.messages.values()
+        for entry in message["entries"]
+    )
+
+
+@pytest.fixture
+def storage():
+    return MemoryStorage(rules=RULES, snapshots=[get_snapshot(0)])
+
+
+def test_failing_job_is_notified_once(storage):
+    engine = CueEngine(storage)
+    engine.run()
+    storage.snapshots.append(get_snapshot(3))
+    engine.run()
+    engine.run()
+    assert get_names(storage) == ["job0"]
+    assert storage.locks["render_failing"] == {"job0": {"ann"}}
+
+
+@pytest.mark.parametrize("method", ["get_pending_messages", "write_tick"])
+def test_transitions_survive_a_failed_tick(storage, method):
+    engine = CueEngine(storage)
+    engine.run()
+    storage.snapshots.append(get_snapshot(3))
+    setattr(storage, method, failing_once(getattr(storage, method), RuntimeError()))
+    with pytest.raises(RuntimeError):
+        engine.run()
+    engine.run()
+    engine.run()
+    assert get_names(storage) == ["job0"]
+    assert storage.locks["render_failing"] == {"job0": {"ann"}}
+
+
+def test_appends_to_a_claimed_message_are_reopened(storage):
+    storage.snapshots.append(get_snapshot(3))
+    engine = CueEngine(storage)
+    engine.run()
+    storage.snapshots.append(get_snapshot(3, count=3))
+    write_tick = storage.write_tick
+
+    def claim_first(tick, batch_size=None):
+        # The outbox got to the pending message between prefetch and flush
+        for message in storage.messages.values():
+            message["claimed_by"] = "outbox"
+        return write_tick(tick, batch_size)
+
+    storage.write_tick = claim_first
+    engine.run()
+    claimed, reopened = sorted(
+        storage.messages.values(), key=lambda message: bool(message.get("claimed_by"))
+    )[::-1]
+    assert [entry["name"] for entry in claimed["entries"]] == ["job0"]
+    assert [entry["name"] for entry in reopened["entries"]] == ["job1", "job2"]
+    assert reopened["total"] == 2
+    assert reopened["window_close"] <= time.time()
+    assert not reopened.get("claimed_by")
+
+
+def test_volt_is_kept_apart_from_cue(storage):
+    storage.rules.append(dict(RULES[0], sources=["volt"]))
+    cue = CueEngine(storage)
+    volt = CueEngine(storage, service="volt")
+    cue.run()
+    volt.run()
+    storage.snapshots.append(get_snapshot(3))
+    cue.run()
+    volt.run()
+    assert sorted(m["service"] for m in storage.messages.values()) == ["cue", "volt"]
+    assert storage.locks["render_failing"] == {"job0": {"ann"}, "volt:job0": {"ann"}}
+
+
+def test_volt_and_cue_spend_the_same_budget(storage):
+    storage.rules.append(dict(RULES[0], sources=["volt"]))
+    cue = CueEngine(storage)
+    volt = CueEngine(storage, service="volt")
+    cue.run()
+    volt.run()
+    storage.snapshots.append(get_snapshot(3))
+    cue.run()
+    volt.run()
+    # Both opened a message, neither write hid the other's token
+    assert storage.throttle["u:ann"]["t"] < THROTTLE_USER_BURST - 1.5
+    assert storage.throttle["c:slack"]["t"] < THROTTLE_CHANNEL_BURST - 1.5
+
+
+def test_engine_metrics_are_labelled_by_source(storage):
+    storage.rules.append(dict(RULES[0], sources=["volt"]))
+    cue = CueEngine(storage)
+    volt = CueEngine(storage, service="volt")
+    storage.snapshots.append(get_snapshot(3))
+    METRICS.reset()
+    cue.run()
+    volt.run()
+    counters = {
+        (counter["name"], counter["labels"].get("service")): counter["value"]
+        for counter in METRICS.snapshot()["counters"]
+    }
+    assert counters["messages_created", "cue"] == 1
+    assert counters["messages_created", "volt"] == 1
+    assert ("messages_created", None) not in counters
+
+
+def test_window_edits_apply_without_a_restart(storage):
+    engine = CueEngine(storage)
+    engine.run()
+    storage.rules[0] = dict(RULES[0], window=600, max_entries=5)
+    storage.snapshots.append(get_snapshot(3))
+    engine.run()
+    message, = storage.messages.values()
+    assert message["window_close"] - message["window_open"] == 600
+    assert message["max_entries"] == 5
+
+
+def test_summary_reads_layers_only_for_listed_renders():
+    now = time.time()
+    layers = [{"currentCores": 8, "percentCompleted": 50}]
+    storage = MemoryStorage(
+        snapshots=[{"data": {"jobs": [get_render("job0", now, layers=layers)]}}]
+    )
+    engine = CueEngine(storage)
+    get_summaries({"bob": now - 60}, storage, engine.aggregates)
+    engine.run()
+    aggregate, _ = engine.aggregates.users["bob"]
+    assert "layers" not in aggregate.running["job0"]
+    summary = get_summaries({"bob": now - 60}, storage, engine.aggregates)["bob"]
+    assert summary["running"][0]["layers"] == layers
+
+
+def test_renders_that_left_the_farm_are_reconciled_with_stored_renders():
+    now = time.time()
+    storage = MemoryStorage(snapshots=[{"data": {"jobs": [
+        get_render("job0", now), get_render("job1", now)
+    ]}}])
+    engine = CueEngine(storage)
+    get_summaries({"bob": now - 60}, storage, engine.aggregates)
+    engine.run()
+    # job0 finished and was stored, job1 was killed
+    storage.renders.append(get_render("job0", now, state="1", stopTime=now + 5))
+    storage.snapshots.append({"data": {"jobs": []}})
+    engine.run()
+    summary = get_summaries({"bob": now - 60}, storage, engine.aggregates)["bob"]
+    assert [render["name"] for render in summary["finished"]] == ["job0"]
+    assert summary["running_count"] == 0
+    assert summary["duration"] == 5
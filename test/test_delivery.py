@@ -0,0 +1,121 @@
+import socket
+import asyncio
+import threading
+import socketserver
+
+import pytest
+from aiohttp import web
+
+from notifications.delivery import EmailBackend, WebhookBackend
+
+
+def get_message(_id, user):
+    # Plain messages render as their text, see messages.render_text
+    return {"id": _id, "user": user, "message": f"*Renders done*\n{_id}"}
+
+
+class SmtpHandler(socketserver.StreamRequestHandler):
+    """Just enough SMTP for smtplib, mail to bob is turned down."""
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def read_data(self):
+        lines = []
+        while True:
+            line = self.rfile.readline().decode()
+            if line.rstrip("\r\n") == ".":
+                return "".join(lines)
+            lines.append(line)
+
+    def handle(self):
+        self.server.sessions += 1
+        self.reply("220 stand-in")
+        while True:
+            line = self.rfile.readline().decode().strip()
+            if not line:
+                return
+            command = line.split()[0].upper()
+            if command == "RCPT" and "bob@" in line:
+                self.reply("550 no such user")
+            elif command == "DATA":
+                self.reply("354 go on")
+                self.server.mails.append(self.read_data())
+                self.reply("250 queued")
+            elif command == "QUIT":
+                self.reply("221 bye")
+                return
+            else:
+                self.reply("250 ok")
+
+
+@pytest.fixture
+def smtp_server():
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), SmtpHandler)
+    server.daemon_threads = True
+    server.sessions = 0
+    server.mails = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_email_batch_goes_out_over_one_session(smtp_server):
+    backend = EmailBackend(
+        host="127.0.0.1", port=smtp_server.server_address[1], domain="example.com"
+    )
+    messages = [get_message(_id, user) for _id, user in enumerate(["ann", "bob", "cal"])]
+    results = asyncio.run(backend.send_batch(messages))
+    # A turned down recipient doesn't cost the rest of the batch its session
+    assert results == [True, False, True]
+    assert smtp_server.sessions == 1
+    assert len(smtp_server.mails) == 2
+    assert "To: ann@example.com" in smtp_server.mails[0]
+    assert "Subject: Renders done" in smtp_server.mails[0]
+
+
+def test_email_reports_every_message_failed_without_a_server():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    backend = EmailBackend(host="127.0.0.1", port=port, timeout=1)
+    messages = [get_message(0, "ann"), get_message(1, "cal")]
+    assert asyncio.run(backend.send_batch(messages)) == [False, False]
+
+
+async def serve(handler):
+    app = web.Application()
+    app.router.add_post("/hook", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    site = web.SockSite(runner, sock)
+    await site.start()
+    return runner, f"http://127.0.0.1:{sock.getsockname()[1]}/hook"
+
+
+def test_webhook_posts_each_message_and_reports_rejections():
+    received = []
+
+    async def handler(request):
+        payload = await request.json()
+        received.append(payload)
+        return web.Response(status=500 if payload["user"] == "bob" else 200)
+
+    async def run():
+        runner, url = await serve(handler)
+        backend = WebhookBackend(url=url)
+        try:
+            return await backend.send_batch(
+                [get_message("a", "ann"), get_message("b", "bob")]
+            )
+        finally:
+            await backend.close()
+            await runner.cleanup()
+
+    assert asyncio.run(run()) == [True, False]
+    assert sorted(payload["id"] for payload in received) == ["a", "b"]
+    assert received[0]["text"].startswith("*Renders done*")
@@ -0,0 +1,34 @@
+from notifications.diff import (
+    NEW, FAILING, RECOVERED, FINISHED, UNFINISHED, SnapshotDiffer, get_transitions
+)
+
+
+def test_new_job():
+    assert get_transitions(None, ("0", 0, 1, 0)) == {NEW, RECOVERED, UNFINISHED}
+    assert get_transitions(None, ("1", 2, 1, 5)) == {NEW, FAILING, FINISHED}
+
+
+def test_unchanged_job():
+    assert get_transitions(("0", 1, 1, 0), ("0", 1, 1, 0)) == set()
+
+
+def test_failing_and_recovered():
+    assert get_transitions(("0", 0, 1, 0), ("0", 3, 1, 0)) == {FAILING}
+    assert get_transitions(("0", 3, 1, 0), ("0", 0, 1, 0)) == {RECOVERED}
+    # More dead frames on a failing job is no new transition
+    assert get_transitions(("0", 1, 1, 0), ("0", 3, 1, 0)) == set()
+
+
+def test_finished_and_unfinished():
+    assert get_transitions(("0", 0, 1, 0), ("1", 0, 1, 5)) == {FINISHED}
+    assert get_transitions(("1", 0, 1, 5), ("0", 0, 1, 0)) == {UNFINISHED}
+    assert get_transitions(("0", 0, 1, 0), ("1", 2, 1, 5)) == {FAILING, FINISHED}
+
+
+def test_differ_forgets_jobs_off_the_farm():
+    job = {"name": "a", "state": "0", "deadFrames": 0, "startTime": 1, "stopTime": 0}
+    differ = SnapshotDiffer()
+    assert differ.diff([job]) == [(job, {NEW, RECOVERED, UNFINISHED})]
+    assert differ.diff([job]) == []
+    assert differ.diff([]) == []
+    assert differ.diff([job]) == [(job, {NEW, RECOVERED, UNFINISHED})]
@@ -0,0 +1,37 @@
+from notifications.messages import add_entry, new_digest, render_text
+from notifications.templates import SECTION_TEXT_LIMIT
+
+
+def get_digest(amounts, max_entries=1000):
+    digest = new_digest("ann", "slack", 0)
+    digest["max_entries"] = max_entries
+    for rule_type, amount in amounts.items():
+        for i in range(amount):
+            add_entry(digest, {
+                "rule_type": rule_type, "name": f"{rule_type}_{i:04d}_" + "x" * 40,
+                "user": "bob",
+            })
+    return digest
+
+
+def test_digest_lists_everything_that_fits():
+    text = render_text(get_digest({"render_failing": 2, "render_submitted": 1}))
+    assert "*Farm jobs failing* (2)" in text
+    assert "*Farm job submitted* (1)" in text
+    assert "more..." not in text
+
+
+def test_digest_overflow_keeps_every_type_and_one_more_line():
+    digest = get_digest({"render_failing": 150, "render_submitted": 150}, 200)
+    text = render_text(digest)
+    lines = text.split("\n")
+    assert len(text) <= SECTION_TEXT_LIMIT
+    assert "*Farm jobs failing* (150)" in lines
+    assert "*Farm jobs submitted* (150)" in lines
+    failing = [line for line in lines if line.startswith("`render_failing")]
+    submitted = [line for line in lines if line.startswith("`render_submitted")]
+    assert abs(len(failing) - len(submitted)) <= 1
+    # Hidden entries and the 100 that were never stored
+    more = [line for line in lines if line.endswith("more...")]
+    assert more == [f"and {300 - len(failing) - len(submitted)} more..."]
+    assert lines[-1] == more[0]
@@ -0,0 +1,197 @@
+import time
+import asyncio
+from types import SimpleNamespace
+
+from notifications.delivery import Backend
+from notifications.outbox import OutboxDispatcher
+
+
+def matches_value(value, condition):
+    if not isinstance(condition, dict):
+        return value == condition
+    for op, operand in condition.items():
+        if op == "$in" and value not in operand:
+            return False
+        if op == "$ne" and value == operand:
+            return False
+        if op in ("$gt", "$lt", "$gte"):
+            if value is None:
+                return False
+            if op == "$gt" and not value > operand:
+                return False
+            if op == "$lt" and not value < operand:
+                return False
+            if op == "$gte" and not value >= operand:
+                return False
+        if op == "$not" and matches_value(value, operand):
+            return False
+    return True
+
+
+def matches(doc, query):
+    for key, condition in query.items():
+        if key == "$and":
+            if not all(matches(doc, q) for q in condition):
+                return False
+        elif key == "$or":
+            if not any(matches(doc, q) for q in condition):
+                return False
+        elif not matches_value(doc.get(key), condition):
+            return False
+    return True
+
+
+class Cursor(list):
+    def limit(self, n):
+        return Cursor(self[:n])
+
+
+class FakeCollection:
+    """Just the queries and updates the outbox sends to mongo."""
+
+    def __init__(self, docs=()):
+        self.docs = {doc["_id"]: dict(doc) for doc in docs}
+
+    def find(self, query, projection=None):
+        return Cursor(dict(doc) for doc in self.docs.values() if matches(doc, query))
+
+    def update(self, doc, update):
+        for key, value in update.get("$set", {}).items():
+            doc[key] = value
+        for key in update.get("$unset", {}):
+            doc.pop(key, None)
+        for key, n in update.get("$inc", {}).items():
+            doc[key] = doc.get(key, 0) + n
+        for key, value in update.get("$addToSet", {}).items():
+            values = doc.setdefault(key, [])
+            values += [v for v in value["$each"] if v not in values]
+
+    def update_one(self, query, update):
+        return self.update_many(query, update, limit=1)
+
+    def update_many(self, query, update, limit=None):
+        docs = [doc for doc in self.docs.values() if matches(doc, query)][:limit]
+        for doc in docs:
+            self.update(doc, update)
+        return SimpleNamespace(modified_count=len(docs))
+
+    def delete_many(self, query):
+        for doc in [doc for doc in self.docs.values() if matches(doc, query)]:
+            del self.docs[doc["_id"]]
+
+
+def get_message(_id, delivery="slack", **kwargs):
+    message = dict(
+        _id=_id, id=_id, user="ann", delivery=delivery, rule_type="render_failing",
+        entries=[], total=1, window_close=time.time() - 1,
+    )
+    message.update(kwargs)
+    return message
+
+
+def get_dispatcher(coll, **backends):
+    return OutboxDispatcher(coll, backends, worker_id="test", max_attempts=2)
+
+
+def test_claim_only_takes_available_messages():
+    now = time.time()
+    coll = FakeCollection([
+        get_message("due"),
+        get_message("open", window_close=now + 60),
+        get_message("taken", claimed_by="other", claim="x", lease_expires=now + 60),
+        get_message("expired", claimed_by="other", claim="x", lease_expires=now - 1),
+        get_message("failed", failed=True),
+    ])
+    claim, messages = get_dispatcher(coll).claim()
+    assert sorted(msg["_id"] for msg in messages) == ["due", "expired"]
+    assert all(msg["claim"] == claim for msg in messages)
+    assert coll.docs["taken"]["claim"] == "x"
+
+
+def test_a_claimed_message_is_not_claimed_twice():
+    coll = FakeCollection([get_message("a")])
+    claim, messages = get_dispatcher(coll).claim()
+    assert len(messages) == 1
+    assert get_dispatcher(coll).claim() == (None, [])
+
+
+def test_ack_ignores_messages_claimed_by_someone_else():
+    coll = FakeCollection([get_message("a")])
+    dispatcher = get_dispatcher(coll)
+    claim, _ = dispatcher.claim()
+    dispatcher.ack("stale", ["a"], {})
+    assert "a" in coll.docs
+    dispatcher.ack(claim, ["a"], {})
+    assert not coll.docs
+
+
+def test_message_fails_after_max_attempts():
+    async def slack(message):
+        return False
+
+    coll = FakeCollection([get_message("a")])
+    dispatcher = get_dispatcher(coll, slack=slack)
+    asyncio.run(dispatcher.run_once())
+    assert not coll.docs["a"].get("failed")
+    asyncio.run(dispatcher.run_once())
+    assert coll.docs["a"]["failed"]
+    # Failed messages expire through a TTL index on failed_at
+    assert coll.docs["a"]["failed_at"]
+    assert dispatcher.claim() == (None, [])
+
+
+def test_fan_out_only_retries_the_failed_delivery():
+    sent = []
+    email_ok = [False, True]
+
+    async def slack(message):
+        sent.append("slack")
+        return True
+
+    async def email(message):
+        sent.append("email")
+        return email_ok.pop(0)
+
+    coll = FakeCollection([get_message("a", delivery="slack,email")])
+    dispatcher = get_dispatcher(coll, slack=slack, email=email)
+    asyncio.run(dispatcher.run_once())
+    doc = coll.docs["a"]
+    assert doc["delivered_to"] == ["slack"]
+    assert doc["attempts"] == 1
+    assert doc["claimed_by"] is None and "claim" not in doc
+    asyncio.run(dispatcher.run_once())
+    assert sorted(sent) == ["email", "email", "slack"]
+    assert not coll.docs
+
+
+def test_dispatchers_share_a_backends_concurrency():
+    in_flight = []
+    peak = []
+
+    class SlowBackend(Backend):
+        name = "slack"
+        concurrency = 1
+
+        async def send(self, message):
+            in_flight.append(message["id"])
+            peak.append(len(in_flight))
+            await asyncio.sleep(0.01)
+            in_flight.remove(message["id"])
+            return True
+
+    backend = SlowBackend()
+    dispatchers = [
+        OutboxDispatcher(FakeCollection(), {"slack": backend}, worker_id=f"w{i}")
+        for i in range(2)
+    ]
+
+    async def run():
+        return await asyncio.gather(*[
+            dispatcher.deliver(
+                "slack", [get_message(f"{i}{n}") for n in range(2)], asyncio.Semaphore(8)
+            )
+            for i, dispatcher in enumerate(dispatchers)
+        ])
+
+    assert asyncio.run(run()) == [[True, True], [True, True]]
+    assert max(peak) == 1
@@ -0,0 +1,64 @@
+import random
+import fnmatch
+
+from notifications.rules import RuleIndex
+
+
+def is_rule_relevant(rule, job):
+    # The linear scan the index replaced, kept as the reference
+    if not any(fnmatch.fnmatch(job["name"], target) for target in rule["targets"]):
+        return False
+    users_filter = rule.get("filters", {}).get("users", [])
+    return not users_filter or job["user"] in users_filter
+
+
+TARGETS = ["a", "ab", "abc", "b", "*", "a*", "ab*", "*c", "a?c", "[ab]*", "?b*", "b*c"]
+USERS = ["ann", "bob", "cid"]
+
+
+def random_name(rand):
+    return "".join(rand.choice("abc") for _ in range(rand.randint(0, 4)))
+
+
+def random_rules(rand, count):
+    rules = []
+    for i in range(count):
+        rule = {
+            "id": i,
+            "notified_for": rand.choice(["render_failing", "render_finished"]),
+            "user": rand.choice(USERS),
+            "delivery": "slack",
+            "targets": rand.sample(TARGETS, rand.randint(1, 3)),
+        }
+        if rand.random() < 0.4:
+            rule["filters"] = {"users": rand.sample(USERS, rand.randint(1, 2))}
+        rules.append(rule)
+    return rules
+
+
+def test_index_matches_the_scan():
+    rand = random.Random(4)
+    for _ in range(50):
+        rules = random_rules(rand, rand.randint(1, 30))
+        index = RuleIndex(rules)
+        for _ in range(20):
+            job = {"name": random_name(rand), "user": rand.choice(USERS)}
+            for notified_for in ("render_failing", "render_finished", "render_submitted"):
+                expected = [
+                    rule for rule in rules
+                    if rule["notified_for"] == notified_for and is_rule_relevant(rule, job)
+                ]
+                assert index.match(job, notified_for) == expected
+
+
+def test_a_rule_matching_several_targets_is_returned_once():
+    rule = {"notified_for": "render_failing", "targets": ["abc", "a*", "*c", "a?c"]}
+    index = RuleIndex([rule])
+    assert index.match({"name": "abc", "user": "ann"}, "render_failing") == [rule]
+
+
+def test_match_all_only_has_types_with_a_match():
+    failing = {"notified_for": "render_failing", "targets": ["a*"]}
+    finished = {"notified_for": "render_finished", "targets": ["b*"]}
+    index = RuleIndex([failing, finished])
+    assert index.match_all({"name": "ab", "user": "ann"}) == {"render_failing": [failing]}
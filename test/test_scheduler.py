@@ -0,0 +1,95 @@
+import time
+import datetime
+
+import pytest
+
+from notifications.scheduler import SummaryScheduler, get_delivery_key
+from notifications.slack import Response
+from notifications.storage import MemoryStorage
+
+
+def get_storage():
+    # A summary that was due five minutes ago, with one render to report
+    now = datetime.datetime.now()
+    summary = (now - datetime.timedelta(minutes=5)).strftime("%H:%M")
+    logoff = (now - datetime.timedelta(hours=1)).strftime("%H:%M")
+    render = {
+        "name": "job0",
+        "user": "ann",
+        "state": "1",
+        "deadFrames": 0,
+        "startTime": time.time() - 10,
+        "stopTime": time.time() - 5,
+    }
+    return MemoryStorage(
+        times={"ann": {"summary": summary, "logoff": logoff}},
+        renders=[render],
+        snapshots=[{"data": {"jobs": []}}],
+    )
+
+
+def get_scheduler(storage, sent, status=200):
+    def send(**kwargs):
+        sent.append(kwargs)
+        return Response(status, "{}")
+
+    scheduler = SummaryScheduler(storage, send=send)
+    scheduler.load()
+    return scheduler
+
+
+def test_summary_is_sent_once_across_schedulers():
+    storage = get_storage()
+    sent = []
+    first = get_scheduler(storage, sent)
+    second = get_scheduler(storage, sent)
+    due = first.pop_due(time.time())
+    assert [user for _, user, _ in due] == ["ann"]
+    assert list(first.fire(due)) == ["ann"]
+    assert second.fire(second.pop_due(time.time())) == {}
+    assert [kwargs["user"] for kwargs in sent] == ["ann"]
+
+
+def test_reload_does_not_bring_a_sent_summary_back():
+    storage = get_storage()
+    sent = []
+    scheduler = get_scheduler(storage, sent)
+    scheduler.fire(scheduler.pop_due(time.time()))
+    scheduler.load()
+    assert scheduler.pop_due(time.time()) == []
+    assert len(sent) == 1
+
+
+def test_keys_are_released_when_the_run_fails():
+    storage = get_storage()
+    sent = []
+    scheduler = get_scheduler(storage, sent)
+    due = scheduler.pop_due(time.time())
+    key = get_delivery_key("ann", due[0][2])
+    get_renders_since = storage.get_renders_since
+
+    def unreachable(*args, **kwargs):
+        raise RuntimeError()
+
+    storage.get_renders_since = unreachable
+    with pytest.raises(RuntimeError):
+        scheduler.fire(due)
+    assert key not in storage.deliveries
+    assert key not in scheduler.done
+    storage.get_renders_since = get_renders_since
+    scheduler.load()
+    scheduler.fire(scheduler.pop_due(time.time()))
+    assert key in storage.deliveries
+    assert len(sent) == 1
+
+
+def test_key_is_released_when_slack_rejects_the_summary():
+    storage = get_storage()
+    sent = []
+    scheduler = get_scheduler(storage, sent, status=400)
+    due = scheduler.pop_due(time.time())
+    key = get_delivery_key("ann", due[0][2])
+    scheduler.fire(due)
+    assert len(sent) == 1
+    assert key not in storage.deliveries
+    assert key not in scheduler.done
@@ -0,0 +1,98 @@
+import time
+import random
+import functools
+
+from notifications.cue import CueEngine
+from notifications.shards import ShardedCueEngine
+from notifications.snapshot import get_shard, get_shard_expression
+from notifications.storage import MemoryStorage
+
+
+def run_expression(expression, variables):
+    # Just enough of the aggregation language for get_shard_expression
+    if isinstance(expression, str) and expression.startswith("$$"):
+        return variables[expression[2:]]
+    if not isinstance(expression, dict):
+        return expression
+    (op, args), = expression.items()
+    if op == "$reduce":
+        value = run_expression(args["initialValue"], variables)
+        for item in run_expression(args["input"], variables):
+            value = run_expression(args["in"], dict(variables, value=value, this=item))
+        return value
+    if not isinstance(args, list):
+        args = [args]
+    args = [run_expression(arg, variables) for arg in args]
+    if op == "$mod":
+        return args[0] % args[1]
+    if op == "$add":
+        return sum(args)
+    if op == "$multiply":
+        return args[0] * args[1]
+    if op == "$range":
+        return range(args[0], args[1])
+    if op == "$strLenCP":
+        return len(args[0])
+    if op == "$substrCP":
+        return args[0][args[1]:args[1] + args[2]]
+    if op == "$indexOfCP":
+        return args[0].find(args[1])
+    raise NotImplementedError(op)
+
+
+def test_mongo_and_python_agree_on_shards():
+    rand = random.Random(2)
+    for _ in range(200):
+        name = "".join(rand.choice("abcXYZ019-_. /é") for _ in range(rand.randint(0, 30)))
+        shards = rand.randint(2, 8)
+        expression = get_shard_expression("$$name", shards)
+        assert run_expression(expression, {"name": name}) == get_shard(name, shards)
+
+
+RULES = [{
+    "notified_for": "render_failing",
+    "user": "ann",
+    "delivery": "slack",
+    "targets": ["*"],
+}]
+
+
+def get_snapshots(now):
+    jobs = [
+        {
+            "name": f"job{i}",
+            "user": "bob",
+            "state": "0",
+            "deadFrames": 0,
+            "startTime": now,
+            "stopTime": 0,
+        }
+        for i in range(40)
+    ]
+    failing = [dict(job, deadFrames=i % 3) for i, job in enumerate(jobs)]
+    return [{"data": {"jobs": jobs}}, {"data": {"jobs": failing}}]
+
+
+def get_total(storage):
+    return sum(message["total"] for message in storage.messages.values())
+
+
+def test_shards_notify_like_one_engine():
+    snapshots = get_snapshots(time.time())
+    single = MemoryStorage(rules=RULES)
+    parent = MemoryStorage(rules=RULES)
+    factory = functools.partial(MemoryStorage, rules=RULES, snapshots=snapshots)
+    engine = CueEngine(single)
+    sharded = ShardedCueEngine(parent, shards=3, storage_factory=factory)
+    try:
+        for snapshot in snapshots:
+            single.snapshots.append(snapshot)
+            parent.snapshots.append(snapshot)
+            engine.run()
+            sharded.run()
+        assert parent.locks == single.locks
+        assert len(parent.locks["render_failing"]) == 26
+        assert get_total(parent) == get_total(single) == 26
+        assert all(stats["jobs"] for stats in sharded.shard_stats)
+    finally:
+        sharded.close()
@@ -0,0 +1,57 @@
+import time
+import socket
+import asyncio
+from email.utils import formatdate
+
+import pytest
+from aiohttp import web
+
+from notifications.slack import SlackClient, get_retry_after
+
+
+def test_retry_after_takes_seconds_or_an_http_date():
+    assert get_retry_after("3", 0.5) == 3
+    assert 8 < get_retry_after(formatdate(time.time() + 10, usegmt=True), 0.5) <= 10
+    assert get_retry_after(formatdate(time.time() - 10, usegmt=True), 0.5) == 0
+    assert get_retry_after("soon", 0.5) == 0.5
+    assert get_retry_after(None, 0.5) == 0.5
+
+
+async def serve(answers):
+    # Answers each request with the next (status, headers), then 200
+    requests = []
+
+    async def handler(request):
+        requests.append(await request.json())
+        status, headers = answers.pop(0) if answers else (200, {})
+        return web.json_response({"ok": status < 400}, status=status, headers=headers)
+
+    app = web.Application()
+    app.router.add_post("/api/send_slack_message", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    site = web.SockSite(runner, sock)
+    await site.start()
+    return runner, f"http://127.0.0.1:{sock.getsockname()[1]}/api", requests
+
+
+@pytest.mark.parametrize("retry_after", [
+    formatdate(time.time() - 10, usegmt=True),
+    "not a date",
+])
+def test_rate_limited_request_is_retried(retry_after):
+    async def run():
+        runner, url, requests = await serve([(429, {"Retry-After": retry_after})])
+        client = SlackClient(base_url=url, backoff=0.01)
+        try:
+            resp = await client.send_message(user="ann", text="hi")
+        finally:
+            await client.close()
+            await runner.cleanup()
+        return resp, requests
+
+    resp, requests = asyncio.run(run())
+    assert resp.ok
+    assert requests == [{"user": "ann", "text": "hi"}] * 2
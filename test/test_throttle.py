@@ -0,0 +1,50 @@
+from notifications.throttle import THROTTLE_CHANNEL_BURST, Throttle, merge_bucket
+
+
+def get_throttle(docs=()):
+    throttle = Throttle(user_burst=10, user_per_minute=6)
+    throttle.load(docs)
+    return throttle
+
+
+def persist(docs, throttle):
+    stored = {doc["_id"]: doc for doc in docs}
+    for key, change in throttle.pop_changes():
+        stored[key] = dict(merge_bucket(stored.get(key), change), _id=key)
+    return list(stored.values())
+
+
+def test_budget_runs_out_and_refills():
+    throttle = get_throttle()
+    assert all(throttle.allow("ann", "slack", 100) for _ in range(6))
+    # The delivery budget of 6 is spent, the user's isn't
+    assert not throttle.allow("ann", "slack", 100)
+    assert throttle.allow("ann", "email", 100)
+    assert throttle.allow("ann", "slack", 200)
+
+
+def test_throttles_loaded_together_both_count():
+    docs = [{"_id": "u:ann", "t": 10, "at": 90}]
+    first = get_throttle(docs)
+    second = get_throttle(docs)
+    for throttle in (first, second):
+        for delivery in ("slack", "email", "webhook"):
+            assert throttle.allow("ann", delivery, 100)
+    docs = persist(persist(docs, first), second)
+    stored = {doc["_id"]: doc for doc in docs}
+    # Each spent 3 of the user's 10, written back one after the other
+    assert stored["u:ann"]["t"] == 4
+    assert stored["u:ann"]["at"] == 100
+    assert stored["c:slack"]["t"] == THROTTLE_CHANNEL_BURST - 2
+
+
+def test_merge_refills_to_the_later_time():
+    throttle = get_throttle([{"_id": "u:ann", "t": 0, "at": 100}])
+    throttle.get_bucket("u:ann").tokens = 5
+    throttle.get_bucket("u:ann").take(110)
+    throttle.dirty.add("u:ann")
+    stored = {"t": 0, "at": 100}
+    _, change = throttle.pop_changes()[0]
+    # 10 seconds at 6 a minute refill one token, one was spent since
+    assert merge_bucket(stored, change)["t"] == 0
+    assert merge_bucket(None, change)["t"] == 9
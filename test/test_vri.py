@@ -0,0 +1,49 @@
+from notifications.vri import VriResolver, get_asset_dirs
+
+
+def get_job(*paths):
+    return {"name": "job0", "layers": [{"outputPaths": list(paths)}]}
+
+
+def write_vri(root, asset, vri):
+    asset_dir = root / asset
+    asset_dir.mkdir(parents=True, exist_ok=True)
+    (asset_dir / ".vri").write_text(vri)
+    return str(asset_dir / "beauty.0001.exr")
+
+
+def test_walk_stops_at_the_first_path_outside_root(tmp_path):
+    inside = str(tmp_path / "show" / "a" / "beauty.0001.exr")
+    outside = "/elsewhere/b/beauty.0001.exr"
+    job = get_job(inside, outside, str(tmp_path / "c" / "x.exr"))
+    assert [str(d) for d in get_asset_dirs(job, str(tmp_path))] == [
+        str(tmp_path / "show" / "a")
+    ]
+
+
+def test_first_asset_with_a_vri_wins(tmp_path):
+    resolver = VriResolver(root=str(tmp_path), timeout=5)
+    missing = str(tmp_path / "show" / "missing" / "beauty.0001.exr")
+    found = write_vri(tmp_path, "show/found", "vri-found")
+    other = write_vri(tmp_path, "show/other", "vri-other")
+    jobs = [get_job(missing, found, other), get_job(other), get_job("/elsewhere/x.exr")]
+    assert resolver.resolve_many(jobs) == ["vri-found", "vri-other", ""]
+
+
+def test_lookups_are_cached_until_cleared(tmp_path):
+    resolver = VriResolver(root=str(tmp_path), timeout=5)
+    path = str(tmp_path / "show" / "a" / "beauty.0001.exr")
+    assert resolver.resolve(get_job(path)) == ""
+    write_vri(tmp_path, "show/a", "vri-a")
+    # The miss is cached as well
+    assert resolver.resolve(get_job(path)) == ""
+    resolver.clear()
+    assert resolver.resolve(get_job(path)) == "vri-a"
+
+
+def test_expired_entries_are_read_again(tmp_path):
+    resolver = VriResolver(root=str(tmp_path), timeout=5, ttl=0)
+    path = write_vri(tmp_path, "show/a", "vri-a")
+    assert resolver.resolve(get_job(path)) == "vri-a"
+    write_vri(tmp_path, "show/a", "vri-b")
+    assert resolver.resolve(get_job(path)) == "vri-b"
@@ -0,0 +1,81 @@
+import time
+import queue
+import asyncio
+
+import pytest
+from pymongo.errors import OperationFailure
+
+from notifications.watch import SnapshotWatcher
+
+
+class FakeStream:
+    def __init__(self, farm):
+        self.farm = farm
+        self.alive = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.alive = False
+
+    def try_next(self):
+        try:
+            return self.farm.changes.get(timeout=0.01)
+        except queue.Empty:
+            return None
+
+
+class FakeFarm:
+    """store_farm with or without change streams."""
+
+    full_name = "test.store_farm"
+
+    def __init__(self, change_streams=True):
+        self.change_streams = change_streams
+        self.docs = []
+        self.changes = queue.Queue()
+
+    def insert(self):
+        self.docs.append({"_id": len(self.docs) + 1})
+        self.changes.put({"operationType": "insert"})
+
+    def watch(self, pipeline, **kwargs):
+        if not self.change_streams:
+            raise OperationFailure("$changeStream is only supported on replica sets")
+        return FakeStream(self)
+
+    def find_one(self, query=None, sort=None, projection=None):
+        after = (query or {}).get("_id", {}).get("$gt")
+        docs = [doc for doc in self.docs if after is None or doc["_id"] > after]
+        return docs[-1] if docs else None
+
+
+async def watch(farm, burst):
+    watcher = SnapshotWatcher(farm, debounce=0.05, max_wait=0.5, poll_interval=0.01)
+    calls = []
+    task = asyncio.create_task(watcher.run(lambda: calls.append(time.monotonic())))
+    while watcher.mode is None:
+        await asyncio.sleep(0.01)
+    # Let the tail read where the collection is before anything lands
+    await asyncio.sleep(0.05)
+    for _ in range(burst):
+        farm.insert()
+    await asyncio.sleep(0.3)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    return watcher, calls
+
+
+@pytest.mark.parametrize("change_streams, mode", [
+    (True, "change_stream"),
+    (False, "tail"),
+])
+def test_a_burst_of_snapshots_triggers_one_callback(change_streams, mode):
+    farm = FakeFarm(change_streams)
+    watcher, calls = asyncio.run(watch(farm, burst=3))
+    assert watcher.mode == mode
+    # Once for what was already there, once for the burst
+    assert len(calls) == 2
+    assert watcher.stopped.is_set()